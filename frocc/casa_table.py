@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+'''
+Minimal pure-Python reader for CASA tables.
+
+Only what is needed to plan the output channels without casatools is
+supported: columns stored by the StandardStMan data manager holding scalars,
+variable length strings and (direct or indirect) numerical arrays. This
+covers the SPECTRAL_WINDOW (CHAN_FREQ, CHAN_WIDTH) and FIELD (NAME)
+subtables of measurement sets. Everything else raises a NotImplementedError,
+so callers can fall back to casatools.
+
+The layout of table.dat and of the StandardStMan files follows the casacore
+sources (tables/Tables/PlainTable.cc, ColumnSet.cc, BaseColDesc.cc and
+tables/DataMan/SSMBase.cc).
+'''
+
+import os
+import struct
+
+import numpy as np
+
+
+AIPSIO_MAGIC = b"\xbe\xbe\xbe\xbe"
+# casacore DataType enum
+DATA_TYPES = [
+    "bool", "char", "uchar", "short", "ushort", "int", "uint", "float", "double",
+    "complex", "dcomplex", "string", "table", "arraybool", "arraychar", "arrayuchar",
+    "arrayshort", "arrayushort", "arrayint", "arrayuint", "arrayfloat", "arraydouble",
+    "arraycomplex", "arraydcomplex", "arraystr", "record", "other",
+]
+NUMPY_DTYPES = {
+    "short": "i2", "ushort": "u2", "int": "i4", "uint": "u4", "float": "f4",
+    "double": "f8", "complex": "c8", "dcomplex": "c16",
+}
+DEFAULT_VALUE_SIZES = {
+    "bool": 1, "short": 2, "ushort": 2, "int": 4, "uint": 4, "float": 4,
+    "double": 8, "complex": 8, "dcomplex": 16, "record": 8,
+}
+# StandardStMan files start with a 512 byte header followed by the buckets
+SSM_HEADER_SIZE = 512
+
+
+class AipsIOReader:
+    '''
+    Reads the AipsIO serialisation of casacore from a byte string.
+    '''
+
+    def __init__(self, data, endian=">"):
+        self.data = data
+        self.pos = 0
+        self.endian = endian
+
+    def read(self, n):
+        if self.pos + n > len(self.data):
+            raise ValueError("Unexpected end of CASA table data.")
+        chunk = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return chunk
+
+    def read_int32(self):
+        return struct.unpack(self.endian + "i", self.read(4))[0]
+
+    def read_int64(self):
+        return struct.unpack(self.endian + "q", self.read(8))[0]
+
+    def read_bool(self):
+        return self.read(1) == b"\x01"
+
+    def read_string(self):
+        return self.read(self.read_int32()).replace(b"\x00", b"").decode("ascii")
+
+    def read_object(self):
+        '''
+        Returns a reader for the next object, which is prefixed by its length
+        in bytes (including the length itself).
+        '''
+        return AipsIOReader(self.read(self.read_int32() - 4), endian=self.endian)
+
+    def skip_object(self):
+        self.read(self.read_int32() - 4)
+
+    def check_type(self, typeName, versionList):
+        '''
+        Reads the object type and version, returns the version.
+        '''
+        objectType = self.read_string()
+        version = self.read_int32()
+        if objectType != typeName or version not in versionList:
+            raise NotImplementedError(f"CASA table object {objectType} version {version} is not supported.")
+        return version
+
+    def read_iposition(self):
+        iposition = self.read_object()
+        iposition.check_type("IPosition", (1,))
+        return [iposition.read_int32() for ii in range(0, iposition.read_int32())]
+
+    def read_block(self):
+        self.read_int32()
+        self.read_string()
+        self.read_int32()
+        return [self.read_int32() for ii in range(0, self.read_int32())]
+
+
+def get_aipsio_endian(data):
+    '''
+    AipsIO objects start with their length, which is small compared to 2^24,
+    so the first byte is zero for big endian data.
+    '''
+    return ">" if data[:1] == b"\x00" else "<"
+
+
+def read_column_desc(reader):
+    '''
+    Reads one column description from the table description.
+    '''
+    reader.read_int32()
+    columnType = reader.read_string()
+    if not columnType.startswith(("ScalarColumnDesc", "ArrayColumnDesc")) or reader.read_int32() != 1:
+        raise NotImplementedError(f"CASA column description {columnType} is not supported.")
+    columnDesc = {"isArray": columnType.startswith("ArrayColumnDesc")}
+    columnDesc["name"] = reader.read_string()
+    reader.read_string()  # comment
+    columnDesc["dataManagerType"] = reader.read_string()
+    reader.read_string()  # data manager group
+    columnDesc["valueType"] = DATA_TYPES[reader.read_int32()]
+    option = reader.read_int32()
+    columnDesc["isDirect"] = option & 1 == 1
+    columnDesc["ndim"] = reader.read_int32()
+    if columnDesc["ndim"] != 0:
+        columnDesc["shape"] = reader.read_iposition()
+    columnDesc["maxlen"] = reader.read_int32()
+    reader.skip_object()  # keywords
+    reader.read_int32()
+    if columnDesc["isArray"]:
+        reader.read(1)
+    elif columnDesc["valueType"] == "string":
+        reader.read_string()
+    elif columnDesc["valueType"] in DEFAULT_VALUE_SIZES:
+        reader.read(DEFAULT_VALUE_SIZES[columnDesc["valueType"]])
+    else:
+        raise NotImplementedError(f"CASA column {columnDesc['name']} of type {columnDesc['valueType']} is not supported.")
+    return columnDesc
+
+
+def read_table_nrow(tablePath):
+    '''
+    Number of rows of the CASA table at tablePath, read from the start of
+    table.dat only.
+    '''
+    with open(os.path.join(tablePath, "table.dat"), "rb") as f:
+        data = f.read(1024)
+    if data[:4] != AIPSIO_MAGIC:
+        raise ValueError(f"Not a CASA table: {tablePath}")
+    reader = AipsIOReader(data[8:], endian=get_aipsio_endian(data[4:]))
+    tableVersion = reader.check_type("Table", (2, 3))
+    return reader.read_int64() if tableVersion > 2 else reader.read_int32()
+
+
+def read_table_dat(tablePath):
+    '''
+    Reads the table description, the column to data manager mapping and the
+    StandardStMan column layout from table.dat.
+
+    Returns
+    -------
+    tableDict: dict
+       nrow, columnDescList (one dict per column, including the data manager
+       sequence number and the column shape) and ssmDict (StandardStMan
+       layout by sequence number).
+
+    '''
+    with open(os.path.join(tablePath, "table.dat"), "rb") as f:
+        data = f.read()
+    if data[:4] != AIPSIO_MAGIC:
+        raise ValueError(f"Not a CASA table: {tablePath}")
+    reader = AipsIOReader(data[4:], endian=get_aipsio_endian(data[4:]))
+    table = reader.read_object()
+    tableVersion = table.check_type("Table", (2, 3))
+    nrow = table.read_int64() if tableVersion > 2 else table.read_int32()
+    table.read_int32()  # format
+    table.read_string()  # table type
+
+    tableDesc = table.read_object()
+    tableDesc.check_type("TableDesc", (2,))
+    for ii in range(0, 3):
+        tableDesc.read_string()
+    tableDesc.skip_object()  # keywords
+    tableDesc.skip_object()  # private keywords
+    columnDescList = [read_column_desc(tableDesc) for ii in range(0, tableDesc.read_int32())]
+
+    columnSetVersion = -table.read_int32()
+    if columnSetVersion not in (2, 3):
+        raise NotImplementedError(f"CASA ColumnSet version {columnSetVersion} is not supported.")
+    if columnSetVersion > 2:
+        table.read_int64()
+    else:
+        table.read_int32()
+    table.read_int32()
+    dataManagerList = [[table.read_string(), table.read_int32()] for ii in range(0, table.read_int32())]
+    for columnDesc in columnDescList:
+        if table.read_int32() < 2:
+            raise NotImplementedError("CASA PlainColumn version < 2 is not supported.")
+        table.read_string()
+        table.read_int32()
+        columnDesc["seqnr"] = table.read_int32()
+        columnDesc["columnShape"] = []
+        if columnDesc["ndim"] != 0 and table.read_bool():
+            columnDesc["columnShape"] = table.read_iposition()
+
+    ssmDict = {}
+    for name, seqnr in dataManagerList:
+        # every data manager blob starts with its length, 0 for data managers
+        # that keep everything in their own files (e.g. TiledColumnStMan)
+        blob = table.read(table.read_int32())
+        if name == "StandardStMan":
+            if blob[:4] != AIPSIO_MAGIC:
+                raise ValueError(f"No StandardStMan description in CASA table: {tablePath}")
+            ssm = AipsIOReader(blob[4:], endian=table.endian).read_object()
+            ssm.check_type("SSM", (2,))
+            ssm.read_string()
+            ssmDict[seqnr] = {"columnOffset": ssm.read_block(), "columnIndexMap": ssm.read_block()}
+    return {"nrow": nrow, "columnDescList": columnDescList, "ssmDict": ssmDict}
+
+
+def read_ssm_header(filepath):
+    '''
+    Reads the header of a StandardStMan file table.f<seqnr>.
+    '''
+    with open(filepath, "rb") as f:
+        data = f.read(SSM_HEADER_SIZE)
+    if data[:4] != AIPSIO_MAGIC:
+        raise ValueError(f"Not a StandardStMan file: {filepath}")
+    reader = AipsIOReader(data[4:], endian=get_aipsio_endian(data[4:])).read_object()
+    version = reader.check_type("StandardStMan", (2, 3))
+    header = {"bigEndian": reader.read_bool() if version >= 3 else True}
+    for key in [
+        "bucketSize", "nBuckets", "persistentCache", "nFreeBuckets", "firstFreeBucket",
+        "nIndexBuckets", "firstIndexBucket", "indexBucketOffset", "lastStringBucket",
+        "indexLength", "nIndices",
+    ]:
+        header[key] = reader.read_int32()
+    return header
+
+
+def read_ssm_index(f, header, endian):
+    '''
+    Reads the last row and the bucket number of all data buckets from the
+    (possibly chained) index buckets.
+    '''
+    indexBytes = b""
+    nextIndexBucket = header["firstIndexBucket"]
+    for ii in range(0, header["nIndexBuckets"]):
+        bucketStart = SSM_HEADER_SIZE + nextIndexBucket * header["bucketSize"]
+        f.seek(bucketStart)
+        # the chain to the next index bucket is always big endian
+        nextIndexBucket = struct.unpack(">i", f.read(4))[0]
+        if header["indexBucketOffset"] > 0:
+            f.seek(bucketStart + header["indexBucketOffset"])
+            indexBytes += f.read(header["indexLength"])
+        else:
+            f.seek(bucketStart + 8)
+            indexBytes += f.read(min(header["indexLength"], header["bucketSize"] - 8))
+    index = AipsIOReader(indexBytes[4:], endian=endian).read_object()
+    index.check_type("SSMIndex", (1,))
+    for ii in range(0, 3):
+        index.read_int32()
+    # free space map
+    freeSpace = index.read_object()
+    freeSpace.check_type("SimpleOrderedMap", (1,))
+    lastRowList = index.read_block()
+    bucketNumberList = index.read_block()
+    return lastRowList, bucketNumberList
+
+
+def read_ssm_string(f, header, endian, bucketCache):
+    '''
+    Reads one variable length string cell. Strings up to 8 bytes are stored in
+    place, longer ones in the string buckets.
+    '''
+    cell = f.read(8)
+    length = struct.unpack(endian + "i", f.read(4))[0]
+    if length <= 8:
+        return cell[:length].decode("ascii")
+    bucketId, offset = struct.unpack(endian + "ii", cell)
+    position = f.tell()
+    data = b""
+    while len(data) < length:
+        if bucketId not in bucketCache:
+            f.seek(SSM_HEADER_SIZE + header["bucketSize"] * bucketId + 12)
+            nextBucketId = struct.unpack(">i", f.read(4))[0]
+            bucketCache[bucketId] = (nextBucketId, f.read(header["bucketSize"] - 16))
+        nextBucketId, bucketData = bucketCache[bucketId]
+        data += bucketData[offset:offset + length - len(data)]
+        bucketId, offset = nextBucketId, 0
+    f.seek(position)
+    return data.decode("ascii")
+
+
+def read_ssm_indirect_array(fi, offset, valueType, endian):
+    '''
+    Reads one indirect array cell from table.f<seqnr>i.
+    '''
+    fi.seek(offset)
+    ndim = struct.unpack(endian + "i", fi.read(4))[0]
+    shape = struct.unpack(endian + "i" * ndim, fi.read(4 * ndim))
+    dtype = np.dtype(endian + NUMPY_DTYPES[valueType])
+    size = int(np.prod(shape))
+    return np.frombuffer(fi.read(size * dtype.itemsize), dtype=dtype).reshape(shape[::-1])
+
+
+def read_ssm_column(tablePath, tableDict, columnDesc):
+    '''
+    Reads all cells of a StandardStMan column.
+    '''
+    seqnr = columnDesc["seqnr"]
+    if seqnr not in tableDict["ssmDict"]:
+        raise NotImplementedError(f"CASA column {columnDesc['name']} is not stored by the StandardStMan.")
+    filepath = os.path.join(tablePath, f"table.f{seqnr}")
+    header = read_ssm_header(filepath)
+    endian = ">" if header["bigEndian"] else "<"
+    # position of the column among the columns of its data manager
+    columnIdx = tableDict["columnDescList"].index(columnDesc)
+    ssmColumnIdx = sum(1 for desc in tableDict["columnDescList"][:columnIdx] if desc["seqnr"] == seqnr)
+    columnOffset = tableDict["ssmDict"][seqnr]["columnOffset"][ssmColumnIdx]
+    columnBucket = tableDict["ssmDict"][seqnr]["columnIndexMap"][ssmColumnIdx]
+    valueType = columnDesc["valueType"]
+    if valueType != "string" and valueType not in NUMPY_DTYPES:
+        raise NotImplementedError(f"CASA column {columnDesc['name']} of type {valueType} is not supported.")
+
+    cellList = []
+    bucketCache = {}
+    with open(filepath, "rb") as f:
+        lastRowList, bucketNumberList = read_ssm_index(f, header, endian)
+        firstRow = 0
+        fi = open(filepath + "i", "rb") if os.path.exists(filepath + "i") else None
+        try:
+            for lastRow, bucketId in zip(lastRowList, bucketNumberList):
+                nrowBucket = max(0, lastRow + 1 - firstRow)
+                firstRow = lastRow + 1
+                f.seek(SSM_HEADER_SIZE + header["bucketSize"] * (bucketId + columnBucket) + columnOffset)
+                for row in range(0, nrowBucket):
+                    if valueType == "string":
+                        if columnDesc["isArray"] or columnDesc["maxlen"] != 0:
+                            raise NotImplementedError(f"CASA string column {columnDesc['name']} layout is not supported.")
+                        cellList.append(read_ssm_string(f, header, endian, bucketCache))
+                    elif not columnDesc["isArray"]:
+                        dtype = np.dtype(endian + NUMPY_DTYPES[valueType])
+                        cellList.append(np.frombuffer(f.read(dtype.itemsize), dtype=dtype)[0])
+                    elif columnDesc["isDirect"]:
+                        shape = columnDesc["columnShape"] or columnDesc["shape"]
+                        dtype = np.dtype(endian + NUMPY_DTYPES[valueType])
+                        size = int(np.prod(shape))
+                        cellList.append(np.frombuffer(f.read(size * dtype.itemsize), dtype=dtype).reshape(shape[::-1]))
+                    else:
+                        if fi is None:
+                            raise ValueError(f"Missing indirect array file: {filepath}i")
+                        offset = struct.unpack(endian + "q", f.read(8))[0]
+                        cellList.append(read_ssm_indirect_array(fi, offset, valueType, endian))
+        finally:
+            if fi is not None:
+                fi.close()
+    return cellList
+
+
+def read_casa_table_columns(tablePath, columnNameList):
+    '''
+    Reads the columns in columnNameList of the CASA table at tablePath.
+
+    Returns
+    -------
+    columnDict: dict
+       One list of cells (scalars, strings or numpy arrays) per column name.
+
+    Raises
+    ------
+    NotImplementedError
+       If the table uses a layout this reader does not support.
+
+    '''
+    tableDict = read_table_dat(tablePath)
+    columnDescDict = {columnDesc["name"]: columnDesc for columnDesc in tableDict["columnDescList"]}
+    columnDict = {}
+    for columnName in columnNameList:
+        if columnName not in columnDescDict:
+            raise ValueError(f"Column {columnName} not found in CASA table: {tablePath}")
+        columnDict[columnName] = read_ssm_column(tablePath, tableDict, columnDescDict[columnName])[:tableDict["nrow"]]
+    return columnDict
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+'''
+Channel identity of the cube: filenames of the per channel data products and
+the channel index file, which maps every planned output channel number to its
+frequency and to the paths of its split visibilities and tclean images.
+'''
+
+import csv
+import itertools
+import os
+from glob import glob
+
+from frocc.lhelpers import get_basename_from_path, get_firstFreq, get_channelDigits, encode_channelNumber, format_legend, get_lowest_channelIdx_and_freq_with_data_in_cube
+from frocc.logger import *
+
+
+CHANNEL_INDEX_LEGEND = ["chanNo", "chanId", "frequency [Hz]", "startFreq [Hz]", "stopFreq [Hz]", "visList", "image", "imageSmoothed"]
+# rmsNoise is the RMS of the flagging Stokes parameter, Stokes V by default
+CUBE_INDEX_LEGEND = ["chanNo", "frequency [Hz]", "valid", "rmsStokesI [Jy/beam]", "rmsNoise [Jy/beam]", "maxStokesI [Jy/beam]"]
+
+
+def get_channel_freqRange(conf, chanNo):
+    '''
+    Start and stop frequency in [Hz] of output channel `chanNo` (first channel
+    is 1), as used for the CASA split.
+    '''
+    firstFreq = get_firstFreq(conf)
+    startFreq = int(firstFreq) + int(conf.input.outputChanBandwidth) * (int(chanNo) - 1)
+    stopFreq = int(firstFreq) + int(conf.input.outputChanBandwidth) * int(chanNo)
+    return startFreq, stopFreq
+
+
+def get_channel_visPath(conf, chanNo, msIdx):
+    '''
+    Path of the split visibilities of channel `chanNo` from input MS `msIdx`.
+    '''
+    return (
+        conf.env.dirVis
+        + get_basename_from_path(conf.input.inputMS[msIdx])
+        + conf.env.markerChannel
+        + encode_channelNumber(chanNo, get_channelDigits(conf))
+        + ".ms"
+    )
+
+
+def get_channel_imagename(conf, chanNo):
+    '''
+    CASA tclean imagename (without extension) of channel `chanNo`.
+    '''
+    return os.path.join(conf.env.dirImages, conf.input.basename + conf.env.markerChannel + encode_channelNumber(chanNo, get_channelDigits(conf)))
+
+
+def get_channel_imagePath(conf, chanNo, mode="normal"):
+    '''
+    Path of the exported tclean fits image of channel `chanNo`.
+    '''
+    if mode == "smoothed":
+        return get_channel_imagename(conf, chanNo) + conf.env.extTcleanImageSmoothed
+    return get_channel_imagename(conf, chanNo) + conf.env.extTcleanImage
+
+
+def get_predicted_chanNoList(conf):
+    '''
+    Sorted list of all output channels that are predicted to hold data in at
+    least one input MS.
+    '''
+    return sorted(set(itertools.chain(*conf.data.predictedOutputChannels)))
+
+
+def write_channel_index(conf):
+    '''
+    Writes the channel index file for all predicted output channels.
+    '''
+    filepathIndex = conf.input.basename + conf.env.extChannelIndex
+    digits = get_channelDigits(conf)
+    info(f"Writing channel index file with {digits} digit channel numbers: {filepathIndex}")
+    with open(filepathIndex, "w") as csvFile:
+        writer = csv.writer(csvFile, delimiter="\t")
+        csvData = [CHANNEL_INDEX_LEGEND]
+        for chanNo in get_predicted_chanNoList(conf):
+            startFreq, stopFreq = get_channel_freqRange(conf, chanNo)
+            visList = [
+                get_channel_visPath(conf, chanNo, msIdx)
+                for msIdx, chanList in enumerate(conf.data.predictedOutputChannels)
+                if chanNo in chanList
+            ]
+            csvData.append([
+                chanNo,
+                encode_channelNumber(chanNo, digits),
+                (startFreq + stopFreq) / 2.,
+                startFreq,
+                stopFreq,
+                ",".join(visList),
+                get_channel_imagePath(conf, chanNo),
+                get_channel_imagePath(conf, chanNo, mode="smoothed") if conf.input.smoothbeam else "",
+            ])
+        writer.writerows(csvData)
+
+
+def read_channel_index(conf):
+    '''
+    Reads the channel index file into a dict with chanNo as key and a dict of
+    the remaining columns as value.
+    '''
+    filepathIndex = conf.input.basename + conf.env.extChannelIndex
+    indexDict = {}
+    with open(filepathIndex) as csvFile:
+        reader = csv.reader(csvFile, delimiter="\t")
+        next(reader)
+        for row in reader:
+            chanNo, chanId, freq, startFreq, stopFreq, visList, image, imageSmoothed = row
+            indexDict[int(chanNo)] = {
+                "chanId": chanId,
+                "frequency": float(freq),
+                "startFreq": float(startFreq),
+                "stopFreq": float(stopFreq),
+                "visList": list(filter(None, visList.split(","))),
+                "image": image,
+                "imageSmoothed": imageSmoothed,
+            }
+    return indexDict
+
+
+def get_cube_filepath(conf, mode="normal"):
+    '''
+    Path of the normal or smoothed fits cube.
+    '''
+    if mode == "smoothed":
+        return os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeSmoothedFits)
+    return os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeFits)
+
+
+def get_slabStatistics_filepath(conf, slabIdx, mode="normal"):
+    '''
+    Path of the partial statistics of one channel slab.
+    '''
+    if mode == "smoothed":
+        filepathStatistics = conf.input.basename + conf.env.extCubeSmoothedStatistics
+    else:
+        filepathStatistics = conf.input.basename + conf.env.extCubeStatistics
+    return filepathStatistics.replace(".tab", f".slab-{slabIdx}.json")
+
+
+def remove_stale_slab_files(conf):
+    '''
+    Removes the locks and partial slab statistics that a failed distributed
+    cube assembly left behind, before the pipeline is started again.
+    Otherwise the cube allocation gets skipped and the first slab to finish
+    merges stale statistics.
+    '''
+    for mode in ["normal", "smoothed"]:
+        filepathCube = get_cube_filepath(conf, mode=mode)
+        for filepath in glob(get_slabStatistics_filepath(conf, "*", mode=mode)) + [filepathCube + ".lock", filepathCube + ".reduce.lock"]:
+            if os.path.exists(filepath):
+                info(f"Removing stale file of the distributed cube assembly: {filepath}")
+                os.remove(filepath)
+
+
+def get_cube_validityIndex_filepath(conf, mode="normal"):
+    '''
+    Path of the channel validity index of the normal or smoothed cube.
+    '''
+    if mode == "smoothed":
+        return conf.input.basename + conf.env.extCubeSmoothedValidityIndex
+    return conf.input.basename + conf.env.extCubeValidityIndex
+
+
+def write_cube_validity_index(conf, indexDict, mode="normal"):
+    '''
+    Writes the channel validity and summary index of a cube. Downstream stages
+    use it to skip channels which hold no data and to get per channel
+    summaries without reading the cube.
+
+    Parameters
+    ----------
+    indexDict: dict of lists
+       Lists for all keys of CUBE_INDEX_LEGEND (without units), one entry per
+       cube channel.
+
+    '''
+    filepathIndex = get_cube_validityIndex_filepath(conf, mode=mode)
+    info(f"Writing cube validity index: {filepathIndex}")
+    keyList = [format_legend(legend) for legend in CUBE_INDEX_LEGEND]
+    with open(filepathIndex, "w") as csvFile:
+        writer = csv.writer(csvFile, delimiter="\t")
+        csvData = [CUBE_INDEX_LEGEND]
+        for ii in range(0, len(indexDict["chanNo"])):
+            row = [indexDict[key][ii] for key in keyList]
+            row[keyList.index("valid")] = bool(row[keyList.index("valid")])
+            csvData.append(row)
+        writer.writerows(csvData)
+
+
+def read_cube_validity_index(conf, mode="normal"):
+    '''
+    Reads the channel validity index of a cube into a dict of lists. Returns
+    an empty dict if the index does not exist, e.g. for cubes created by an
+    older pipeline version.
+    '''
+    filepathIndex = get_cube_validityIndex_filepath(conf, mode=mode)
+    if not os.path.exists(filepathIndex):
+        warning(f"Cube validity index not found, falling back to reading the cube: {filepathIndex}")
+        return {}
+    keyList = [format_legend(legend) for legend in CUBE_INDEX_LEGEND]
+    indexDict = {key: [] for key in keyList}
+    with open(filepathIndex) as csvFile:
+        reader = csv.reader(csvFile, delimiter="\t")
+        next(reader)
+        for row in reader:
+            for key, value in zip(keyList, row):
+                if key == "chanNo":
+                    indexDict[key].append(int(value))
+                elif key == "valid":
+                    indexDict[key].append(value == "True")
+                else:
+                    indexDict[key].append(float(value))
+    return indexDict
+
+
+def update_cube_validity_index(conf, flaggedChanNoList, mode="normal"):
+    '''
+    Marks the channels in flaggedChanNoList as not valid, e.g. after the
+    iterative outlier rejection flagged them in the cube.
+    '''
+    indexDict = read_cube_validity_index(conf, mode=mode)
+    if not indexDict:
+        return
+    flaggedChanNoSet = set([int(chanNo) for chanNo in flaggedChanNoList])
+    for ii, chanNo in enumerate(indexDict["chanNo"]):
+        if chanNo in flaggedChanNoSet:
+            indexDict["valid"][ii] = False
+    write_cube_validity_index(conf, indexDict, mode=mode)
+
+
+def get_valid_chanIdxList(conf, mode="normal"):
+    '''
+    Sorted list of the cube indexes (chanNo - 1) of all valid channels, or
+    None if the cube has no validity index.
+    '''
+    indexDict = read_cube_validity_index(conf, mode=mode)
+    if not indexDict:
+        return None
+    return [chanNo - 1 for chanNo, valid in zip(indexDict["chanNo"], indexDict["valid"]) if valid]
+
+
+def get_hole_chanNoList(conf, mode="normal"):
+    '''
+    Channels of the sparse fits cube that are not valid and may be
+    unallocated holes, which read as 0 instead of NaN. Empty for a dense
+    cube, the cube store or without validity index.
+    '''
+    if not conf.input.sparseCube or conf.input.cubeStore:
+        return []
+    indexDict = read_cube_validity_index(conf, mode=mode)
+    if not indexDict:
+        return []
+    return [chanNo for chanNo, valid in zip(indexDict["chanNo"], indexDict["valid"]) if not valid]
+
+
+def get_lowest_channelIdx_and_freq_with_data(conf, mode="normal", freqPower=1e-9):
+    '''
+    Index and frequency (in units of 1/freqPower Hz) of the first valid cube
+    channel. Reads the cube validity index and only falls back to scanning
+    the cube if the index does not exist.
+    '''
+    indexDict = read_cube_validity_index(conf, mode=mode)
+    if not indexDict:
+        return get_lowest_channelIdx_and_freq_with_data_in_cube(get_cube_filepath(conf, mode=mode), freqPower=freqPower)
+    for chanNo, freq, valid in zip(indexDict["chanNo"], indexDict["frequency"], indexDict["valid"]):
+        if valid:
+            return {'chanIdx': chanNo - 1, 'freq': freq * freqPower}
+    return {'chanIdx': 0, 'freq': indexDict["frequency"][0] * freqPower}
+
+
+def get_valid_channel_count(conf, mode="normal"):
+    '''
+    Number of valid channels in the cube, or None without validity index.
+    '''
+    validChanIdxList = get_valid_chanIdxList(conf, mode=mode)
+    if validChanIdxList is None:
+        return None
+    return len(validChanIdxList)
+
+
+def get_channel_frequency(conf, chanNo, mode="normal"):
+    '''
+    Frequency in [Hz] of cube channel `chanNo`, falls back to the planned
+    channel frequency without validity index.
+    '''
+    indexDict = read_cube_validity_index(conf, mode=mode)
+    if indexDict and int(chanNo) in indexDict["chanNo"]:
+        return indexDict["frequency"][indexDict["chanNo"].index(int(chanNo))]
+    return sum(get_channel_freqRange(conf, chanNo)) / 2.
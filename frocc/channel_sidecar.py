@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+'''
+Statistics sidecars of the exported tclean channel images.
+
+Every cube_tclean task computes the statistics of its channel images right
+after the export, while they are still in the page cache, and writes them to
+a small json file next to the image. The tasks run in parallel, so buildcube
+only merges the sidecars instead of computing the statistics of all channels
+one after the other. A sidecar holds per Stokes parameter the RMS via MAD,
+the maximum and the NaN fraction, the frequency, the restoring beam and the
+checksum of the image data, as written into the cube.
+
+A sidecar is only used if size and modification time of the image still
+match, otherwise buildcube falls back to computing the statistics.
+'''
+
+import json
+import os
+
+import numpy as np
+
+from frocc.lhelpers import get_std_via_mad, get_stokesList
+from frocc.channel_index import get_channel_imagePath
+from frocc.image_catalogue import get_image_entry, read_image_plane
+from frocc.cube_verify import get_channel_checksum
+from frocc.logger import *
+
+
+def get_channelSidecar_filepath(filepathImage, conf):
+    '''
+    Path of the statistics sidecar of a channel image.
+    '''
+    return filepathImage + conf.env.extChannelSidecar
+
+
+def get_channel_statistics(entry, stokesList):
+    '''
+    Statistics of a channel image, as stored in the sidecar.
+
+    Parameters
+    ----------
+    entry: dict
+       Image catalogue entry of the channel image
+    stokesList: list of str
+       Label of every Stokes plane of the image
+
+    '''
+    channel = np.empty((len(stokesList), entry["NAXIS2"], entry["NAXIS1"]), dtype=np.float32)
+    for stokesIdx in range(0, len(stokesList)):
+        channel[stokesIdx] = read_image_plane(entry, stokesIdx, out=channel[stokesIdx])
+    imageStat = os.stat(entry["path"])
+    return {
+        "chanNo": entry["chanNo"],
+        "frequency": entry["frequency"],
+        "BMAJ": entry["BMAJ"],
+        "BMIN": entry["BMIN"],
+        "BPA": entry["BPA"],
+        "rms": {stokes: float(get_std_via_mad(plane)) for stokes, plane in zip(stokesList, channel)},
+        "max": {stokes: float(np.max(plane)) for stokes, plane in zip(stokesList, channel)},
+        "nanFraction": {stokes: float(np.count_nonzero(np.isnan(plane)) / plane.size) for stokes, plane in zip(stokesList, channel)},
+        "checksum": get_channel_checksum(channel),
+        "imageSize": imageStat.st_size,
+        "imageMtime": imageStat.st_mtime_ns,
+    }
+
+
+def write_channel_sidecar(conf, chanNo, mode="normal"):
+    '''
+    Writes the statistics sidecar of the exported channel image, called by
+    cube_tclean right after the export.
+    '''
+    filepathImage = get_channel_imagePath(conf, chanNo, mode=mode)
+    stokesList = get_stokesList(conf)
+    try:
+        entry = get_image_entry(filepathImage, conf.env.markerChannel)
+    except (OSError, ValueError, KeyError) as e:
+        warning(f"Not writing statistics sidecar, channel image unreadable: {filepathImage}: {e}")
+        return
+    if entry["NAXIS4"] != len(stokesList):
+        warning(f"Not writing statistics sidecar, channel image has {entry['NAXIS4']} Stokes planes instead of {len(stokesList)}: {filepathImage}")
+        return
+    filepathSidecar = get_channelSidecar_filepath(filepathImage, conf)
+    info(f"Writing statistics sidecar: {filepathSidecar}")
+    sidecar = get_channel_statistics(entry, stokesList)
+    # buildcube never sees a partly written sidecar
+    with open(filepathSidecar + ".tmp", "w") as f:
+        json.dump(sidecar, f)
+    os.replace(filepathSidecar + ".tmp", filepathSidecar)
+
+
+def read_channel_sidecar(conf, entry, stokesList):
+    '''
+    Statistics sidecar of the channel image of a catalogue entry. None if
+    there is no sidecar, if it does not cover stokesList or if the image
+    changed after the sidecar was written.
+    '''
+    if not entry:
+        return None
+    filepathSidecar = get_channelSidecar_filepath(entry["path"], conf)
+    try:
+        with open(filepathSidecar) as f:
+            sidecar = json.load(f)
+        imageStat = os.stat(entry["path"])
+    except (OSError, ValueError):
+        return None
+    if (sidecar["imageSize"], sidecar["imageMtime"]) != (imageStat.st_size, imageStat.st_mtime_ns):
+        info(f"Ignoring statistics sidecar of changed channel image: {filepathSidecar}")
+        return None
+    if not all([stokes in sidecar["rms"] for stokes in stokesList]):
+        return None
+    return sidecar
+
+
+def get_sidecar_flagging(sidecar, stokes):
+    '''
+    RMS of a Stokes plane and whether the channel gets flagged, as
+    cube_buildcube.check_rms decides it from the plane: flagged with NaN
+    pixels and with an RMS below 1 uJy/beam, which is then NaN.
+
+    Returns
+    -------
+    [std, flagged]: list with float and bool
+
+    '''
+    std = sidecar["rms"][stokes]
+    if std < 1e-6:
+        return [np.nan, True]
+    return [std, bool(sidecar["nanFraction"][stokes] > 0 or not np.isfinite(std))]
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-from frocc.lhelpers import DotMap, get_dict_from_click_args
+from frocc.lhelpers import DotMap, get_dict_from_click_args, VALID_STOKES_LIST
 from frocc.config import SPECIAL_FLAGS, FILEPATH_CONFIG_TEMPLATE_ORIGINAL
 import sys
 import re
@@ -31,11 +31,25 @@ USAGE='''
  ------------------
  frocc --status
 
- 5. Canel slurm jobs
+ 5. Start with automatic retries
+ -------------------------------
+ frocc --supervise
+ Instead of `--start`: submits the stages one after another and resubmits
+ failed, timed out and straggling array tasks with more memory and time.
+ The supervisor runs as its own slurm job until the last stage finished,
+ its log is logs/frocc_supervisor-<jobID>.out. `--cancel` also cancels it.
+
+ 6. Verify the cubes
+ ------------------
+ frocc --verify
+ Re-checksums the cubes and their HDF5 copies and compares them with the
+ checksums recorded while the cubes were built.
+
+ 7. Canel slurm jobs
  -------------------
  frocc --cancel
 
- 6. Further help
+ 8. Further help
  ---------------
  frocc --readme
  frocc --help
@@ -62,13 +76,13 @@ README='''
  -----------------
  
  `frocc` takes input measurement set (ms) data and parameters to create
- channelized data cube in Stokes IQUV.  
+ channelized data cube in Stokes IQUV (or a subset with `--stokes`).  
  First CASA `split` is run to split out visibilities from the input ms into
  visibilities of the aimed resolution in frequency. Then `tclean` runs on each
  of these ms separately and creates `.fits`-files for each channel. Next, the
  channel files are put into a data cube. The cube is analysed with an iterative
  outlier rejection which detects strongly diverging channels by measuring the
- RMS in Stokes V by fitting a third order polynomial. Bad channels get flagged
+ RMS in Stokes V (`--flaggingStokes`) by fitting a third order polynomial. Bad channels get flagged
  and the cube `.fits`-file is converted into a `.hdf5`-file.  
  The aforementioned is realized through the following scripts:
  `cube_split.py, cube_tclean.py, cube_buildcube.py, cube_ior_flagging.py`
@@ -233,10 +247,30 @@ def check_if_crop_has_right_format(flagList):
         print(f' `frocc --help` to list all valid flags.')
         sys.exit()
 
+def check_if_choice_is_valid(flagList):
+    '''
+    --stokes must be a Stokes selection tclean can image, --flaggingStokes a
+    single Stokes parameter, --quantisedCube an integer type and
+    --compressedCube a fits tile compression type.
+    '''
+    for flag, validList in [("--stokes", VALID_STOKES_LIST), ("--flaggingStokes", list("IQUV")), ("--quantisedCube", ["int16", "int32"]), ("--compressedCube", ["RICE_1", "GZIP_1", "GZIP_2", "HCOMPRESS_1"])]:
+        if flag in flagList:
+            try:
+                value = flagList[flagList.index(flag) + 1]
+            except:
+                print(f' ERROR: {flag} needs a parameter, one of: {", ".join(validList)}')
+                sys.exit()
+            if value.strip() not in validList and value.strip().upper() not in validList:
+                print(f' ERROR: Did not recognise {flag} {value}. Use one of: {", ".join(validList)}')
+                print()
+                print(f' `frocc --help-verbose` to list all valid flags and how to use them.')
+                sys.exit()
+
 def check_flags(flagList, conf):
     check_if_flag_exists(flagList)
     check_if_inputMS_and_createScrits_come_together(flagList)
     check_if_crop_has_right_format(flagList)
+    check_if_choice_is_valid(flagList)
 
 def print_help_verbose():
     configDictList = get_config_dictList()
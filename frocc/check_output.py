@@ -5,6 +5,8 @@ import os
 import re
 
 from frocc.lhelpers import get_config_in_dot_notation, get_basename_from_path, get_statusList, SEPERATOR, SEPERATOR_HEAVY
+from frocc.channel_index import get_channel_visPath, get_channel_imagePath
+from frocc.cube_cleanup import is_channel_image_confirmed
 from frocc.config import FILEPATH_CONFIG_TEMPLATE, FILEPATH_CONFIG_USER
 from frocc.logger import *
 
@@ -30,16 +32,20 @@ def check_is_still_running(conf):
         return False
 
 def get_missingVisList(conf):
+    '''
+    Split visibilities of all predicted channels that do not exist. A channel
+    with confirmed tclean images was split successfully, its visibilities can
+    be gone because of conf.input.cleanupStaged.
+    '''
     missingVisList = []
+    confirmedDict = {}
     for ii, inputMS in enumerate(conf.input.inputMS):
         for channelNumber in conf.data.predictedOutputChannels[ii]:
-            outputMS = (
-                conf.env.dirVis
-                + get_basename_from_path(inputMS)
-                + conf.env.markerChannel
-                + str(channelNumber).zfill(3)
-                + ".ms"
-            )
+            if channelNumber not in confirmedDict:
+                confirmedDict[channelNumber] = is_channel_image_confirmed(conf, int(channelNumber))
+            if confirmedDict[channelNumber]:
+                continue
+            outputMS = get_channel_visPath(conf, channelNumber, ii)
             if not os.path.exists(outputMS):
                 missingVisList.append(outputMS)
     return missingVisList
@@ -59,16 +65,7 @@ def get_missingImageList(conf, mode=None):
     flatChannelList = [item for sublist in conf.data.predictedOutputChannels for item in sublist]
     channelSet = set(flatChannelList)
     for channelNumber in channelSet:
-        outputMS = (
-            conf.env.dirImages
-            + conf.input.basename
-            + conf.env.markerChannel
-            + str(channelNumber).zfill(3)
-        )
-        if mode == "smoothed":
-            outputMS += conf.env.extTcleanImageSmoothed
-        else:
-            outputMS += conf.env.extTcleanImage
+        outputMS = get_channel_imagePath(conf, channelNumber, mode=mode)
         if not os.path.exists(outputMS):
             missingImageList.append(outputMS)
     return missingImageList
@@ -22,6 +22,8 @@ SPECIAL_FLAGS = [
         "--help-verbose",
         "-h",
         "--start",
+        "--supervise",
+        "--verify",
         "--usage",
         "--createConfig",
         "--createScripts",
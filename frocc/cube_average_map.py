@@ -34,7 +34,10 @@ import click
 import numpy as np
 from astropy.io import fits
 
-from frocc.lhelpers import get_channelNumber_from_filename, get_config_in_dot_notation, get_std_via_mad, main_timer, change_channelNumber_from_filename,  SEPERATOR, get_lowest_channelNo_with_data_in_cube, update_fits_header_of_cube, DotMap, get_dict_from_click_args, calculate_channelFreq_from_header
+from frocc.lhelpers import get_channelNumber_from_filename, get_config_in_dot_notation, get_std_via_mad, main_timer, change_channelNumber_from_filename,  SEPERATOR, get_lowest_channelNo_with_data_in_cube, update_fits_header_of_cube, DotMap, get_dict_from_click_args, calculate_channelFreq_from_header, allocate_fits_file, get_stokesIdx, get_stokesIdxList, get_flaggingStokes
+from frocc.channel_index import get_valid_chanIdxList
+from frocc.plane_io import get_plane_buffers, read_plane_native
+from frocc.cube_compress import open_cube
 from frocc.config import FILEPATH_CONFIG_TEMPLATE, FILEPATH_CONFIG_USER
 from frocc.logger import *
 
@@ -52,6 +55,21 @@ from frocc.logger import *
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
 
+def get_averageMap_labelList(conf):
+    """
+    Labels of the average maps in the order of the W-axis: Stokes I, scalar P
+    from Stokes Q and U, and Stokes V, as far as these are imaged.
+    """
+    labelList = []
+    if get_stokesIdx(conf, "I") is not None:
+        labelList.append("Stokes I")
+    if get_stokesIdxList(conf, "QU") is not None:
+        labelList.append("scalar P")
+    if get_stokesIdx(conf, "V") is not None:
+        labelList.append("Stokes V")
+    return labelList
+
+
 def make_empty_image(conf, mode="normal"):
     """
     Generate an empty dummy fits data cube.
@@ -59,13 +77,12 @@ def make_empty_image(conf, mode="normal"):
     The data cube dimensions are derived from the cube images.
 
     """
-    cubeNameInput = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeSmoothedFits)
     cubeNameOutput = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeAveragemapFits)
         
     info(SEPERATOR)
-    info(f"Getting image dimension for data cube from: {cubeNameInput}")
-    hduCubeInput = fits.open(cubeNameInput, memmap=True, mode="update")
-    xdim, ydim = np.squeeze(hduCubeInput[0].data).shape[-2:]
+    info("Getting image dimension for data cube from the smoothed cube.")
+    hduCubeInput, dataCubeInput, headerInput = open_cube(conf, mode="smoothed")
+    xdim, ydim = headerInput["NAXIS2"], headerInput["NAXIS1"]
 
     info("X-dimension: %s", xdim)
     info("Y-dimension: %s", ydim)
@@ -73,8 +90,8 @@ def make_empty_image(conf, mode="normal"):
     zdim = 1
     info(f"Z-dimension: {zdim}")
 
-    info("Assuming full Stokes for dimension W.")
-    wdim = 3
+    info(f"Getting dimension W from the average maps for Stokes {conf.input.stokes}.")
+    wdim = len(get_averageMap_labelList(conf))
     info("W-dimension: %s", wdim)
 
     dims = tuple([xdim, ydim, zdim, wdim])
@@ -87,29 +104,8 @@ def make_empty_image(conf, mode="normal"):
     dummy_data = np.zeros(dummy_dims, dtype=np.float32)
     hdu = fits.PrimaryHDU(data=dummy_data)
 
-    header = hduCubeInput[0].header
-    for i, dim in enumerate(dims, 1):
-        header["NAXIS%d" % i] = dim
-
-
-    header.tofile(cubeNameOutput, overwrite=True)
-
-    # create full-sized zero image
-
-    header_size = len(
-        header.tostring()
-    )  # Probably 2880. We don't pad the header any more; it's just the bare minimum
-    data_size = np.product(dims) * np.dtype(np.float32).itemsize
-    # This is not documented in the example, but appears to be Astropy's default behaviour
-    # Pad the total file size to a multiple of the header block size
-    block_size = 2880
-    data_size = block_size * (((data_size -1) // block_size) + 1)
-
-    with open(cubeNameOutput, "rb+") as f:
-        f.seek(header_size + data_size - 1)
-        f.write(b"\0")
-
-
+    allocate_fits_file(cubeNameOutput, headerInput, dims)
+    hduCubeInput.close()
 
 
 def write_statistics_file(statsDict, conf, mode="normal"):
@@ -143,13 +139,12 @@ def fill_cube_with_images(conf, mode="normal"):
 
     """
 
-    cubeNameInput = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeSmoothedFits)
     cubeNameOutput = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeAveragemapFits)
 
     info(SEPERATOR)
-    info(f"Opening data cube: {cubeNameInput}")
-    hudCubeInput = fits.open(cubeNameInput, memmap=True, ignore_missing_end=True, mode="update")
-    dataCubeInput = hudCubeInput[0].data
+    info("Opening smoothed data cube.")
+    # fits cube or tile-compressed cube
+    hudCubeInput, dataCubeInput, headerInput = open_cube(conf, mode="smoothed")
 
     info(f"Opening data cube: {cubeNameOutput}")
     hudCubeOutput = fits.open(cubeNameOutput, memmap=True, ignore_missing_end=True, mode="update")
@@ -161,39 +156,58 @@ def fill_cube_with_images(conf, mode="normal"):
     statsDict["chanNo"] = []
     statsDict["weight"] = []
     statsDict["frequency"] = []
+    validChanIdxList = get_valid_chanIdxList(conf, mode="smoothed")
+    planeShape = dataCubeInput.shape[2:]
+    flaggingStokes = get_flaggingStokes(conf)
+    flaggingIdx = get_stokesIdx(conf, flaggingStokes)
+    stokesIdxI = get_stokesIdx(conf, "I")
+    stokesIdxV = get_stokesIdx(conf, "V")
+    stokesIdxListQU = get_stokesIdxList(conf, "QU")
+    # the flagging Stokes plane is converted once into a native buffer for the
+    # NaN check and the MAD
+    N, = get_plane_buffers(planeShape, count=1)
     for ii in range(0, highestChannel):
-        if np.isnan(np.sum(dataCubeInput[3, ii, :, :])):
+        if validChanIdxList is not None and ii not in validChanIdxList:
+            w = np.nan
+        elif np.isnan(np.sum(read_plane_native(dataCubeInput[flaggingIdx, ii, :, :], N))):
             w = np.nan
         else:
-            info(f"Getting RMS from Stokes V for channel {ii}")
-            rms = get_std_via_mad(dataCubeInput[3, ii, :, :])
+            info(f"Getting RMS from Stokes {flaggingStokes} for channel {ii}")
+            rms = get_std_via_mad(N)
             w = 1/(rms**2)
-        calcFreq = calculate_channelFreq_from_header(hudCubeInput[0].header, ii)
+        calcFreq = calculate_channelFreq_from_header(headerInput, ii)
         statsDict["frequency"].append(calcFreq)
         statsDict["weight"].append(w)
         statsDict["chanNo"].append(ii)
 
-    P_I = dataCubeOutput[0, 0, :, :]
-    P_QU = dataCubeOutput[1, 0, :, :]
-    P_V = dataCubeOutput[2, 0, :, :]
+    # native accumulators, written to the big-endian output cube only once
+    accumulatorList = get_plane_buffers(planeShape, count=len(get_averageMap_labelList(conf)))
+    for accumulator in accumulatorList:
+        accumulator.fill(0)
+    A, B, tmp = get_plane_buffers(planeShape, count=3)
     weightedFreqs = 0
     for ii, w in enumerate(statsDict["weight"]):
         info(f"Processing average maps: Progress {ii+1}/{len(statsDict['weight'])}")
         if not np.isnan(w):
-            I = dataCubeInput[0, ii, :, :]
-            Q = dataCubeInput[1, ii, :, :]
-            #info(f"Q: Progress {Q}")
-            U = dataCubeInput[2, ii, :, :]
-            V = dataCubeInput[3, ii, :, :]
-            P_I += w * I
-            P_QU += w * np.sqrt(Q**2 + U**2)
-            #info(f"P_QU: Progress {P_QU}")
-            P_V += w * V
+            accumulatorIter = iter(accumulatorList)
+            # I and V are weighted directly, Q and U as scalar P
+            if stokesIdxI is not None:
+                np.multiply(read_plane_native(dataCubeInput[stokesIdxI, ii, :, :], A), w, out=tmp)
+                next(accumulatorIter)[...] += tmp
+            if stokesIdxListQU is not None:
+                read_plane_native(dataCubeInput[stokesIdxListQU[0], ii, :, :], A)
+                read_plane_native(dataCubeInput[stokesIdxListQU[1], ii, :, :], B)
+                np.hypot(A, B, out=tmp)
+                tmp *= w
+                next(accumulatorIter)[...] += tmp
+            if stokesIdxV is not None:
+                np.multiply(read_plane_native(dataCubeInput[stokesIdxV, ii, :, :], A), w, out=tmp)
+                next(accumulatorIter)[...] += tmp
             weightedFreqs += w * np.sqrt(statsDict["frequency"][ii]**2)
     weightsSum = np.nansum(statsDict["weight"])
-    dataCubeOutput[0, 0, :, :] = P_I / weightsSum
-    dataCubeOutput[1, 0, :, :] = P_QU / weightsSum
-    dataCubeOutput[2, 0, :, :] = P_V / weightsSum
+    for outputIdx, accumulator in enumerate(accumulatorList):
+        accumulator /= weightsSum
+        dataCubeOutput[outputIdx, 0, :, :] = accumulator
     averagedFreq = np.nansum(weightedFreqs) / weightsSum
 
     hudCubeInput.close()
@@ -20,8 +20,9 @@
 """
 
 import itertools
+import json
 import logging
-from logging import info, error
+from logging import info, warning, error
 import os
 import csv
 import datetime
@@ -39,7 +40,15 @@ from matplotlib import pyplot as plt
 import numpy as np
 from astropy.io import fits
 
-from frocc.lhelpers import get_channelNumber_from_filename, get_config_in_dot_notation, get_std_via_mad, main_timer, change_channelNumber_from_filename,  SEPERATOR, get_lowest_channelNo_with_data_in_cube, update_fits_header_of_cube, DotMap, get_dict_from_click_args
+from frocc.lhelpers import get_channelNumber_from_filename, get_config_in_dot_notation, get_std_via_mad, main_timer, change_channelNumber_from_filename,  SEPERATOR, get_lowest_channelNo_with_data_in_cube, update_fits_header_of_cube, DotMap, get_dict_from_click_args, decode_channelNumber, allocate_fits_file, copy_file_region, run_once, get_stokesList, get_stokesIdx, get_flaggingStokes, get_rmsStokesList
+from frocc.channel_index import get_channel_imagePath, get_channel_freqRange, write_cube_validity_index, get_slabStatistics_filepath
+from frocc.image_catalogue import build_image_catalogue, read_image_catalogue, read_fits_header_block, read_image_plane
+from frocc.cube_verify import get_channel_checksum, write_checksum_index
+from frocc.cube_compress import write_compressed_cube
+from frocc.channel_sidecar import read_channel_sidecar, get_sidecar_flagging
+from frocc.cube_store import get_cubeStore_dirpath, read_store_metadata, read_store_plane, read_store_sampled_plane, is_store_channel_written, delete_store_channel, write_store_plane, read_store_header, write_store_header
+from frocc.preview_pyramid import open_pyramid, add_channel_to_pyramid, close_pyramid
+from frocc.plane_io import BIG_ENDIAN_DTYPE, get_plane_buffers, read_plane_native, write_plane_bigendian
 from frocc.config import FILEPATH_CONFIG_TEMPLATE, FILEPATH_CONFIG_USER
 
 
@@ -89,7 +98,7 @@ def get_correction_coefficients(conf, obsid):
 
 
 
-def get_and_add_custom_header(header, zdim, conf, mode="normal"):
+def get_and_add_custom_header(header, zdim, conf, mode="normal", catalogueDict=None):
     """
     Gets header from fits file and updates the cube header.
 
@@ -99,6 +108,9 @@ def get_and_add_custom_header(header, zdim, conf, mode="normal"):
     header: astroy.io.fits header
        The header class that gets updated
 
+    catalogueDict: dict
+       Channel image catalogue, read from the catalogue file if not given.
+
     Returns
     -------
     header: astroy.io.fits header
@@ -106,14 +118,12 @@ def get_and_add_custom_header(header, zdim, conf, mode="normal"):
 
     """
     info(SEPERATOR)
-    if mode == "smoothed":
-        lowestChannelFitsfile = sorted(glob(conf.env.dirImages + "*image.smoothed.fits"))[0]
-    else:
-        lowestChannelFitsfile = sorted(glob(conf.env.dirImages + "*image.fits"))[0]
+    if catalogueDict is None:
+        catalogueDict = read_image_catalogue(conf, mode=mode)
+    lowestChannelFitsfile = catalogueDict[min(catalogueDict)]["path"]
 
     info("Getting header for data cube from: %s", lowestChannelFitsfile)
-    with fits.open(lowestChannelFitsfile, memmap=True) as hud:
-        header = hud[0].header
+    header = read_fits_header_block(lowestChannelFitsfile)[0]
     #    # Optional: Update the header.
     #    header["OBJECT"] = str(conf.data.field)
     #    header["NAXIS3"] = int(zdim)
@@ -151,44 +161,40 @@ def make_empty_image(conf, mode="normal"):
     """
     Generate an empty dummy fits data cube.
 
-    The data cube dimensions are derived from the channel fits images. The
-    resulting data cube can exceed the machine's RAM.
+    The data cube dimensions are derived from the headers of the channel fits
+    images, collected in the channel image catalogue. The resulting data cube
+    can exceed the machine's RAM.
 
     """
-    if mode == "smoothed":
-        channelFitsfileList = sorted(glob(conf.env.dirImages + "*image.smoothed.fits"))
-    else:
-        channelFitsfileList = sorted(glob(conf.env.dirImages + "*image.fits"))
-        
-    lowestChannelFitsfile = channelFitsfileList[0]
-    highestChannelFitsfile = channelFitsfileList[-1]
+    catalogueDict = build_image_catalogue(conf, mode=mode)
+    lowestEntry = catalogueDict[min(catalogueDict)]
     info(SEPERATOR)
     if conf.input.crop:
         info("Getting image dimension for data cube from flag '--crop %s'", conf.input.crop)
         xdim, ydim = get_cropped_size_in_px(conf)
-        with fits.open(lowestChannelFitsfile, memmap=True) as hud:
-            xdim_check, ydim_check = np.squeeze(hud[0].data).shape[-2:]
+        xdim_check, ydim_check = lowestEntry["NAXIS1"], lowestEntry["NAXIS2"]
         if xdim_check < xdim or ydim_check < ydim:
             info(f"Input dimensions {xdim_check}px,{ydim_check}px are lower than target '--crop {conf.input.crop}'")
             info(f"Falling back to: {xdim_check}px,{ydim_check}px")
             xdim = xdim_check
-            ydim = xdim_check
+            ydim = ydim_check
     else:
-        info("Getting image dimension for data cube from: %s", lowestChannelFitsfile)
-        with fits.open(lowestChannelFitsfile, memmap=True) as hud:
-            xdim, ydim = np.squeeze(hud[0].data).shape[-2:]
+        info("Getting image dimension for data cube from: %s", lowestEntry["path"])
+        xdim, ydim = lowestEntry["NAXIS1"], lowestEntry["NAXIS2"]
     info("X-dimension: %s", xdim)
     info("Y-dimension: %s", ydim)
 
     info(
         "Getting channel dimension Z for data cube from number of entries in PATHLIST_STOKESI."
     )
-    # parse highest channel from fits file to get cube z dimension
-    zdim = int(get_channelNumber_from_filename(highestChannelFitsfile, conf.env.markerChannel))
+    # highest channel with an image gives the cube z dimension
+    zdim = max(catalogueDict)
     info(f"Z-dimension: {zdim}")
 
-    info("Assuming full Stokes for dimension W.")
-    wdim = 4
+    info(f"Getting dimension W from the imaged Stokes parameters: {conf.input.stokes}")
+    wdim = len(get_stokesList(conf))
+    if lowestEntry["NAXIS4"] != wdim:
+        warning(f"Channel image {lowestEntry['path']} has {lowestEntry['NAXIS4']} Stokes planes, expected {wdim} for Stokes {conf.input.stokes}.")
     info("W-dimension: %s", wdim)
 
     dims = tuple([xdim, ydim, zdim, wdim])
@@ -202,7 +208,7 @@ def make_empty_image(conf, mode="normal"):
     hdu = fits.PrimaryHDU(data=dummy_data)
 
     header = hdu.header
-    header = get_and_add_custom_header(header, zdim, conf, mode=mode)
+    header = get_and_add_custom_header(header, zdim, conf, mode=mode, catalogueDict=catalogueDict)
     for i, dim in enumerate(dims, 1):
         header["NAXIS%d" % i] = dim
         info(header["CRPIX1"])
@@ -212,28 +218,24 @@ def make_empty_image(conf, mode="normal"):
         info(header["CRPIX1"])
         info(header["CRPIX2"])
 
+    if conf.input.cubeStore:
+        # the cube_tclean tasks already wrote the data, only the header is kept
+        dirpathStore = get_cubeStore_dirpath(conf, mode=mode)
+        storeShape = read_store_metadata(dirpathStore)["shape"]
+        if list(reversed(storeShape)) != list(dims):
+            warning(f"Cube store has the shape {storeShape}, using it instead of the dimensions {dims} from the channel images.")
+        for i, dim in enumerate(reversed(storeShape), 1):
+            header["NAXIS%d" % i] = dim
+        info(f"Writing header of cube store: {dirpathStore}")
+        write_store_header(dirpathStore, header)
+        return
+
     if mode == "smoothed":
         cubeName = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeSmoothedFits)
     else:
         cubeName = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeFits)
 
-    header.tofile(cubeName, overwrite=True)
-
-    # create full-sized zero image
-
-    header_size = len(
-        header.tostring()
-    )  # Probably 2880. We don't pad the header any more; it's just the bare minimum
-    data_size = np.product(dims) * np.dtype(np.float32).itemsize
-    # This is not documented in the example, but appears to be Astropy's default behaviour
-    # Pad the total file size to a multiple of the header block size
-    block_size = 2880
-    data_size = block_size * (((data_size -1) // block_size) + 1)
-
-    with open(cubeName, "rb+") as f:
-        f.seek(header_size + data_size - 1)
-        f.write(b"\0")
-
+    allocate_fits_file(cubeName, header, dims)
 
 
 def check_rms(npArray):
@@ -263,34 +265,36 @@ def check_rms(npArray):
 
 def write_statistics_file(statsDict, conf, mode="normal"):
     """
-    Takes the dictionary with Stokes I and V RMS noise and writes it to a file.
+    Takes the dictionary with the Stokes I and flagging Stokes RMS noise and
+    writes it to a file.
 
     Parameters
     ----------
     rmdDict: dict of lists with floats
-       Dictionary with lists for Stokes I and V rms noise
+       Dictionary with lists for Stokes I and flagging Stokes rms noise
 
     """
-    # Outputs a statistics file with estimates for RMS noise in Stokes I and V
+    # Outputs a statistics file with estimates for RMS noise in Stokes I and
+    # the flagging Stokes (V by default)
     if mode == "smoothed":
         filepathStatistics = conf.input.basename + conf.env.extCubeSmoothedStatistics
     else:
         filepathStatistics = conf.input.basename + conf.env.extCubeStatistics
-    legendList = ["chanNo", "frequency [MHz]", "rmsStokesI [uJy/beam]", "rmsStokesV [uJy/beam]",  "maxStokesI [uJy/beam]", "flagged", "xyPhaseCorr", "polAngleCorr"]
+    rmsStokesList = get_rmsStokesList(conf)
+    legendList = ["chanNo", "frequency [MHz]"] + [f"rmsStokes{stokes} [uJy/beam]" for stokes in rmsStokesList] + ["maxStokesI [uJy/beam]", "flagged", "xyPhaseCorr", "polAngleCorr"]
     info("Writing statistics file: %s", filepathStatistics)
     with open(filepathStatistics, "w") as csvFile:
         writer = csv.writer(csvFile, delimiter="\t")
         csvData = [legendList]
-        for ii, entry in enumerate(statsDict["rmsI"]):
+        for ii, entry in enumerate(statsDict["chanNo"]):
             chanNo = statsDict["chanNo"][ii]
             freq = round(statsDict["freq"][ii] * 1e-6, 4)
-            rmsI = round(statsDict["rmsI"][ii] * 1e6, 4)
-            rmsV = round(statsDict["rmsV"][ii] * 1e6, 4)
+            rmsList = [round(statsDict["rms" + stokes][ii] * 1e6, 4) for stokes in rmsStokesList]
             maxI = round(statsDict["maxI"][ii] * 1e6, 4)
             xyPhaseCorr = round(statsDict["xyPhaseCorr"][ii], 4)
             polAngleCorr = round(statsDict["polAngleCorr"][ii], 4)
             flagged = statsDict["flagged"][ii]
-            csvData.append([chanNo, freq, rmsI, rmsV, maxI, flagged, xyPhaseCorr, polAngleCorr])
+            csvData.append([chanNo, freq] + rmsList + [maxI, flagged, xyPhaseCorr, polAngleCorr])
         writer.writerows(csvData)
 
 def plot_xyPhaseCorr_and_polAngleCorr(statsDict,  conf):
@@ -321,156 +325,455 @@ def plot_xyPhaseCorr_and_polAngleCorr(statsDict,  conf):
     #plt.show()
 
 
+def get_crop_window(conf, plane_width, plane_height):
+    """
+    Rows and columns (top, bottom, left, right) of the centred '--crop'
+    window in a plane of plane_width x plane_height pixels.
+    """
+    width, height = get_cropped_size_in_px(conf)
+    if plane_width < width or plane_height < height:
+        width = plane_width
+        height = plane_height
+    left = int(plane_width/2 - width/2)
+    top = int(plane_height/2 - height/2)
+    right = int(plane_width/2 + width/2)
+    bottom = int(plane_height/2 + height/2)
+    return (top, bottom, left, right)
+
+
 def get_cropped_numpy_plane(conf, plane):
     if conf.input.crop:
         plane_height, plane_width = plane.shape
-        print(plane_width, plane_height)
-        width, height = get_cropped_size_in_px(conf)
-        print(width, height)
-
-        if plane_width < width or plane_height < height:
-            #info(f"Input dimensions {plane_width}px,{plane_height}px are lower than target '--crop {conf.input.crop}'")
-            #info(f"Falling back to: {plane_width}px,{plane_height}px")
-            width = plane_width
-            height = plane_height
-
-        left = int(plane_width/2 - width/2)
-        top = int(plane_height/2 - height/2)
-        right = int(plane_width/2 + width/2)
-        bottom = int(plane_height/2 + height/2)
+        top, bottom, left, right = get_crop_window(conf, plane_width, plane_height)
         plane = plane[top:bottom, left:right]
-        print(plane.shape)
     return plane
 
 
-def fill_cube_with_images(conf, mode="normal"):
+def get_channel_plane_reader(conf, channelFitsfile, entry, bufferList):
     """
-    Fills the empty data cube with fits data.
+    Returns a function which reads the (cropped) plane of a Stokes index of
+    the channel image into the native buffer bufferList[stokesIdx], and the
+    opened fits file or None.
+
+    With '--crop' and a catalogue entry, only the crop window is read
+    from the file. Otherwise the image is opened with astropy and the plane
+    gets cropped after reading.
+    """
+    if conf.input.crop and entry:
+        window = get_crop_window(conf, entry["NAXIS1"], entry["NAXIS2"])
+        return lambda stokesIdx: read_image_plane(entry, stokesIdx, window=window, out=bufferList[stokesIdx]), None
+    hud = fits.open(channelFitsfile, memmap=True)
+    return lambda stokesIdx: read_plane_native(get_cropped_numpy_plane(conf, hud[0].data[stokesIdx, 0, :, :]), bufferList[stokesIdx]), hud
 
 
+def is_plane_copy_possible(conf, entry, cubeShape):
     """
-    if mode == "smoothed":
-        cubeName = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeSmoothedFits)
+    True if the Stokes planes of the channel image are byte-identical to
+    their slots in the cube: big-endian float32 of the same size, no crop
+    and no XY-phase and polarisation angle correction.
+    """
+    if not conf.env.buildcubeFastPath or not entry:
+        return False
+    if conf.input.crop or conf.input.fileXYphasePolAngleCoeffs:
+        return False
+    return (
+        entry["dtype"] == ">f4"
+        and entry["NAXIS1"] == cubeShape[3]
+        and entry["NAXIS2"] == cubeShape[2]
+        and entry["NAXIS4"] >= cubeShape[0]
+    )
+
+
+def get_cube_plane_offset(cubeDataOffset, cubeShape, stokesIdx, chanIdx):
+    """
+    Byte offset of the plane [stokesIdx, chanIdx, :, :] in the cube file.
+    """
+    return cubeDataOffset + (stokesIdx * cubeShape[1] + chanIdx) * cubeShape[2] * cubeShape[3] * 4
+
+
+def write_cube_plane(cubeFd, cubeDataOffset, cubeShape, stokesIdx, chanIdx, plane):
+    """
+    Writes one plane as big-endian float32 to its offset in the cube with
+    pwrite. Unlike writes through a memory map, pwrite only touches the bytes
+    of the plane, so several tasks on different nodes can write disjoint
+    channels of the same cube. A native float32 plane is swapped in place for
+    the write instead of being copied.
+    """
+    def pwrite_plane(bigendianPlane):
+        view = memoryview(bigendianPlane).cast("B")
+        offset = get_cube_plane_offset(cubeDataOffset, cubeShape, stokesIdx, chanIdx)
+        while view:
+            written = os.pwrite(cubeFd, view, offset)
+            view = view[written:]
+            offset += written
+
+    if plane.dtype == BIG_ENDIAN_DTYPE and plane.flags.c_contiguous:
+        pwrite_plane(plane)
     else:
-        cubeName = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeFits)
+        write_plane_bigendian(pwrite_plane, plane)
 
-    info(SEPERATOR)
-    info(f"Opening data cube: {cubeName}")
-    # TODO: debug: if ignore_missing_end is not true I get an error.
-    hudCube = fits.open(cubeName, memmap=True, ignore_missing_end=True, mode="update")
-    dataCube = hudCube[0].data
-    highestChannel = int(dataCube.shape[1] + 1)
 
+def copy_channel_planes(entry, cubeFd, cubeDataOffset, chanIdx, cubeShape):
+    """
+    Copies all Stokes planes of a channel image into the cube inside the
+    kernel, without decoding them.
+    """
+    planeSize = cubeShape[2] * cubeShape[3] * 4
+    srcFd = os.open(entry["path"], os.O_RDONLY)
+    try:
+        for stokesIdx in range(0, cubeShape[0]):
+            srcOffset = entry["dataOffset"] + stokesIdx * entry["NAXIS3"] * planeSize
+            copy_file_region(srcFd, cubeFd, planeSize, srcOffset, get_cube_plane_offset(cubeDataOffset, cubeShape, stokesIdx, chanIdx))
+    finally:
+        os.close(srcFd)
+
+
+def get_cube_name(conf, mode="normal"):
+    if mode == "smoothed":
+        return os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeSmoothedFits)
+    return os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeFits)
+
+
+def get_cube_header(conf, mode="normal"):
+    """
+    Header of the fits cube, or of the chunked cube store with
+    '--cubeStore'.
+    """
+    if conf.input.cubeStore:
+        return read_store_header(get_cubeStore_dirpath(conf, mode=mode))
+    return read_fits_header_block(get_cube_name(conf, mode=mode))[0]
+
+
+def apply_pol_correction(conf, planeDict, freq):
+    """
+    XY-phase and polarisation angle correction of the Stokes Q, U and V
+    planes in planeDict at the frequency freq [Hz].
+
+    Returns
+    -------
+    [xyPhaseAngle, polAngle]: list of floats
+       The applied angles in radians.
+
+    """
+    stokesQ, stokesU, stokesV = planeDict["Q"], planeDict["U"], planeDict["V"]
+    info("Starting XY phase and pol angle rotation.")
+    # grep obsid from MS filename. TODO: find something better
+    basename = os.path.basename(os.path.normpath(conf.input.inputMS[0]))
+    obsid = re.search(r"[0-9]{10}", basename)[0]
+    info(f"Uning observation ID (obsid): {obsid}")
+
+    coeffs = get_correction_coefficients(conf, obsid)
+    info(f"Using correction coefficients: {coeffs.to_dict()}")
+    info(f'Image frequency : {freq}')
+
+    # correctXYPhase, and convert from GHz to Hz
+    coeffsXY = [coeffs['coeffsXY_a'].to_numpy()[0], coeffs['coeffsXY_b'].to_numpy()[0], coeffs['coeffsXY_c'].to_numpy()[0]]
+    xyPhaseAngle = second_order_poly(freq*1e-9, coeffsXY)
+    #xyPhaseAngle = xyPhaseAngle * np.pi/180
+    info(f"Using xy-phase angle: {xyPhaseAngle}")
+    stokesUtmp = stokesU*np.cos(xyPhaseAngle) - stokesV*np.sin(xyPhaseAngle)
+    stokesVtmp = stokesU*np.sin(xyPhaseAngle) + stokesV*np.cos(xyPhaseAngle)
+
+    # correctPolAngle, and convert from GHz to Hz
+    coeffsPol = [coeffs['coeffsPol_a'].to_numpy()[0], coeffs['coeffsPol_b'].to_numpy()[0], coeffs['coeffsPol_c'].to_numpy()[0]]
+    polAngle = second_order_poly(freq*1e-9, coeffsPol)
+    #polAngle = polAngle * np.pi/180
+    info(f"Using polarization angle: {polAngle}")
+    stokesQtmp = stokesQ*np.cos(polAngle) - stokesUtmp*np.sin(polAngle)
+    stokesUtmp = stokesQ*np.sin(polAngle) + stokesUtmp*np.cos(polAngle)
+    planeDict["Q"] = stokesQtmp
+    planeDict["U"] = stokesUtmp
+    planeDict["V"] = stokesVtmp
+    return [xyPhaseAngle, polAngle]
+
+
+def get_empty_rmsDict(conf):
+    """
+    Channel statistics with an empty list per column.
+    """
     rmsDict = {}
     rmsDict["chanNo"] = []
     rmsDict["freq"] = []
-    rmsDict["rmsI"] = []
-    rmsDict["rmsV"] = []
+    for stokes in get_rmsStokesList(conf):
+        rmsDict["rms" + stokes] = []
     rmsDict["maxI"] = []
     rmsDict["flagged"] = []
     rmsDict["polAngleCorr"] = []
     rmsDict["xyPhaseCorr"] = []
-    if mode == "smoothed":
-        channelFitsfileList = sorted(glob(conf.env.dirImages + "*image.smoothed.fits"))
-    else:
-        channelFitsfileList = sorted(glob(conf.env.dirImages + "*image.fits"))
-    maxChanNo =  int(get_channelNumber_from_filename(channelFitsfileList[-1], conf.env.markerChannel))
-    for ii in range(0, maxChanNo):
+    return rmsDict
+
+
+def fill_cube_slab(conf, chanNoList, catalogueDict, mode="normal", pyramid=None):
+    """
+    Fills the channels in chanNoList of the allocated data cube with fits
+    data. The cube is not opened with astropy, every plane is written to its
+    byte offset with pwrite (or copied there inside the kernel).
+
+    Returns
+    -------
+    [rmsDict, checksumDict]: list of dicts
+       Statistics and checksums of the channels in chanNoList.
+
+    """
+    if conf.input.cubeStore:
+        return fill_cube_store(conf, chanNoList, catalogueDict, mode=mode, pyramid=pyramid)
+    cubeName = get_cube_name(conf, mode=mode)
+    info(SEPERATOR)
+    info(f"Opening data cube: {cubeName}")
+    cubeHeader, cubeDataOffset = read_fits_header_block(cubeName)
+    cubeShape = tuple([cubeHeader[f"NAXIS{axis}"] for axis in (4, 3, 2, 1)])
+    cubeFd = os.open(cubeName, os.O_RDWR)
+
+    stokesList = get_stokesList(conf)
+    flaggingStokes = get_flaggingStokes(conf)
+    flaggingIdx = stokesList.index(flaggingStokes)
+    stokesIdxI = get_stokesIdx(conf, "I")
+    # the XY-phase and polarisation angle correction needs Stokes Q, U and V
+    correctPol = bool(conf.input.fileXYphasePolAngleCoeffs) and all([stokes in stokesList for stokes in "QUV"])
+    if conf.input.fileXYphasePolAngleCoeffs and not correctPol:
+        warning(f"Not applying XY-phase and polarisation angle correction to Stokes {conf.input.stokes}, it needs Stokes Q, U and V.")
+
+    rmsDict = get_empty_rmsDict(conf)
+    checksumDict = {}
+    # a flagged channel in a sparse cube is a hole and reads as zeros
+    flaggedChecksum = get_channel_checksum(np.full((cubeShape[0],) + cubeShape[2:], 0. if conf.input.sparseCube else np.nan, dtype=np.float32))
+    sidecarCount = 0
+    # every Stokes plane is read once into a reused native buffer
+    bufferList = get_plane_buffers(cubeShape[2:], count=cubeShape[0])
+    for chanNo in chanNoList:
+        ii = chanNo - 1
         rmsDict['chanNo'].append(ii + 1)
         hudSwitch = False
-        channelFitsfile = change_channelNumber_from_filename(channelFitsfileList[0], conf.env.markerChannel, ii + 1)
+        if ii + 1 in catalogueDict:
+            channelFitsfile = catalogueDict[ii + 1]["path"]
+        else:
+            channelFitsfile = get_channel_imagePath(conf, ii + 1, mode=mode)
         info(f"Trying to open fits file: {channelFitsfile}")
         # Switch
-        stokesVflag = False
+        stokesFlag = False
+        copyPlanes = False
+        sidecar = None
 
         # Try to open file. If channel doesn't exists flag channel
         try:
-            hud = fits.open(channelFitsfile, memmap=True)
-            rmsDict['freq'].append(hud[0].header["CRVAL3"])
-            stokesV = get_cropped_numpy_plane(conf, hud[0].data[3, 0, :, :])
-            checkedArray, std = check_rms(stokesV)
-            rmsDict["rmsV"].append(std)
-            dataCube[3, ii, :, :] = checkedArray
-            if np.isnan(np.sum(checkedArray)) or std==0:
-                stokesVflag = True
-                rmsDict['freq'][-1] = np.nan
-            hudSwitch = True
-        except:
-            info(f"Flagging channel, can not open file: {channelFitsfile}")
-            stokesVflag = True
-            rmsDict["freq"].append(np.nan)
-            rmsDict["rmsV"].append(np.nan)
-
-        if not stokesVflag:
-            stokesI = get_cropped_numpy_plane(conf, hud[0].data[0, 0, :, :])
-            std = get_std_via_mad(stokesI)
-            rmsDict["rmsI"].append(std)
-            rmsDict["maxI"].append(np.max(stokesI))
+            entry = catalogueDict.get(ii + 1)
+            # statistics computed by the cube_tclean task, they do not apply
+            # to cropped planes
+            if not conf.input.crop:
+                sidecar = read_channel_sidecar(conf, entry, stokesList)
+            # the planes are only copied if nothing needs them in userspace:
+            # statistics and checksum come from the sidecar, and there is no
+            # preview pyramid
+            if sidecar is not None and not pyramid and is_plane_copy_possible(conf, entry, cubeShape):
+                copyPlanes = True
+            else:
+                read_plane, hud = get_channel_plane_reader(conf, channelFitsfile, entry, bufferList)
+                hudSwitch = hud is not None
+                flaggingPlane = read_plane(flaggingIdx)
+            freq = entry["frequency"] if entry else hud[0].header["CRVAL3"]
+            if sidecar is not None:
+                std, stokesFlag = get_sidecar_flagging(sidecar, flaggingStokes)
+            else:
+                checkedArray, std = check_rms(flaggingPlane)
+                stokesFlag = bool(np.isnan(np.sum(checkedArray)) or std==0)
+        # astropy raises a TypeError for the memory map of a truncated image
+        except (OSError, EOFError, ValueError, KeyError, IndexError, TypeError) as e:
+            info(f"Flagging channel, can not open file: {channelFitsfile}: {e}")
+            stokesFlag = True
+            copyPlanes = False
+            sidecar = None
+            std = np.nan
+        if sidecar is not None:
+            sidecarCount += 1
+        rmsDict["freq"].append(np.nan if stokesFlag else freq)
+        rmsDict["rms" + flaggingStokes].append(std)
+
+        if not stokesFlag and copyPlanes:
+            if stokesIdxI is not None and flaggingStokes != "I":
+                rmsDict["rmsI"].append(sidecar["rms"]["I"])
+            rmsDict["maxI"].append(sidecar["max"]["I"] if stokesIdxI is not None else np.nan)
             rmsDict["flagged"].append(False)
-            dataCube[0, ii, :, :] = stokesI
-
-            stokesQ = get_cropped_numpy_plane(conf, hud[0].data[1, 0, :, :])
-            stokesU = get_cropped_numpy_plane(conf, hud[0].data[2, 0, :, :])
-            stokesV = get_cropped_numpy_plane(conf, hud[0].data[3, 0, :, :])
-
-            if conf.input.fileXYphasePolAngleCoeffs:
-                info("Starting XY phase and pol angle rotation.")
-                # grep obsid from MS filename. TODO: find something better
-                basename = os.path.basename(os.path.normpath(conf.input.inputMS[0]))
-                obsid = re.search(r"[0-9]{10}", basename)[0]
-                info(f"Uning observation ID (obsid): {obsid}")
-
-                coeffs = get_correction_coefficients(conf, obsid)
-                info(f"Using correction coefficients: {coeffs.to_dict()}")
-                info(f'Image frequency : {rmsDict["freq"][-1]}')
-
-                # correctXYPhase, and convert from GHz to Hz
-                coeffsXY = [coeffs['coeffsXY_a'].to_numpy()[0], coeffs['coeffsXY_b'].to_numpy()[0], coeffs['coeffsXY_c'].to_numpy()[0]]
-                xyPhaseAngle = second_order_poly(rmsDict["freq"][-1]*1e-9, coeffsXY)
-                #xyPhaseAngle = xyPhaseAngle * np.pi/180
-                info(f"Using xy-phase angle: {xyPhaseAngle}")
-                stokesUtmp = stokesU*np.cos(xyPhaseAngle) - stokesV*np.sin(xyPhaseAngle)
-                stokesVtmp = stokesU*np.sin(xyPhaseAngle) + stokesV*np.cos(xyPhaseAngle)
-
-                # correctPolAngle, and convert from GHz to Hz
-                coeffsPol = [coeffs['coeffsPol_a'].to_numpy()[0], coeffs['coeffsPol_b'].to_numpy()[0], coeffs['coeffsPol_c'].to_numpy()[0]]
-                polAngle = second_order_poly(rmsDict["freq"][-1]*1e-9, coeffsPol)
-                #polAngle = polAngle * np.pi/180
-                info(f"Using polarization angle: {polAngle}")
-                stokesQtmp = stokesQ*np.cos(polAngle) - stokesUtmp*np.sin(polAngle)
-                stokesUtmp = stokesQ*np.sin(polAngle) + stokesUtmp*np.cos(polAngle)
-                stokesQ = stokesQtmp
-                stokesU = stokesUtmp
-                stokesV = stokesVtmp
+            rmsDict["xyPhaseCorr"].append(np.nan)
+            rmsDict["polAngleCorr"].append(np.nan)
+            copy_channel_planes(entry, cubeFd, cubeDataOffset, ii, cubeShape)
+
+        elif not stokesFlag:
+            planeDict = {flaggingStokes: flaggingPlane}
+            for stokesIdx, stokes in enumerate(stokesList):
+                if stokes != flaggingStokes:
+                    planeDict[stokes] = read_plane(stokesIdx)
+            if stokesIdxI is not None:
+                if flaggingStokes != "I":
+                    rmsDict["rmsI"].append(sidecar["rms"]["I"] if sidecar is not None else get_std_via_mad(planeDict["I"]))
+                rmsDict["maxI"].append(sidecar["max"]["I"] if sidecar is not None else np.max(planeDict["I"]))
+            else:
+                rmsDict["maxI"].append(np.nan)
+            rmsDict["flagged"].append(False)
+
+            if correctPol:
+                xyPhaseAngle, polAngle = apply_pol_correction(conf, planeDict, rmsDict["freq"][-1])
                 rmsDict["xyPhaseCorr"].append(xyPhaseAngle)
                 rmsDict["polAngleCorr"].append(polAngle)
-
-            elif not conf.input.fileXYphasePolAngleCoeffs:
+            else:
                 rmsDict["xyPhaseCorr"].append(np.nan)
                 rmsDict["polAngleCorr"].append(np.nan)
 
-            dataCube[1, ii, :, :] = stokesQ
-            dataCube[2, ii, :, :] = stokesU
-            dataCube[3, ii, :, :] = stokesV
+            for stokesIdx, stokes in enumerate(stokesList):
+                write_cube_plane(cubeFd, cubeDataOffset, cubeShape, stokesIdx, ii, planeDict[stokes])
+            if pyramid:
+                add_channel_to_pyramid(pyramid, ii, [planeDict[stokes] for stokes in stokesList])
 
         #if False:
-        elif stokesVflag:
-            dataCube[:, ii, :, :] = np.nan
-            rmsDict["rmsI"].append(np.nan)
+        elif stokesFlag:
+            # In a sparse cube the channel is not written at all, it stays a
+            # hole in the file and reads as zeros.
+            if not conf.input.sparseCube:
+                nanPlane = np.full(cubeShape[2:], np.nan, dtype=">f4")
+                for stokesIdx in range(0, cubeShape[0]):
+                    write_cube_plane(cubeFd, cubeDataOffset, cubeShape, stokesIdx, ii, nanPlane)
+            if pyramid:
+                add_channel_to_pyramid(pyramid, ii, None)
+            if flaggingStokes != "I" and stokesIdxI is not None:
+                rmsDict["rmsI"].append(np.nan)
             rmsDict["maxI"].append(np.nan)
             rmsDict["flagged"].append(True)
             rmsDict["xyPhaseCorr"].append(np.nan)
             rmsDict["polAngleCorr"].append(np.nan)
             info(
-                "Stokes V RMS noise of {0} is below below 1 [uJy/beam]. Flagging Stokes IQUV.".format(round(rmsDict["rmsV"][-1] * 1e6, 2))
+                "Stokes {0} RMS noise of {1} is below below 1 [uJy/beam]. Flagging Stokes {2}.".format(flaggingStokes, round(rmsDict["rms" + flaggingStokes][-1] * 1e6, 2), "".join(stokesList))
             )
 
+        if stokesFlag:
+            checksumDict[ii + 1] = flaggedChecksum
+        elif copyPlanes:
+            # the copied planes are byte-identical to the channel image
+            checksumDict[ii + 1] = sidecar["checksum"]
+        else:
+            # the planes as written into the cube
+            checksumDict[ii + 1] = get_channel_checksum(np.array([planeDict[stokes] for stokes in stokesList]))
         if hudSwitch:
             hud.close()
+    info(f"Statistics of {sidecarCount} of {len(chanNoList)} channels from the statistics sidecars.")
     info(SEPERATOR)
+    os.close(cubeFd)
+    return [rmsDict, checksumDict]
+
 
+def fill_cube_store(conf, chanNoList, catalogueDict, mode="normal", pyramid=None):
+    """
+    Statistics of the channels in chanNoList of the chunked cube store, which
+    the cube_tclean tasks already filled. Only the chunks of flagged channels
+    (deleted) and of polarisation corrected channels (rewritten from the
+    channel image, so a rerun does not correct twice) are written. The
+    statistics come from the statistics sidecars of the channel images, or,
+    without polarisation correction and preview pyramid, from every
+    fastPathSampleStep-th row of the chunks. The checksums come from the
+    sidecars, from the planes written or read anyway, or else from the chunks.
 
-    hudCube.close()
+    Returns
+    -------
+    [rmsDict, checksumDict]: list of dicts
+       Statistics and checksums of the channels in chanNoList.
+
+    """
+    dirpathStore = get_cubeStore_dirpath(conf, mode=mode)
+    info(SEPERATOR)
+    info(f"Opening cube store: {dirpathStore}")
+    cubeShape = tuple(read_store_metadata(dirpathStore)["shape"])
+
+    stokesList = get_stokesList(conf)
+    flaggingStokes = get_flaggingStokes(conf)
+    stokesIdxI = get_stokesIdx(conf, "I")
+    correctPol = bool(conf.input.fileXYphasePolAngleCoeffs) and all([stokes in stokesList for stokes in "QUV"])
+    if conf.input.fileXYphasePolAngleCoeffs and not correctPol:
+        warning(f"Not applying XY-phase and polarisation angle correction to Stokes {conf.input.stokes}, it needs Stokes Q, U and V.")
+    readFullPlanes = correctPol or bool(pyramid)
+    sampleStep = int(conf.env.fastPathSampleStep)
+    rmsDict = get_empty_rmsDict(conf)
+    checksumDict = {}
+    # a channel without chunks reads as NaN
+    nanChecksum = get_channel_checksum(np.full(cubeShape[:1] + cubeShape[2:], np.nan, dtype=np.float32))
+    sidecarCount = 0
+    bufferList = get_plane_buffers(cubeShape[2:], count=cubeShape[0])
+    for chanNo in chanNoList:
+        ii = chanNo - 1
+        entry = catalogueDict.get(chanNo)
+        rmsDict["chanNo"].append(chanNo)
+        rmsDict["freq"].append(entry["frequency"] if entry else np.nan)
+        stokesFlag = not entry or not is_store_channel_written(dirpathStore, ii, cubeShape[0])
+        std = np.nan
+        if stokesFlag:
+            info(f"Flagging channel, not written into the cube store: {chanNo}")
+        else:
+            sidecar = read_channel_sidecar(conf, entry, stokesList)
+            if readFullPlanes:
+                # the chunks hold the image planes, unless already corrected
+                planeDict = {stokes: read_image_plane(entry, stokesIdx, out=bufferList[stokesIdx]) for stokesIdx, stokes in enumerate(stokesList)}
+            elif sidecar is None:
+                planeDict = {stokes: read_store_sampled_plane(dirpathStore, cubeShape, stokesList.index(stokes), ii, sampleStep) for stokes in {flaggingStokes, "I"} if stokes in stokesList}
+            if sidecar is not None:
+                sidecarCount += 1
+                std, stokesFlag = get_sidecar_flagging(sidecar, flaggingStokes)
+            else:
+                checkedArray, std = check_rms(planeDict[flaggingStokes])
+                stokesFlag = bool(np.isnan(np.sum(checkedArray)) or std == 0)
+        rmsDict["rms" + flaggingStokes].append(std)
+
+        if stokesFlag:
+            rmsDict["freq"][-1] = np.nan
+            # without chunks the channel reads as NaN
+            delete_store_channel(dirpathStore, ii, cubeShape[0])
+            if pyramid:
+                add_channel_to_pyramid(pyramid, ii, None)
+            if flaggingStokes != "I" and stokesIdxI is not None:
+                rmsDict["rmsI"].append(np.nan)
+            rmsDict["maxI"].append(np.nan)
+            rmsDict["flagged"].append(True)
+            rmsDict["xyPhaseCorr"].append(np.nan)
+            rmsDict["polAngleCorr"].append(np.nan)
+            checksumDict[chanNo] = nanChecksum
+            info(f"Flagging Stokes {''.join(stokesList)} of channel {chanNo}, Stokes {flaggingStokes} RMS noise: {std}")
+            continue
+
+        if stokesIdxI is not None:
+            if flaggingStokes != "I":
+                rmsDict["rmsI"].append(sidecar["rms"]["I"] if sidecar is not None else get_std_via_mad(planeDict["I"]))
+            rmsDict["maxI"].append(sidecar["max"]["I"] if sidecar is not None else np.max(planeDict["I"]))
+        else:
+            rmsDict["maxI"].append(np.nan)
+        rmsDict["flagged"].append(False)
+        if correctPol:
+            xyPhaseAngle, polAngle = apply_pol_correction(conf, planeDict, rmsDict["freq"][-1])
+            for stokes in "QUV":
+                write_store_plane(dirpathStore, stokesList.index(stokes), ii, planeDict[stokes])
+            rmsDict["xyPhaseCorr"].append(xyPhaseAngle)
+            rmsDict["polAngleCorr"].append(polAngle)
+        else:
+            rmsDict["xyPhaseCorr"].append(np.nan)
+            rmsDict["polAngleCorr"].append(np.nan)
+        if pyramid:
+            add_channel_to_pyramid(pyramid, ii, [planeDict[stokes] for stokes in stokesList])
+        if readFullPlanes:
+            # the chunks hold exactly these planes
+            checksumDict[chanNo] = get_channel_checksum(np.array([planeDict[stokes] for stokes in stokesList]))
+        elif sidecar is not None:
+            # the chunks are byte-identical to the channel image
+            checksumDict[chanNo] = sidecar["checksum"]
+        else:
+            checksumDict[chanNo] = get_channel_checksum(np.array([read_store_plane(dirpathStore, stokesIdx, ii, bufferList[stokesIdx]) for stokesIdx in range(0, cubeShape[0])]))
+    info(f"Statistics of {sidecarCount} of {len(chanNoList)} channels from the statistics sidecars.")
+    info(SEPERATOR)
+    return [rmsDict, checksumDict]
+
+
+def finalize_cube(conf, rmsDict, checksumDict, mode="normal", pyramid=None):
+    """
+    Updates the cube header and writes the statistics file, the validity
+    index and the checksum index of the filled cube, and the tile-compressed
+    copy if conf.input.compressedCube is set.
+    """
+    cubeName = get_cube_name(conf, mode=mode)
+    highestChannel = int(get_cube_header(conf, mode=mode)["NAXIS3"])
     # TODO, check whether lowestChanNo is necessary
     # lowestChanNo = get_lowest_channelNo_with_data_in_cube(cubeName)
     addFitsHeaderDict = {
@@ -480,10 +783,122 @@ def fill_cube_with_images(conf, mode="normal"):
             "CTYPE3": ("FREQ", ""),
             "COMMENT": "Created by IDIA Pipeline"
             }
-    update_fits_header_of_cube(cubeName, addFitsHeaderDict)
+    if conf.input.cubeStore:
+        dirpathStore = get_cubeStore_dirpath(conf, mode=mode)
+        info(f"Updating header of cube store: {dirpathStore}, Update: {addFitsHeaderDict}")
+        header = read_store_header(dirpathStore)
+        header.update(addFitsHeaderDict)
+        write_store_header(dirpathStore, header)
+    else:
+        update_fits_header_of_cube(cubeName, addFitsHeaderDict)
+    if pyramid:
+        close_pyramid(pyramid, addFitsHeaderDict)
     write_statistics_file(rmsDict, conf, mode=mode)
+    indexFreqList = [
+        freq if not flagged else np.mean(get_channel_freqRange(conf, chanNo))
+        for chanNo, freq, flagged in zip(rmsDict["chanNo"], rmsDict["freq"], rmsDict["flagged"])
+    ]
+    indexDict = {
+            "chanNo": rmsDict["chanNo"],
+            "frequency": indexFreqList,
+            "valid": [not flagged for flagged in rmsDict["flagged"]],
+            "rmsStokesI": rmsDict.get("rmsI", [np.nan] * len(rmsDict["chanNo"])),
+            "rmsNoise": rmsDict["rms" + get_flaggingStokes(conf)],
+            "maxStokesI": rmsDict["maxI"],
+            }
+    write_cube_validity_index(conf, indexDict, mode=mode)
+    write_checksum_index(conf, checksumDict, mode=mode)
+    if conf.input.compressedCube and conf.input.cubeStore:
+        warning("Not writing the compressed cube, it is compressed from the fits cube and not from the cube store.")
+    elif conf.input.compressedCube:
+        # needs the channel noise from the validity index
+        write_compressed_cube(conf, mode=mode)
     if conf.input.fileXYphasePolAngleCoeffs:
         plot_xyPhaseCorr_and_polAngleCorr(rmsDict, conf)
+    if conf.input.sparseCube and not conf.input.cubeStore:
+        info(f"Sparse cube {cubeName}: apparent size {os.path.getsize(cubeName)} bytes, allocated {os.stat(cubeName).st_blocks * 512} bytes.")
+
+
+def fill_cube_with_images(conf, mode="normal"):
+    """
+    Fills the empty data cube with fits data.
+
+
+    """
+    catalogueDict = read_image_catalogue(conf, mode=mode)
+    pyramid = None
+    if conf.input.previewPyramid:
+        pyramid = open_pyramid(conf, get_cube_header(conf, mode=mode), mode=mode)
+    rmsDict, checksumDict = fill_cube_slab(conf, range(1, max(catalogueDict) + 1), catalogueDict, mode=mode, pyramid=pyramid)
+    finalize_cube(conf, rmsDict, checksumDict, mode=mode, pyramid=pyramid)
+
+
+def write_slab_statistics(conf, slabIdx, rmsDict, checksumDict, mode="normal"):
+    # numpy scalars are not json serializable
+    slabDict = {
+        "rmsDict": {
+            key: [bool(value) if key == "flagged" else int(value) if key == "chanNo" else float(value) for value in valueList]
+            for key, valueList in rmsDict.items()
+        },
+        "checksumDict": checksumDict,
+    }
+    with open(get_slabStatistics_filepath(conf, slabIdx, mode=mode), "w") as f:
+        json.dump(slabDict, f)
+
+
+def reduce_slab_statistics(conf, slabCount, mode="normal"):
+    """
+    Merges the partial statistics of all slabs in channel order.
+    """
+    rmsDict = {}
+    checksumDict = {}
+    for slabIdx in range(0, slabCount):
+        with open(get_slabStatistics_filepath(conf, slabIdx, mode=mode)) as f:
+            slabDict = json.load(f)
+        for key, valueList in slabDict["rmsDict"].items():
+            rmsDict.setdefault(key, []).extend(valueList)
+        checksumDict.update({int(chanNo): checksum for chanNo, checksum in slabDict["checksumDict"].items()})
+    return [rmsDict, checksumDict]
+
+
+def build_cube_slab(conf, slabIdx, slabCount, mode="normal"):
+    """
+    Distributed cube assembly: every slurm array task fills one contiguous
+    slab of channels. The first task allocates the cube, the others wait for
+    it. Each task writes the partial statistics of its slab and the task that
+    finishes last merges them and finalizes the cube.
+    """
+    cubeName = get_cube_name(conf, mode=mode)
+
+    def allocate():
+        for ii in range(0, slabCount):
+            if os.path.exists(get_slabStatistics_filepath(conf, ii, mode=mode)):
+                os.remove(get_slabStatistics_filepath(conf, ii, mode=mode))
+        make_empty_image(conf, mode=mode)
+
+    run_once(cubeName + ".lock", allocate)
+    catalogueDict = read_image_catalogue(conf, mode=mode)
+    chanNoList = [int(chanNo) for chanNo in np.array_split(np.arange(1, max(catalogueDict) + 1), slabCount)[slabIdx]]
+    info(f"Filling slab {slabIdx + 1}/{slabCount} with {len(chanNoList)} channels {chanNoList[:1]}-{chanNoList[-1:]}: {cubeName}")
+    if conf.input.previewPyramid:
+        warning("The preview pyramid is not generated in the distributed cube assembly.")
+    rmsDict, checksumDict = fill_cube_slab(conf, chanNoList, catalogueDict, mode=mode)
+    write_slab_statistics(conf, slabIdx, rmsDict, checksumDict, mode=mode)
+
+    if not all([os.path.exists(get_slabStatistics_filepath(conf, ii, mode=mode)) for ii in range(0, slabCount)]):
+        return
+    try:
+        os.close(os.open(cubeName + ".reduce.lock", os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return
+    info(f"All {slabCount} slabs filled, merging statistics: {cubeName}")
+    rmsDict, checksumDict = reduce_slab_statistics(conf, slabCount, mode=mode)
+    finalize_cube(conf, rmsDict, checksumDict, mode=mode)
+    for ii in range(0, slabCount):
+        os.remove(get_slabStatistics_filepath(conf, ii, mode=mode))
+    os.remove(cubeName + ".reduce.lock")
+    os.remove(cubeName + ".lock")
+
 
 def move_casalogs_to_dirLogs(conf):
     '''
@@ -513,8 +928,16 @@ def main(ctx):
     info(f"Scripts config: {conf}")
     move_casalogs_to_dirLogs(conf)
 
+    # distributed assembly: tasks 1..N fill the slabs of the normal cube,
+    # tasks N+1..2N the slabs of the smoothed cube
+    slabCount = int(conf.env.buildcubeSlabCount)
+    if slabCount > 1:
+        taskIdx = int(args.slurmArrayTaskId) - 1
+        mode = "smoothed" if taskIdx >= slabCount else "normal"
+        build_cube_slab(conf, taskIdx % slabCount, slabCount, mode=mode)
+
     # exploit slurm task ID to run normal buildcube or smoothed buildcube
-    if int(args.slurmArrayTaskId) == 1:
+    elif int(args.slurmArrayTaskId) == 1:
         make_empty_image(conf, mode="normal")
         fill_cube_with_images(conf, mode="normal")
 
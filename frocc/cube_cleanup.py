@@ -19,14 +19,17 @@ import datetime
 import argparse
 import os
 import shutil
-from logging import info, error
+from concurrent.futures import ThreadPoolExecutor
+from logging import info, warning, error
 
 import click
 
-import casatasks 
+from astropy.io import fits
 
 from frocc.config import FILEPATH_CONFIG_TEMPLATE, FILEPATH_CONFIG_USER
 from frocc.lhelpers import get_dict_from_click_args, DotMap, get_config_in_dot_notation, get_firstFreq, get_basename_from_path, SEPERATOR, SEPERATOR_HEAVY
+from frocc.channel_index import get_channel_imagePath
+from frocc.cube_verify import verify_cube
 
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # SETTINGS
@@ -72,47 +75,184 @@ def main_timer(func):
 
 
 
-def delete_temporary_files(conf):
+def get_path_size(path):
     '''
-    TODO: Find a better indicator than the hdf5 file for a sucessfull run.
-    Also, think about how to arrange the report script an the cleanup.
-    TODO: handle exception if directory is already deleted.
+    Allocated size in bytes of a file or of a directory tree.
     '''
-    run_success = False
-    pathCubeHdf5 =  os.path.join(os.path.join(conf.input.dirHdf5Output, conf.input.basename + conf.env.extCubeHdf5))
-    pathCubeSmoothedHdf5 =  os.path.join(os.path.join(conf.input.dirHdf5Output, conf.input.basename + conf.env.extCubeHdf5))
-    if os.path.isfile(pathCubeHdf5):
-        run_success = True
-        info(f"Found file: {pathCubeHdf5}")
-    else:
-        error(f"File not found: {pathCubeHdf5}")
+    try:
+        if not os.path.isdir(path) or os.path.islink(path):
+            return os.lstat(path).st_blocks * 512
+        size = os.lstat(path).st_blocks * 512
+        with os.scandir(path) as entryIterator:
+            for entry in entryIterator:
+                size += get_path_size(entry.path)
+        return size
+    except FileNotFoundError:
+        return 0
 
-    if conf.input.smoothbeam:
-        if run_success and os.path.isfile(pathCubeSmoothedHdf5):
-            run_success = True
-            info(f"Found file: {pathCubeSmoothedHdf5}")
+
+def remove_path(path):
+    '''
+    Deletes a file or a directory tree. Paths that are already deleted are
+    ignored.
+    '''
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
         else:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def get_deletion_unitList(directory):
+    '''
+    Paths two levels below directory (e.g. the column files and subtables of
+    every split MS in dirVis), so that a single large MS is deleted by several
+    workers as well.
+    '''
+    unitList = []
+    with os.scandir(directory) as entryIterator:
+        for entry in entryIterator:
+            if entry.is_dir(follow_symlinks=False):
+                unitList += [subEntry.path for subEntry in os.scandir(entry.path)]
+            else:
+                unitList.append(entry.path)
+    return unitList
+
+
+def get_reclaimable_space(directory, conf):
+    '''
+    Allocated size in bytes of all files in directory, summed up in parallel.
+    '''
+    if not os.path.isdir(directory):
+        return 0
+    with ThreadPoolExecutor(max_workers=int(conf.env.cleanupMaxWorkers)) as executor:
+        return sum(executor.map(get_path_size, get_deletion_unitList(directory)))
+
+
+def delete_paths(pathList, conf):
+    '''
+    Deletes all paths with conf.env.cleanupMaxWorkers threads. Deleting is
+    bound by metadata operations on the file system, not by the CPU.
+    '''
+    with ThreadPoolExecutor(max_workers=int(conf.env.cleanupMaxWorkers)) as executor:
+        list(executor.map(remove_path, pathList))
+
+
+def delete_directory(directory, conf):
+    '''
+    Deletes directory in parallel.
+    '''
+    if not os.path.isdir(directory):
+        warning(f"Directory already deleted: {directory}")
+        return
+    info(f"Deleting {directory} with {conf.env.cleanupMaxWorkers} workers.")
+    delete_paths(get_deletion_unitList(directory), conf)
+    # only the empty directory skeleton is left
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def is_fits_file_complete(filepath):
+    '''
+    True if the fits file exists and is at least as large as its header
+    announces, i.e. it was written completely.
+    '''
+    try:
+        with open(filepath, "rb") as f:
+            header, headerSize = fits.Header.fromfile(f), f.tell()
+    except (OSError, ValueError):
+        return False
+    dataSize = abs(header.get("BITPIX", 8)) // 8 * np.prod([header.get(f"NAXIS{axis}", 0) for axis in range(1, header.get("NAXIS", 0) + 1)], dtype=np.int64)
+    return os.path.getsize(filepath) >= headerSize + dataSize
+
+
+def is_channel_image_confirmed(conf, chanNo):
+    '''
+    True if the exported tclean images of channel chanNo (and the smoothed
+    image if conf.input.smoothbeam) are complete.
+    '''
+    imagePathList = [get_channel_imagePath(conf, chanNo)]
+    if conf.input.smoothbeam:
+        imagePathList.append(get_channel_imagePath(conf, chanNo, mode="smoothed"))
+    return all([is_fits_file_complete(imagePath) for imagePath in imagePathList])
+
+
+def delete_channel_vis(conf, chanNo, channelInputMS):
+    '''
+    Staged cleanup: deletes the split visibilities of one channel as soon as
+    its tclean images are confirmed. Called by cube_tclean after each channel.
+    '''
+    if not is_channel_image_confirmed(conf, chanNo):
+        warning(f"Images of channel {chanNo} not confirmed, keeping split visibilities: {channelInputMS}")
+        return
+    size = sum([get_path_size(ms) for ms in channelInputMS])
+    info(f"Staged cleanup: deleting split visibilities of channel {chanNo}, reclaiming {round(size / 1024.**2, 2)} MB: {channelInputMS}")
+    unitList = []
+    for ms in channelInputMS:
+        unitList += [entry.path for entry in os.scandir(ms)]
+    delete_paths(unitList, conf)
+    for ms in channelInputMS:
+        shutil.rmtree(ms, ignore_errors=True)
+
+
+def is_run_successful(conf):
+    '''
+    A run is successful if the HDF5 files of all cubes exist and the cubes
+    and their HDF5 copies match the checksums recorded by cube_buildcube.
+    With conf.input.cubeStore no HDF5 copy is written, the cube stores have
+    to match the checksums.
+    '''
+    modeList = ["normal", "smoothed"] if conf.input.smoothbeam else ["normal"]
+    extHdf5Dict = {"normal": conf.env.extCubeHdf5, "smoothed": conf.env.extCubeSmoothedHdf5}
+    run_success = True
+    for mode in modeList:
+        pathCubeHdf5 = os.path.join(conf.input.dirHdf5Output, conf.input.basename + extHdf5Dict[mode])
+        if not conf.input.cubeStore:
+            if os.path.isfile(pathCubeHdf5):
+                info(f"Found file: {pathCubeHdf5}")
+            else:
+                error(f"File not found: {pathCubeHdf5}")
+                run_success = False
+                continue
+        problemList = verify_cube(conf, mode=mode)
+        for problem in problemList:
+            error(problem)
+        if problemList:
+            error(f"Verification of the {mode} cube failed.")
             run_success = False
-            error(f"File not found: {pathCubeSmoothedHdf5}")
+        else:
+            info(f"Verification of the {mode} cube passed.")
+    return run_success
 
-    level = int(conf.input.cleanup)
-    if run_success:
-        info(f"Files found. Assuming the run went through sucessfully.")
-        info(f"Deleting temporary files according to --cleanup flag.")
-        if level == 0:
-            info(f"Cleanup flag: --cleanup {level}. Not deleting any files.")
-        elif level == 1:
-            info(f"Cleanup flag: --cleanup {level}. Deleting directory {conf.env.dirVis}.")
-            shutil.rmtree(conf.env.dirVis)
-        elif level == 2:
-            info(f"Cleanup flag: --cleanup {level}. Deleting directory {conf.env.dirVis} and {conf.env.dirImages}.")
-            shutil.rmtree(conf.env.dirVis)
-            shutil.rmtree(conf.env.dirImages)
-    else:
-        error("Files not found. Assuming run did not run through without errors. Not deleting temporary files.")
 
+def delete_temporary_files(conf):
+    '''
+    Verifies the cubes and deletes the temporary directories according to the
+    --cleanup level, see get_cleanup_directoryList.
+    TODO: Think about how to arrange the report script an the cleanup.
+    '''
+    level = int(conf.input.cleanup)
     if level == 0:
         info(f"Cleanup level {level}. Not deleting any temporary files.")
+        return
+    directoryList = [conf.env.dirVis]
+    if level >= 2:
+        directoryList.append(conf.env.dirImages)
+
+    info(SEPERATOR)
+    sizeDict = {directory: get_reclaimable_space(directory, conf) for directory in directoryList}
+    for directory, size in sizeDict.items():
+        info(f"Reclaimable space in {directory}: {round(size / 1024.**3, 2)} GB")
+    info(SEPERATOR)
+
+    if not is_run_successful(conf):
+        error("Cubes not verified. Assuming run did not run through without errors. Not deleting temporary files.")
+        return
+    info(f"Cubes verified. Deleting temporary files according to --cleanup {level}: {directoryList}")
+    for directory in directoryList:
+        delete_directory(directory, conf)
+    info(f"Cleanup done, reclaimed {round(sum(sizeDict.values()) / 1024.**3, 2)} GB.")
 
 @click.command(context_settings=dict(
     ignore_unknown_options=True,
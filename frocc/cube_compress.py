@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+'''
+Tile-compressed fits copy of the cube, following the fits tiled image
+compression convention (as written by fpack and read by astropy, cfitsio,
+ds9 and CARTA).
+
+Every plane [stokes, chan, :, :] is one tile, i.e. one row of the compressed
+binary table. The tiles are compressed in a process pool and streamed into
+the heap of the table in the order they are done, the row descriptors and the
+header are written at the end. Only the header and the row table have to be
+held in memory, so the cube can exceed the machine's RAM.
+
+GZIP_1 and GZIP_2 (byte shuffled) compress the float32 values losslessly.
+RICE_1 and HCOMPRESS_1 compress integers: every tile gets quantised with
+ZSCALE = compressionQuantisationStep times the channel noise (ZQUANTIZ =
+NO_DITHER, NaN as ZBLANK), so the error of every value is at most half a
+step. For noise dominated polarisation cubes this compresses several times
+better than lossless compression. The quantised integer tiles are encoded
+with astropy's CompImageHDU (astropy >= 5.3).
+
+open_cube reads either the fits cube or, if that does not exist, the
+compressed cube or the chunked cube store, so the downstream stages read all
+of them transparently.
+'''
+
+import io
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+
+from frocc.channel_index import get_cube_filepath, get_hole_chanNoList
+from frocc.cube_quantise import get_channel_noiseDict, get_plane_scaling, quantise_plane
+from frocc.cube_store import CubeStoreSection, get_cubeStore_dirpath, read_store_header
+from frocc.image_catalogue import read_fits_header_block, FITS_BLOCK_SIZE
+from frocc.plane_io import pread_into, swap_native_inplace
+from frocc.logger import *
+
+
+COMPRESSION_TYPE_LIST = ["GZIP_1", "GZIP_2", "RICE_1", "HCOMPRESS_1"]
+QUANTISED_COMPRESSION_TYPE_LIST = ["RICE_1", "HCOMPRESS_1"]
+ZBLANK = -2**31
+# keywords of the cube header that describe the data layout and are replaced
+# by the Z keywords of the compressed table
+STRUCTURAL_KEYWORD_LIST = ["SIMPLE", "BITPIX", "NAXIS", "NAXIS1", "NAXIS2", "NAXIS3", "NAXIS4", "EXTEND", "BSCALE", "BZERO", "BLANK", "PCOUNT", "GCOUNT", "XTENSION", "CHECKSUM", "DATASUM"]
+
+
+def get_compressedCube_filepath(conf, mode="normal"):
+    '''
+    Path of the tile-compressed copy of the normal or smoothed cube.
+    '''
+    if mode == "smoothed":
+        return os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeSmoothedCompressedFits)
+    return os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeCompressedFits)
+
+
+def encode_integer_tile(quantised, compressionType):
+    '''
+    RICE_1 or HCOMPRESS_1 compressed bytes of one int32 tile. The tile is
+    written as a single tile compressed image into memory with astropy's
+    CompImageHDU, integers are compressed without further quantisation, and
+    the bytes are read back from the row of the binary table.
+    '''
+    hdu = fits.CompImageHDU(quantised, compression_type=compressionType, tile_shape=quantised.shape)
+    buffer = io.BytesIO()
+    hdu.writeto(buffer)
+    buffer.seek(0)
+    with fits.open(buffer, disable_image_compression=True) as hud:
+        return hud[1].data["COMPRESSED_DATA"][0].tobytes()
+
+
+def compress_tile(plane, compressionType, noise=np.nan, quantisationStep=0.):
+    '''
+    Compressed bytes of one native float32 plane.
+
+    Returns
+    -------
+    [compressed, zscale, zzero]: list with bytes and floats
+       zscale and zzero are None for the lossless GZIP compression.
+
+    '''
+    if compressionType in QUANTISED_COMPRESSION_TYPE_LIST:
+        zscale, zzero = get_plane_scaling(plane, np.int32, noise=noise, quantisationStep=quantisationStep)
+        quantised = quantise_plane(plane, zscale, zzero, np.int32)
+        return [encode_integer_tile(quantised, compressionType), zscale, zzero]
+    tileBytes = np.ascontiguousarray(plane, dtype=">f4").tobytes()
+    if compressionType == "GZIP_2":
+        # bytes sorted by significance compress better
+        tileBytes = np.frombuffer(tileBytes, dtype=np.uint8).reshape(-1, 4).T.tobytes()
+    compressor = zlib.compressobj(wbits=31)  # gzip stream as written by cfitsio
+    return [compressor.compress(tileBytes) + compressor.flush(), None, None]
+
+
+def compress_chunk(filepathCube, planeIdxList, noiseList, holePlaneIdxList, compressionType, quantisationStep):
+    '''
+    Compresses the planes in planeIdxList (stokesIdx * NAXIS3 + chanIdx) of
+    the fits cube. The planes in holePlaneIdxList are not read but compressed
+    as NaN, they are holes of a sparse cube. Runs in a worker process.
+
+    Returns
+    -------
+    tileList: list
+       [planeIdx, compressed, zscale, zzero] per plane.
+
+    '''
+    header, dataOffset = read_fits_header_block(filepathCube)
+    plane = np.empty((header["NAXIS2"], header["NAXIS1"]), dtype=np.float32)
+    tileList = []
+    fd = os.open(filepathCube, os.O_RDONLY)
+    try:
+        for planeIdx, noise in zip(planeIdxList, noiseList):
+            if planeIdx in holePlaneIdxList:
+                plane.fill(np.nan)
+            else:
+                pread_into(fd, plane, dataOffset + planeIdx * plane.nbytes)
+                swap_native_inplace(plane)
+            tileList.append([planeIdx] + compress_tile(plane, compressionType, noise=noise, quantisationStep=quantisationStep))
+    finally:
+        os.close(fd)
+    return tileList
+
+
+def get_compressed_table_header(cubeHeader, compressionType, rowCount, heapSize, maxTileSize):
+    '''
+    Header of the compressed image table. Its number of cards only depends
+    on the cube header and compressionType, so it can be rewritten in place
+    with the final heap size.
+    '''
+    quantised = compressionType in QUANTISED_COMPRESSION_TYPE_LIST
+    header = fits.Header()
+    header["XTENSION"] = "BINTABLE"
+    header["BITPIX"] = 8
+    header["NAXIS"] = 2
+    # 64 bit heap descriptors (1Q), the heap of a large cube exceeds 2 GiB
+    header["NAXIS1"] = 32 if quantised else 16
+    header["NAXIS2"] = rowCount
+    header["PCOUNT"] = heapSize
+    header["GCOUNT"] = 1
+    header["TFIELDS"] = 3 if quantised else 1
+    header["TTYPE1"] = "COMPRESSED_DATA"
+    header["TFORM1"] = f"1QB({maxTileSize})"
+    if quantised:
+        header["TTYPE2"] = "ZSCALE"
+        header["TFORM2"] = "1D"
+        header["TTYPE3"] = "ZZERO"
+        header["TFORM3"] = "1D"
+    header["ZIMAGE"] = True
+    header["ZBITPIX"] = -32
+    header["ZNAXIS"] = 4
+    for axis in range(1, 5):
+        header[f"ZNAXIS{axis}"] = cubeHeader[f"NAXIS{axis}"]
+    header["ZTILE1"] = cubeHeader["NAXIS1"]
+    header["ZTILE2"] = cubeHeader["NAXIS2"]
+    header["ZTILE3"] = 1
+    header["ZTILE4"] = 1
+    header["ZCMPTYPE"] = compressionType
+    if compressionType == "RICE_1":
+        header["ZNAME1"] = "BLOCKSIZE"
+        header["ZVAL1"] = 32
+        header["ZNAME2"] = "BYTEPIX"
+        header["ZVAL2"] = 4
+    elif compressionType == "HCOMPRESS_1":
+        header["ZNAME1"] = "SCALE"
+        header["ZVAL1"] = 0
+        header["ZNAME2"] = "SMOOTH"
+        header["ZVAL2"] = 0
+    header["ZQUANTIZ"] = "NO_DITHER" if quantised else "NONE"
+    if quantised:
+        header["ZBLANK"] = ZBLANK
+    for card in cubeHeader.cards:
+        if card.keyword not in STRUCTURAL_KEYWORD_LIST:
+            header.append(card)
+    return header
+
+
+def write_header_in_place(fd, header, offset, size):
+    headerBytes = header.tostring().encode("ascii")
+    if len(headerBytes) != size:
+        raise ValueError(f"Compressed table header changed its size from {size} to {len(headerBytes)} bytes.")
+    os.pwrite(fd, headerBytes, offset)
+
+
+def write_compressed_cube(conf, mode="normal"):
+    '''
+    Writes the tile-compressed copy of the fits cube with
+    conf.input.compressedCube as compression type.
+    '''
+    compressionType = str(conf.input.compressedCube).upper()
+    filepathCube = get_cube_filepath(conf, mode=mode)
+    filepathCompressed = get_compressedCube_filepath(conf, mode=mode)
+    quantisationStep = float(conf.input.compressionQuantisationStep)
+    info(f"Writing {compressionType} tile-compressed cube: {filepathCompressed}")
+    cubeHeader = read_fits_header_block(filepathCube)[0]
+    stokesCount, chanCount = cubeHeader["NAXIS4"], cubeHeader["NAXIS3"]
+    rowCount = stokesCount * chanCount
+    noiseDict = get_channel_noiseDict(conf, mode=mode)
+    noiseList = [noiseDict.get(chanIdx + 1, np.nan) for chanIdx in range(0, chanCount)] * stokesCount
+    holePlaneIdxSet = set([stokesIdx * chanCount + chanNo - 1 for chanNo in get_hole_chanNoList(conf, mode=mode) for stokesIdx in range(0, stokesCount)])
+
+    primaryBytes = fits.PrimaryHDU().header.tostring().encode("ascii")
+    tableHeader = get_compressed_table_header(cubeHeader, compressionType, rowCount, 0, 0)
+    tableHeaderSize = len(tableHeader.tostring())
+    tableOffset = len(primaryBytes) + tableHeaderSize
+    heapOffset = tableOffset + rowCount * tableHeader["NAXIS1"]
+    rowList = [None] * rowCount
+    heapSize = 0
+    maxTileSize = 0
+
+    fd = os.open(filepathCompressed, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.pwrite(fd, primaryBytes, 0)
+        chunkSize = int(conf.env.compressionChanChunkSize)
+        chunkList = [list(range(ii, min(ii + chunkSize, rowCount))) for ii in range(0, rowCount, chunkSize)]
+        with ProcessPoolExecutor(max_workers=int(conf.env.compressionMaxCpuCores)) as executor:
+            futureList = [
+                executor.submit(
+                    compress_chunk, filepathCube, chunk, [noiseList[planeIdx] for planeIdx in chunk],
+                    [planeIdx for planeIdx in chunk if planeIdx in holePlaneIdxSet], compressionType, quantisationStep,
+                )
+                for chunk in chunkList
+            ]
+            for future in futureList:
+                for planeIdx, compressed, zscale, zzero in future.result():
+                    os.pwrite(fd, compressed, heapOffset + heapSize)
+                    rowList[planeIdx] = (len(compressed), heapSize, zscale, zzero)
+                    heapSize += len(compressed)
+                    maxTileSize = max(maxTileSize, len(compressed))
+        write_compressed_rows(fd, tableOffset, rowList, compressionType)
+        tableHeader = get_compressed_table_header(cubeHeader, compressionType, rowCount, heapSize, maxTileSize)
+        write_header_in_place(fd, tableHeader, len(primaryBytes), tableHeaderSize)
+        pad_fits_file(fd, heapOffset + heapSize)
+    finally:
+        os.close(fd)
+    info(f"Compressed cube: {os.path.getsize(filepathCompressed)} bytes, fits cube: {os.path.getsize(filepathCube)} bytes.")
+
+
+def write_compressed_rows(fd, tableOffset, rowList, compressionType):
+    '''
+    Writes the row table: heap descriptor (length, offset) and, for quantised
+    tiles, ZSCALE and ZZERO.
+    '''
+    if compressionType in QUANTISED_COMPRESSION_TYPE_LIST:
+        rowDtype = np.dtype([("count", ">i8"), ("offset", ">i8"), ("zscale", ">f8"), ("zzero", ">f8")])
+    else:
+        rowDtype = np.dtype([("count", ">i8"), ("offset", ">i8")])
+    rowArray = np.zeros(len(rowList), dtype=rowDtype)
+    for ii, (count, offset, zscale, zzero) in enumerate(rowList):
+        rowArray[ii]["count"] = count
+        rowArray[ii]["offset"] = offset
+        if zscale is not None:
+            rowArray[ii]["zscale"] = zscale
+            rowArray[ii]["zzero"] = zzero
+    os.pwrite(fd, rowArray.tobytes(), tableOffset)
+
+
+def pad_fits_file(fd, size):
+    '''
+    Truncates or zero pads the file after `size` bytes to a multiple of the
+    fits block size.
+    '''
+    os.ftruncate(fd, FITS_BLOCK_SIZE * ((size - 1) // FITS_BLOCK_SIZE + 1))
+
+
+def replace_compressed_tiles(conf, chanNoList, mode="normal"):
+    '''
+    Sets the channels in chanNoList of the compressed cube to NaN, e.g. after
+    the iterative outlier rejection. The NaN tiles are appended to the heap
+    and the row descriptors point to them, the old tiles stay unused in the
+    heap.
+    '''
+    filepathCompressed = get_compressedCube_filepath(conf, mode=mode)
+    if not chanNoList or not os.path.exists(filepathCompressed):
+        return
+    info(f"Flagging {len(chanNoList)} channels in compressed cube: {filepathCompressed}")
+    tableOffset = read_fits_header_block(filepathCompressed)[1]
+    with open(filepathCompressed, "rb") as f:
+        f.seek(tableOffset)
+        tableHeader = fits.Header.fromfile(f)
+    tableHeaderSize = len(tableHeader.tostring())
+    rowOffset = tableOffset + tableHeaderSize
+    compressionType = tableHeader["ZCMPTYPE"]
+    rowCount, rowSize = tableHeader["NAXIS2"], tableHeader["NAXIS1"]
+    chanCount = tableHeader["ZNAXIS3"]
+    heapOffset = rowOffset + rowCount * rowSize
+    heapSize = tableHeader["PCOUNT"]
+    maxTileSize = int(tableHeader["TFORM1"].split("(")[1].rstrip(")"))
+    nanTile = compress_tile(np.full((tableHeader["ZNAXIS2"], tableHeader["ZNAXIS1"]), np.nan, dtype=np.float32), compressionType)[0]
+
+    fd = os.open(filepathCompressed, os.O_RDWR)
+    try:
+        os.pwrite(fd, nanTile, heapOffset + heapSize)
+        descriptor = np.array([len(nanTile), heapSize], dtype=">i8").tobytes()
+        for chanNo in chanNoList:
+            for stokesIdx in range(0, tableHeader["ZNAXIS4"]):
+                os.pwrite(fd, descriptor, rowOffset + (stokesIdx * chanCount + int(chanNo) - 1) * rowSize)
+        heapSize += len(nanTile)
+        maxTileSize = max(maxTileSize, len(nanTile))
+        tableHeader["PCOUNT"] = heapSize
+        tableHeader["TFORM1"] = f"1QB({maxTileSize})"
+        write_header_in_place(fd, tableHeader, tableOffset, tableHeaderSize)
+        pad_fits_file(fd, heapOffset + heapSize)
+    finally:
+        os.close(fd)
+
+
+class SparseCubeSection:
+    '''
+    Read access to the memory mapped data of a sparse fits cube with the
+    indexing of the data, e.g. section[stokesIdx, chanIdx, :, :]. The hole
+    channels, which read as 0, are returned as NaN.
+    '''
+
+    def __init__(self, data, holeChanNoList):
+        self.data = data
+        self.holeChanIdxArray = np.array(holeChanNoList, dtype=int) - 1
+        self.shape = data.shape
+        self.ndim = data.ndim
+        self.dtype = np.dtype(np.float32)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (self.ndim - len(key))
+        stokesIdxArray = np.arange(self.shape[0])[key[0]]
+        chanIdxArray = np.arange(self.shape[1])[key[1]]
+        data = np.array(self.data[key], dtype=np.float32)
+        holeMask = np.isin(chanIdxArray, self.holeChanIdxArray)
+        if np.ndim(chanIdxArray) == 0:
+            if holeMask:
+                data.fill(np.nan)
+        elif holeMask.any():
+            # integer stokes indices drop their axis
+            chanAxis = 0 if np.ndim(stokesIdxArray) == 0 else 1
+            data[(slice(None),) * chanAxis + (holeMask,)] = np.nan
+        return data
+
+
+def open_cube(conf, mode="normal"):
+    '''
+    Opens the fits cube for reading. If it does not exist, the compressed
+    cube or else the chunked cube store is opened.
+
+    Returns
+    -------
+    [hud, data, header]: list
+       The opened HDU list, which has to be closed by the caller, the data,
+       which can be sliced like the memory mapped cube, and the cube header as
+       primary header. The holes of a sparse cube read as NaN.
+
+    '''
+    filepathCube = get_cube_filepath(conf, mode=mode)
+    filepathCompressed = get_compressedCube_filepath(conf, mode=mode)
+    dirpathStore = get_cubeStore_dirpath(conf, mode=mode)
+    if not os.path.exists(filepathCube) and not os.path.exists(filepathCompressed) and os.path.exists(dirpathStore):
+        info(f"Reading cube store: {dirpathStore}")
+        header = read_store_header(dirpathStore)
+        return [fits.HDUList(), CubeStoreSection(dirpathStore), header]
+    if os.path.exists(filepathCube) or not os.path.exists(filepathCompressed):
+        hud = fits.open(filepathCube, memmap=True, ignore_missing_end=True, mode="readonly")
+        holeChanNoList = get_hole_chanNoList(conf, mode=mode)
+        if holeChanNoList:
+            return [hud, SparseCubeSection(hud[0].data, holeChanNoList), hud[0].header]
+        return [hud, hud[0].data, hud[0].header]
+    info(f"Reading compressed cube: {filepathCompressed}")
+    hud = fits.open(filepathCompressed, mode="readonly")
+    header = hud[1].header.copy()
+    for keyword in ["XTENSION", "PCOUNT", "GCOUNT", "EXTNAME"]:
+        header.remove(keyword, ignore_missing=True)
+    header.insert(0, ("SIMPLE", True))
+    # the section only decompresses the tiles of the requested planes
+    return [hud, hud[1].section, header]
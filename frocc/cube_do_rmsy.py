@@ -4,11 +4,16 @@ import logging
 import csv
 import numpy as np
 import json
+import os
 
-from glob import glob
-from frocc.lhelpers import get_config_in_dot_notation, main_timer
+from astropy.io import fits
+from astropy.wcs import WCS
+from concurrent.futures import ProcessPoolExecutor
+from frocc.lhelpers import get_config_in_dot_notation, main_timer, get_firstFreq, get_stokesIdx, get_stokesIdxList, get_flaggingStokes
+from frocc.channel_index import get_cube_filepath, read_cube_validity_index
+from frocc.spectral_extraction import get_spectra, get_box_rms
 from frocc.config import FILEPATH_CONFIG_TEMPLATE, FILEPATH_CONFIG_USER
-from logging import info, error
+from logging import info, warning, error
 
 from RMtools_1D.do_RMsynth_1D import run_rmsynth
 
@@ -80,16 +85,181 @@ def get_statsList_from_datFile(datFile):
 
 
 
+def read_source_catalogue(filepath):
+    '''
+    Reads a tab separated source catalogue with a header line. Sources are
+    given either in pixel coordinates (columns "x" and "y", 0-based) or in
+    world coordinates (columns "ra" and "dec" in degree). An optional "name"
+    column is passed through to the results table.
+
+    Returns
+    -------
+    sourceDict: dict of lists
+       Keys "name" and either "x", "y" or "ra", "dec".
+
+    '''
+    with open(filepath) as csvFile:
+        reader = csv.reader(filter(lambda line: line.strip() and not line.startswith("#"), csvFile), delimiter="\t")
+        legendList = [legend.strip().lower() for legend in next(reader)]
+        sourceDict = {legend: [] for legend in legendList}
+        for row in reader:
+            for legend, value in zip(legendList, row):
+                sourceDict[legend].append(value.strip())
+    if not ({"x", "y"} <= set(legendList) or {"ra", "dec"} <= set(legendList)):
+        raise ValueError(f"Source catalogue needs the columns x, y or ra, dec: {filepath}")
+    for legend in ["x", "y", "ra", "dec"]:
+        if legend in sourceDict:
+            sourceDict[legend] = [float(value) for value in sourceDict[legend]]
+    if "name" not in sourceDict:
+        sourceDict["name"] = [str(ii) for ii in range(0, len(sourceDict[legendList[0]]))]
+    return sourceDict
+
+
+def get_source_positionDict(sourceDict, header):
+    '''
+    Converts the catalogue positions to pixel positions (yIdx, xIdx) in the
+    cube and adds the missing coordinates, pixel or world. Sources outside of
+    the cube are dropped.
+    '''
+    wcs = WCS(header).celestial
+    if "ra" in sourceDict and "x" not in sourceDict:
+        xArray, yArray = wcs.all_world2pix(sourceDict["ra"], sourceDict["dec"], 0)
+    else:
+        xArray, yArray = np.array(sourceDict["x"]), np.array(sourceDict["y"])
+    xArray = np.round(xArray).astype(int)
+    yArray = np.round(yArray).astype(int)
+    raArray, decArray = wcs.all_pix2world(xArray, yArray, 0)
+    insideMask = (xArray >= 0) & (xArray < header["NAXIS1"]) & (yArray >= 0) & (yArray < header["NAXIS2"])
+    for name in np.array(sourceDict["name"])[~insideMask]:
+        warning(f"Source outside of the cube, skipping: {name}")
+    return {
+        "name": list(np.array(sourceDict["name"])[insideMask]),
+        "x": list(xArray[insideMask]),
+        "y": list(yArray[insideMask]),
+        "ra": list(raArray[insideMask]),
+        "dec": list(decArray[insideMask]),
+    }
+
+
+def get_channel_freq_and_noise(conf, dataCube):
+    '''
+    Frequency in [Hz] and noise (RMS of the flagging Stokes, V by default) in
+    [Jy/beam] for all cube channels. Both are taken from the cube validity
+    index. Without index the planned channel frequencies and the box RMS of
+    the flagging Stokes at the cube centre are used.
+    '''
+    indexDict = read_cube_validity_index(conf)
+    if indexDict:
+        freqArray = np.array(indexDict["frequency"])
+        noiseArray = np.array(indexDict["rmsNoise"])
+        noiseArray[~np.array(indexDict["valid"])] = np.nan
+        return freqArray, noiseArray
+    stokes, chanCount, height, width = dataCube.shape
+    freqArray = get_firstFreq(conf) + conf.input.outputChanBandwidth * np.arange(0, chanCount)
+    noiseArray = get_box_rms(dataCube, (height // 2, width // 2), int(width * 0.04), stokesIdx=get_stokesIdx(conf, get_flaggingStokes(conf)))
+    return freqArray, noiseArray
+
+
+def run_rmsynth_for_source(dataList):
+    '''
+    RM synthesis for one source without plots and without files. Runs in a
+    worker process, failures are reported as an empty result.
+    '''
+    try:
+        measurementDict, arrayDict = run_rmsynth(dataList, units="[uJy/beam]", verbose=False, showPlots=False)
+    except Exception as e:
+        return {"error": str(e)}
+    return {key: value for key, value in measurementDict.items() if np.isscalar(value)}
+
+
+def write_rmsy_catalogue_results(conf, positionDict, resultList):
+    '''
+    Writes the positions and the RM synthesis measurements of all sources to
+    one tab separated table.
+    '''
+    filepathResults = os.path.join(conf.env.dirRMSYdata, conf.input.basename + conf.env.extRmsyCatalogue)
+    keyList = []
+    for result in resultList:
+        keyList += [key for key in result if key not in keyList]
+    info(f"Writing RM synthesis results of {len(resultList)} sources: {filepathResults}")
+    with open(filepathResults, "w") as csvFile:
+        writer = csv.writer(csvFile, delimiter="\t")
+        csvData = [["name", "x", "y", "ra [deg]", "dec [deg]"] + keyList]
+        for ii, result in enumerate(resultList):
+            row = [positionDict[key][ii] for key in ["name", "x", "y", "ra", "dec"]]
+            csvData.append(row + [result.get(key, "") for key in keyList])
+        writer.writerows(csvData)
+
+
+def do_rmsy_for_catalogue(conf):
+    '''
+    RM synthesis for all sources of the catalogue conf.input.rmsyCatalogue.
+    The spectra of all sources are read in one pass over the cube, the RM
+    synthesis runs in a process pool.
+    '''
+    cubeName = get_cube_filepath(conf)
+    info(SEPERATOR)
+    info(f"Opening data cube: {cubeName}")
+    hudCube = fits.open(cubeName, memmap=True, ignore_missing_end=True, mode="readonly")
+    dataCube = hudCube[0].data
+    positionDict = get_source_positionDict(read_source_catalogue(conf.input.rmsyCatalogue), hudCube[0].header)
+    info(f"Extracting spectra of {len(positionDict['name'])} sources.")
+    stokesIQU = get_spectra(
+        dataCube,
+        list(zip(positionDict["y"], positionDict["x"])),
+        stokesIdxList=get_stokesIdxList(conf, "IQU"),
+        chanChunkSize=int(conf.env.rmsyChanChunkSize),
+    )
+    freqArray, noiseArray = get_channel_freq_and_noise(conf, dataCube)
+    hudCube.close()
+
+    dataListList = []
+    for ii in range(0, stokesIQU.shape[2]):
+        validMask = np.isfinite(stokesIQU[:, :, ii]).all(axis=0) & np.isfinite(noiseArray) & (stokesIQU[0, :, ii] != 0)
+        noise = noiseArray[validMask] * 1e6
+        dataListList.append([
+            freqArray[validMask],
+            stokesIQU[0, validMask, ii] * 1e6,
+            stokesIQU[1, validMask, ii] * 1e6,
+            stokesIQU[2, validMask, ii] * 1e6,
+            noise, noise, noise,
+        ])
+
+    maxWorkers = int(conf.env.rmsyMaxCpuCores)
+    info(f"Running RM synthesis with {maxWorkers} processes.")
+    with ProcessPoolExecutor(max_workers=maxWorkers) as executor:
+        resultList = list(executor.map(
+            run_rmsynth_for_source,
+            dataListList,
+            chunksize=max(1, len(dataListList) // (4 * maxWorkers)),
+        ))
+    for name, result in zip(positionDict["name"], resultList):
+        if "error" in result:
+            warning(f"RM synthesis failed for source {name}: {result['error']}")
+    write_rmsy_catalogue_results(conf, positionDict, resultList)
+
+
 @main_timer
 def main():
     conf = get_config_in_dot_notation(templateFilename=FILEPATH_CONFIG_TEMPLATE, configFilename=FILEPATH_CONFIG_USER)
-    inputDatList = glob(conf.env.dirRMSYdata + "*tab")
+    if get_stokesIdxList(conf, "IQU") is None:
+        info(f"No Stokes I, Q and U in the cube (stokes = {conf.input.stokes}). Skipping RM synthesis.")
+        return
+    if conf.input.rmsyCatalogue:
+        do_rmsy_for_catalogue(conf)
+        return
+    # only the input data written by cube_generate_rmsy_input_data, not the
+    # catalogue results in the same directory
+    filepathInputData = os.path.join(conf.env.dirRMSYdata, "rmsy." + conf.input.basename + ".tab")
+    if not os.path.exists(filepathInputData):
+        error(f"RM synthesis input data not found, run cube_generate_rmsy_input_data.py first: {filepathInputData}")
+        return
 
 #    statsDict = get_dict_from_tabFile(FILEPATH_STATISTICS)
 #    initialStatsDict = dict(statsDict)  # make a deep copy
-    allStatsList = get_statsList_from_datFile(inputDatList[0])
+    allStatsList = get_statsList_from_datFile(filepathInputData)
     aDict, mDict = run_rmsynth(allStatsList, units="[uJy/beam]", verbose=True, debug=True, showPlots=True)
-    saveOutput(aDict, mDict, inputDatList[0].replace(".tab", ""))
+    saveOutput(aDict, mDict, filepathInputData.replace(".tab", ""))
 
 
 if __name__ == "__main__":
@@ -15,7 +15,10 @@ from glob import glob
 import os
 
 from scipy import *
-from frocc.lhelpers import get_std_via_mad, get_config_in_dot_notation, main_timer, get_firstFreq
+from frocc.lhelpers import get_std_via_mad, get_config_in_dot_notation, main_timer, get_firstFreq, get_stokesIdx, get_stokesIdxList, get_flaggingStokes
+from frocc.channel_index import get_valid_chanIdxList
+from frocc.spectral_extraction import get_first_peak_position, get_spectra, get_box_rms
+from frocc.cube_compress import open_cube
 from frocc.config import FILEPATH_CONFIG_TEMPLATE, FILEPATH_CONFIG_USER
 from logging import info, error
 import subprocess
@@ -78,68 +81,43 @@ def get_dict_from_tabFile(tabFile):
 
 def get_rmsyDict_from_cube(conf):
     """
-    Simple not optimized version TODO
+    Extracts the Stokes I, Q, U spectra at the brightest Stokes I pixel of the
+    first valid channel and the Stokes V box RMS around it for all channels.
 
     """
-    cubeName = conf.input.basename + conf.env.extCubeFits
     info(SEPERATOR)
-    info("Opening data cube: %s", cubeName)
-    # TODO: debug: if ignore_missing_end is not true I get an error.
-    hudCube = fits.open(cubeName, memmap=True, ignore_missing_end=True, mode="update")
-    dataCube = hudCube[0].data
-    asd, maxIndex, width, height = shape(dataCube)
+    info("Opening data cube.")
+    # fits cube or tile-compressed cube
+    hudCube, dataCube, header = open_cube(conf)
+    asd, maxIndex, width, height = dataCube.shape
     rmsBoxSize = int(width * 0.04)
+    validChanIdxList = get_valid_chanIdxList(conf)
+    if validChanIdxList is None:
+        validChanIdxList = list(range(0, maxIndex))
     # get pixel coordinates of max value. try first channel. If it is nan, go to next channel
     info("Trying to get x-y coordinates of highest value of Stokes I in channel.")
-    for ii in range(0, maxIndex + 1):
-        info(f"Trying channel: {ii + 1}")
-        if not np.isnan(np.nanmax(dataCube[0, ii, :, :])):
-            print(np.nanmax(dataCube[0, ii, :, :]))
-            print(np.where(dataCube == np.amax(dataCube[0, ii, :, :])))
-            asd, asdidx, xMaxIndex, yMaxIndex = np.where(dataCube == np.amax(dataCube[0, ii, :, :]))
-            xMaxIndex = xMaxIndex[0]
-            yMaxIndex = yMaxIndex[0]
-            break
-    info(f"Found max value at coordinates: x = {xMaxIndex}, y = {yMaxIndex}")
-
-    freqList = []
-    stokesImaxList = []
-    stokesQmaxList = []
-    stokesUmaxList = []
-    stokesVrmsList = []
-
-    for ii in range(0, maxIndex + 1):
-        # try except, excepts by np.nan. TODO: write this cleaner
-        try:
-            firstFreq = get_firstFreq(conf)
-            freq = firstFreq + conf.input.outputChanBandwidth * ii
-            stokesImax = dataCube[0, ii, xMaxIndex, yMaxIndex]
-            stokesQmax = dataCube[1, ii, xMaxIndex, yMaxIndex]
-            stokesUmax = dataCube[2, ii, xMaxIndex, yMaxIndex]
-
-            xStart = int(xMaxIndex - rmsBoxSize/2)
-            xStop = int(xMaxIndex + rmsBoxSize/2)
-            yStart = int(yMaxIndex - rmsBoxSize/2)
-            yStop = int(yMaxIndex + rmsBoxSize/2)
-            stokesVrms = get_std_via_mad(dataCube[3, ii, xStart:xStop, yStart:yStop])
-
-            freqList.append(freq)
-            stokesImaxList.append(stokesImax)
-            stokesQmaxList.append(stokesQmax)
-            stokesUmaxList.append(stokesUmax)
-            stokesVrmsList.append(stokesVrms)
-            info(f"From channel number {ii + 1} got frequency [Hz], stokesImax [uJy/beam], stokesQmax [uJy/beam], stokesUmax [uJy/beam], stokesVrms [uJy/beam]: {freq * 1e6}, {stokesImax * 1e6}, {stokesQmax * 1e6}, {stokesUmax * 1e6}, {stokesVrms * 1e6}")
-        except:
-            info(f"Channel is nan: {ii + 1}")
+    chanIdx, position = get_first_peak_position(dataCube, validChanIdxList, stokesIdx=get_stokesIdx(conf, "I"))
+    info(f"Found max value in channel {chanIdx + 1} at coordinates: x = {position[0]}, y = {position[1]}")
 
-    info(SEPERATOR)
+    stokesIQU = get_spectra(dataCube, [position], chanIdxList=validChanIdxList, stokesIdxList=get_stokesIdxList(conf, "IQU"), chanChunkSize=int(conf.env.rmsyChanChunkSize))[:, :, 0]
+    # the noise comes from the flagging Stokes, V by default
+    stokesVrms = get_box_rms(dataCube, position, rmsBoxSize, chanIdxList=validChanIdxList, stokesIdx=get_stokesIdx(conf, get_flaggingStokes(conf)))
     hudCube.close()
+
+    firstFreq = get_firstFreq(conf)
+    freqArray = firstFreq + conf.input.outputChanBandwidth * np.array(validChanIdxList)
+    validMask = np.isfinite(stokesIQU).all(axis=0) & np.isfinite(stokesVrms)
+    for ii in np.array(validChanIdxList)[~validMask]:
+        info(f"Channel is nan: {ii + 1}")
+    info(f"Extracted spectra with {np.sum(validMask)} channels.")
+
+    info(SEPERATOR)
     statsDict = dict()
-    statsDict["frequency"] = freqList
-    statsDict["stokesImaxList"] = stokesImaxList
-    statsDict["stokesQmaxList"] = stokesQmaxList
-    statsDict["stokesUmaxList"] = stokesUmaxList
-    statsDict["stokesVrmsList"] = stokesVrmsList
+    statsDict["frequency"] = list(freqArray[validMask])
+    statsDict["stokesImaxList"] = list(stokesIQU[0][validMask])
+    statsDict["stokesQmaxList"] = list(stokesIQU[1][validMask])
+    statsDict["stokesUmaxList"] = list(stokesIQU[2][validMask])
+    statsDict["stokesVrmsList"] = list(stokesVrms[validMask])
     write_statistics_file(statsDict, conf)
 
 
@@ -149,6 +127,9 @@ def main():
     conf = get_config_in_dot_notation(templateFilename=FILEPATH_CONFIG_TEMPLATE, configFilename=FILEPATH_CONFIG_USER)
 #    statsDict = get_dict_from_tabFile(FILEPATH_STATISTICS)
 #    initialStatsDict = dict(statsDict)  # make a deep copy
+    if get_stokesIdxList(conf, "IQU") is None:
+        info(f"No Stokes I, Q and U in the cube (stokes = {conf.input.stokes}). Skipping, not generating RM synthesis input data.")
+        return
     get_rmsyDict_from_cube(conf)
 
 
@@ -17,7 +17,12 @@ from glob import glob
 import os
 
 from scipy import *
-from frocc.lhelpers import get_std_via_mad, get_config_in_dot_notation, main_timer, update_CRPIX3, SEPERATOR, run_command_with_logging, get_dict_from_tabFile, format_legend
+from frocc.lhelpers import get_std_via_mad, get_config_in_dot_notation, main_timer, update_CRPIX3, SEPERATOR, run_command_with_logging, get_dict_from_tabFile, format_legend, get_flaggingStokes, get_rmsStokesList
+from frocc.channel_index import get_cube_validityIndex_filepath, update_cube_validity_index
+from frocc.cube_verify import update_checksum_index
+from frocc.cube_quantise import write_quantised_cube
+from frocc.cube_compress import get_compressedCube_filepath, replace_compressed_tiles
+from frocc.cube_store import get_cubeStore_dirpath, read_store_metadata, delete_store_channel
 from frocc.config import FILEPATH_CONFIG_TEMPLATE, FILEPATH_CONFIG_USER
 from logging import info, error
 import subprocess
@@ -45,28 +50,29 @@ sns.set_style("ticks")
 
 def write_statistics_file(statsDict, conf):
     """
-    Takes the dictionary with Stokes I and V RMS noise and writes it to a file.
+    Takes the dictionary with the Stokes I and flagging Stokes RMS noise and
+    writes it to a file.
 
     Parameters
     ----------
     rmdDict: dict of lists with floats
-       Dictionary with lists for Stokes I and V rms noise
+       Dictionary with lists for Stokes I and flagging Stokes rms noise
 
     """
     filepathStatistics = conf.input.basename + conf.env.extCubeIORStatistics
-    legendList = ["chanNo", "frequency [MHz]",  "rmsStokesI [uJy/beam]", "rmsStokesV [uJy/beam]", "maxStokesI [uJy/beam]", "flagged"]
+    rmsStokesList = get_rmsStokesList(conf)
+    legendList = ["chanNo", "frequency [MHz]"] + [f"rmsStokes{stokes} [uJy/beam]" for stokes in rmsStokesList] + ["maxStokesI [uJy/beam]", "flagged"]
     info("Writing statistics file: %s", filepathStatistics)
     with open(filepathStatistics, "w") as csvFile:
         writer = csv.writer(csvFile, delimiter="\t")
         csvData = [legendList]
-        for i, entry in enumerate(statsDict["rmsStokesI"]):
+        for i, entry in enumerate(statsDict["chanNo"]):
             chanNo = statsDict['chanNo'][i]
-            rmsI = round(statsDict["rmsStokesI"][i], 4)
-            rmsV = round(statsDict["rmsStokesV"][i], 4)
+            rmsList = [round(statsDict["rmsStokes" + stokes][i], 4) for stokes in rmsStokesList]
             flagged = statsDict['flagged'][i]
             maxI = round(statsDict["maxStokesI"][i], 4)
             freq = round(statsDict["frequency"][i], 4)
-            csvData.append([chanNo, freq, rmsI, rmsV, maxI, flagged])
+            csvData.append([chanNo, freq] + rmsList + [maxI, flagged])
         writer.writerows(csvData)
     # also copy ior-flagged statistics file in dirOutput
             # code when Exception occur
@@ -90,7 +96,7 @@ def get_yDataFit(xData, a, b, c, d):
 def plot_all(statsDict, yDataFit, std, outlierIndexSet, iteration, conf):
     xData = statsDict['chanNo']
     x2Data = np.array(statsDict['frequency']) /1000  # conver to GHz
-    yData = statsDict['rmsStokesV']
+    yData = statsDict['rmsStokes' + get_flaggingStokes(conf)]
     fig, ax1 = plt.subplots(figsize=(16,7.5))
     ax1.set_title(r'Iterative outlier rejection, iteration ' + str(iteration))
     ax1.set_xlabel(r'channel',fontsize=22)
@@ -195,7 +201,7 @@ def get_flaggedIndexList_for_nan_and_zero(xData, yData):
 
 def get_outlierIndex_and_fitStats_dict(statsDict, conf):
     xData = statsDict['chanNo']
-    yData = statsDict['rmsStokesV']
+    yData = statsDict['rmsStokes' + get_flaggingStokes(conf)]
     resultsDict = {}
     resultsDict['xData'] = xData
     resultsDict['yData'] = yData
@@ -256,6 +262,22 @@ def flag_chan_in_cube_by_chanNoList(chanNoList, conf, mode="normal"):
     if conf.input.ignoreStokesVFlagging:
         info("ignoreStokesVFlagging flag is set! NOT APPLYING FLAGGING TO CHANNELS!")
         info("Attention: Plots and report will show flagged channels and statistics as if the flagging has been applied.")
+    if not conf.input.ignoreStokesVFlagging:
+        replace_compressed_tiles(conf, chanNoList, mode=mode)
+    if conf.input.cubeStore and not conf.input.ignoreStokesVFlagging:
+        dirpathStore = get_cubeStore_dirpath(conf, mode=mode)
+        stokesCount = read_store_metadata(dirpathStore)["shape"][0]
+        for chanNo in chanNoList:
+            info(f"Flagging chanNo {chanNo} in cube store: {dirpathStore}")
+            delete_store_channel(dirpathStore, int(chanNo) - 1, stokesCount)
+    if not os.path.exists(cubeName):
+        # only the tile-compressed cube or the cube store was kept
+        info(f"Fits cube not found, not flagging it: {cubeName}")
+        if not conf.input.ignoreStokesVFlagging:
+            update_cube_validity_index(conf, chanNoList, mode=mode)
+            if conf.input.cubeStore:
+                update_checksum_index(conf, chanNoList, mode=mode)
+        return
     info(SEPERATOR)
     info("Opening data cube: %s", cubeName)
     # TODO: debug: if ignore_missing_end is not true I get an error.
@@ -269,8 +291,14 @@ def flag_chan_in_cube_by_chanNoList(chanNoList, conf, mode="normal"):
             info(f"Flagging chanNo {chanNo}")
             dataCube[:, idx, :, :] = np.nan
     hudCube.close()
+    if not conf.input.ignoreStokesVFlagging:
+        update_cube_validity_index(conf, chanNoList, mode=mode)
+        update_checksum_index(conf, chanNoList, mode=mode)
 
     update_CRPIX3(cubeName)
+    if conf.input.quantisedCube:
+        info(SEPERATOR)
+        write_quantised_cube(conf, mode=mode)
 
     info(SEPERATOR)
     os.environ['OMP_NUM_THREADS'] = str(conf.env.hdf5ConverterMaxCpuCores)
@@ -278,26 +306,33 @@ def flag_chan_in_cube_by_chanNoList(chanNoList, conf, mode="normal"):
     hdf5Outputfile = os.path.join(conf.input.dirHdf5Output, os.path.basename(cubeName.replace(".fits", '.hdf5')))
     command = " ".join([conf.input.hdf5Converter, "-o", hdf5Outputfile, cubeName])
     run_command_with_logging(command)
+    if conf.input.sparseCube:
+        # the holes of the sparse cube read as 0 in the hdf5 file as well, the
+        # validity index next to it is their channel mask
+        filepathIndex = get_cube_validityIndex_filepath(conf, mode=mode)
+        if os.path.exists(filepathIndex):
+            try:
+                shutil.copyfile(filepathIndex, os.path.join(conf.input.dirHdf5Output, os.path.basename(filepathIndex)))
+            except shutil.SameFileError:
+                pass
 
 def get_only_newly_flagged_chanNoList(initialStatsDict, outlierChanNoList):
     '''
-    TODO: implement when time!
-    TODO: not optimzed yet. This goes through the whole cube even if flagged
-    channels are known from the previous statistics
+    Removes the channels from outlierChanNoList that are already flagged in the
+    cube since the cube creation. Those channels are NaN (or unallocated in a
+    sparse cube) and do not need to be touched again.
     '''
-    #chanNoList = []
-    #for chanNo, flagged in zip(initialStatsDict['chanNo'], initialStatsDict['flagged']):
-    #    if not flagged and (chanNo in outlierChanNoList):
-    #        chanNoList.append(chanNo)
-    #return chanNoList
-    return outlierChanNoList
+    initiallyFlaggedChanNoSet = set([
+        chanNo for chanNo, flagged in zip(initialStatsDict['chanNo'], initialStatsDict['flagged']) if flagged
+    ])
+    return [chanNo for chanNo in outlierChanNoList if chanNo not in initiallyFlaggedChanNoSet]
 
 @main_timer
 def main():
     conf = get_config_in_dot_notation(templateFilename=FILEPATH_CONFIG_TEMPLATE, configFilename=FILEPATH_CONFIG_USER)
     filepathStatistics = conf.input.basename + conf.env.extCubeStatistics
     statsDict = get_dict_from_tabFile(filepathStatistics)
-    initialStatsDict = dict(statsDict)  # make a deep copy
+    initialStatsDict = {key: list(value) for key, value in statsDict.items()}  # make a deep copy
     resultsDict = get_outlierIndex_and_fitStats_dict(statsDict, conf)
     a, b, c, d = resultsDict['fitCoefficients']
     std = resultsDict['sigmaRMS']
@@ -312,7 +347,7 @@ def main():
     # TODO: make this nicer
     flag_chan_in_cube_by_chanNoList(outlierChanNoList, conf, mode="normal")
     # TODO maybe try a better if-clause
-    if os.path.exists(os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeSmoothedFits)):
+    if os.path.exists(os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeSmoothedFits)) or os.path.exists(get_compressedCube_filepath(conf, mode="smoothed")) or os.path.exists(get_cubeStore_dirpath(conf, mode="smoothed")):
         flag_chan_in_cube_by_chanNoList(outlierChanNoList, conf, mode="smoothed")
 
 if __name__ == "__main__":
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+'''
+Quantised copy of the fits cube with scaled int16 or int32 data, e.g. for the
+transfer to the archive. It takes a half (int16) or the same (int32) number of
+bytes as the float32 cube.
+
+Every plane [stokes, chan, :, :] gets its own linear scaling
+value = BZERO + BSCALE * integer. Fits allows only one BSCALE and BZERO per
+HDU, so the primary header has BSCALE = 1, BZERO = 0 and the scaling of all
+planes is stored in the binary table extension QUANTISE (columns chanNo,
+stokesIdx, BSCALE, BZERO). NaN is stored as the BLANK value, the most negative
+integer. read_quantised_channel returns the dequantised float32 data.
+
+The BSCALE of a plane is the larger of
+  - the range step (max - min) / (2 * (2**(bits - 1) - 1)), so that the
+    finite values of the plane never get clipped, and
+  - quantisationStep times the channel noise (RMS of the flagging Stokes,
+    Stokes V by default, from the cube validity index), if
+    conf.input.quantisationStep > 0.
+BZERO is the centre of the range of the plane.
+
+Error bounds: every dequantised value differs from the float32 value by at
+most BSCALE / 2, the quantisation error is uniform with an RMS of
+BSCALE / sqrt(12). With a noise relative step q the error is at most q / 2
+times the channel noise, e.g. q = 0.5 adds 0.144 sigma in quadrature
+(0.5 / sqrt(12)), i.e. 1 % more noise. A plane whose range needs a larger
+step than q sigma is limited by the range step instead. In int16 this happens
+at a dynamic range (max - min) / sigma above 2 * 32767 * q. NaN values are
+restored exactly.
+'''
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+
+from frocc.channel_index import get_cube_filepath, get_hole_chanNoList, read_cube_validity_index
+from frocc.image_catalogue import read_fits_header_block
+from frocc.lhelpers import allocate_fits_file
+from frocc.plane_io import pread_into, swap_native_inplace
+from frocc.logger import *
+
+
+QUANTISED_DTYPE_DICT = {"int16": np.dtype(">i2"), "int32": np.dtype(">i4")}
+QUANTISE_EXTNAME = "QUANTISE"
+
+
+def get_quantisedCube_filepath(conf, mode="normal"):
+    '''
+    Path of the quantised copy of the normal or smoothed cube.
+    '''
+    if mode == "smoothed":
+        return os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeSmoothedQuantisedFits)
+    return os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeQuantisedFits)
+
+
+def get_quantisation_limits(dtype):
+    '''
+    Largest integer used for data and the BLANK integer for NaN.
+    '''
+    bits = np.dtype(dtype).itemsize * 8
+    return 2**(bits - 1) - 1, -2**(bits - 1)
+
+
+def get_plane_scaling(plane, dtype, noise=np.nan, quantisationStep=0.):
+    '''
+    BSCALE and BZERO of one plane, see the module docstring.
+
+    Returns
+    -------
+    [bscale, bzero]: list of floats
+       [1.0, 0.0] if the plane has no finite values.
+
+    '''
+    finitePlane = plane[np.isfinite(plane)]
+    if finitePlane.size == 0:
+        return [1.0, 0.0]
+    qmax = get_quantisation_limits(dtype)[0]
+    vmin, vmax = float(np.min(finitePlane)), float(np.max(finitePlane))
+    bscale = (vmax - vmin) / (2. * qmax)
+    if quantisationStep > 0 and np.isfinite(noise) and noise > 0:
+        bscale = max(bscale, quantisationStep * noise)
+    if bscale == 0:
+        # constant plane, it is restored exactly from BZERO
+        bscale = 1.0
+    return [bscale, (vmax + vmin) / 2.]
+
+
+def quantise_plane(plane, bscale, bzero, dtype):
+    '''
+    Integers of a float plane in the byte order of `dtype`, with BLANK for
+    non-finite values.
+    '''
+    qmax, blank = get_quantisation_limits(dtype)
+    with np.errstate(invalid="ignore"):
+        quantised = np.rint((plane.astype(np.float64) - bzero) / bscale)
+    finiteMask = np.isfinite(quantised)
+    np.clip(quantised, -qmax, qmax, out=quantised)
+    quantised[~finiteMask] = blank
+    return quantised.astype(dtype)
+
+
+def dequantise_plane(quantised, bscale, bzero):
+    '''
+    Float32 values of an integer plane, NaN for BLANK.
+    '''
+    blank = get_quantisation_limits(quantised.dtype)[1]
+    plane = (quantised.astype(np.float64) * bscale + bzero).astype(np.float32)
+    plane[quantised == blank] = np.nan
+    return plane
+
+
+def quantise_chunk(filepathCube, filepathQuantised, chanNoList, noiseList, holeChanNoList, quantisationStep):
+    '''
+    Quantises the channels in chanNoList of the cube into the allocated
+    quantised cube. The channels in holeChanNoList are not read but written
+    as BLANK, they are holes of a sparse cube. Runs in a worker process,
+    every worker writes disjoint planes with pwrite.
+
+    Returns
+    -------
+    scalingList: list
+       [chanNo, stokesIdx, bscale, bzero] for every written plane.
+
+    '''
+    cubeHeader, cubeDataOffset = read_fits_header_block(filepathCube)
+    quantisedHeader, quantisedDataOffset = read_fits_header_block(filepathQuantised)
+    dtype = np.dtype(">i" + str(abs(quantisedHeader["BITPIX"]) // 8))
+    stokesCount, chanCount, height, width = [cubeHeader[f"NAXIS{axis}"] for axis in (4, 3, 2, 1)]
+    plane = np.empty((height, width), dtype=np.float32)
+    scalingList = []
+    cubeFd = os.open(filepathCube, os.O_RDONLY)
+    quantisedFd = os.open(filepathQuantised, os.O_RDWR)
+    try:
+        for chanNo, noise in zip(chanNoList, noiseList):
+            for stokesIdx in range(0, stokesCount):
+                planeIdx = stokesIdx * chanCount + chanNo - 1
+                if chanNo in holeChanNoList:
+                    plane.fill(np.nan)
+                else:
+                    pread_into(cubeFd, plane, cubeDataOffset + planeIdx * plane.nbytes)
+                    swap_native_inplace(plane)
+                bscale, bzero = get_plane_scaling(plane, dtype, noise=noise, quantisationStep=quantisationStep)
+                view = memoryview(quantise_plane(plane, bscale, bzero, dtype)).cast("B")
+                offset = quantisedDataOffset + planeIdx * height * width * dtype.itemsize
+                while view:
+                    written = os.pwrite(quantisedFd, view, offset)
+                    view = view[written:]
+                    offset += written
+                scalingList.append([chanNo, stokesIdx, bscale, bzero])
+    finally:
+        os.close(cubeFd)
+        os.close(quantisedFd)
+    return scalingList
+
+
+def get_channel_noiseDict(conf, mode="normal"):
+    '''
+    Noise in [Jy/beam] per chanNo from the cube validity index, empty without
+    index.
+    '''
+    indexDict = read_cube_validity_index(conf, mode=mode)
+    if not indexDict:
+        return {}
+    return dict(zip(indexDict["chanNo"], indexDict["rmsNoise"]))
+
+
+def write_quantised_cube(conf, mode="normal"):
+    '''
+    Writes the quantised copy of the cube with conf.input.quantisedCube as
+    integer type, the channels are quantised in chunks in a process pool.
+    '''
+    dtype = QUANTISED_DTYPE_DICT[conf.input.quantisedCube]
+    filepathCube = get_cube_filepath(conf, mode=mode)
+    filepathQuantised = get_quantisedCube_filepath(conf, mode=mode)
+    quantisationStep = float(conf.input.quantisationStep)
+    info(f"Writing {conf.input.quantisedCube} quantised cube with quantisation step {quantisationStep} sigma: {filepathQuantised}")
+
+    header = read_fits_header_block(filepathCube)[0]
+    dims = [header[f"NAXIS{axis}"] for axis in range(1, 5)]
+    header["BITPIX"] = dtype.itemsize * 8
+    header["BSCALE"] = (1.0, "per plane scaling in extension " + QUANTISE_EXTNAME)
+    header["BZERO"] = (0.0, "per plane scaling in extension " + QUANTISE_EXTNAME)
+    header["BLANK"] = get_quantisation_limits(dtype)[1]
+    header["EXTEND"] = True
+    header["QSTEP"] = (quantisationStep, "quantisation step in units of channel noise")
+    allocate_fits_file(filepathQuantised, header, dims, dtype=dtype)
+
+    noiseDict = get_channel_noiseDict(conf, mode=mode)
+    holeChanNoSet = set(get_hole_chanNoList(conf, mode=mode))
+    chanNoList = list(range(1, dims[2] + 1))
+    chunkSize = int(conf.env.quantiseChanChunkSize)
+    chunkList = [chanNoList[ii:ii + chunkSize] for ii in range(0, len(chanNoList), chunkSize)]
+    scalingList = []
+    with ProcessPoolExecutor(max_workers=int(conf.env.quantiseMaxCpuCores)) as executor:
+        futureList = [
+            executor.submit(
+                quantise_chunk, filepathCube, filepathQuantised, chunk, [noiseDict.get(chanNo, np.nan) for chanNo in chunk],
+                [chanNo for chanNo in chunk if chanNo in holeChanNoSet], quantisationStep,
+            )
+            for chunk in chunkList
+        ]
+        for future in futureList:
+            scalingList += future.result()
+
+    scalingArray = np.array(sorted(scalingList), dtype=np.float64).reshape(-1, 4)
+    tableHdu = fits.BinTableHDU.from_columns([
+        fits.Column(name="chanNo", format="J", array=scalingArray[:, 0].astype(np.int32)),
+        fits.Column(name="stokesIdx", format="I", array=scalingArray[:, 1].astype(np.int16)),
+        fits.Column(name="BSCALE", format="D", array=scalingArray[:, 2]),
+        fits.Column(name="BZERO", format="D", array=scalingArray[:, 3]),
+    ], name=QUANTISE_EXTNAME)
+    fits.append(filepathQuantised, tableHdu.data, tableHdu.header)
+    info(f"Quantised cube: {os.path.getsize(filepathQuantised)} bytes, float32 cube: {os.path.getsize(filepathCube)} bytes.")
+
+
+def read_quantised_channel(filepath, chanNo):
+    '''
+    Dequantised float32 data of one channel, shape (stokes, y, x), of a
+    quantised cube. The integers are read with pread, astropy can not memory
+    map data with BSCALE, BZERO and BLANK.
+    '''
+    header, dataOffset = read_fits_header_block(filepath)
+    dtype = np.dtype(">i" + str(abs(header["BITPIX"]) // 8))
+    stokesCount, chanCount, height, width = [header[f"NAXIS{axis}"] for axis in (4, 3, 2, 1)]
+    table = fits.getdata(filepath, extname=QUANTISE_EXTNAME)
+    quantisedPlane = np.empty((height, width), dtype=dtype)
+    channel = np.empty((stokesCount, height, width), dtype=np.float32)
+    fd = os.open(filepath, os.O_RDONLY)
+    try:
+        for row in table[table["chanNo"] == int(chanNo)]:
+            planeIdx = int(row["stokesIdx"]) * chanCount + int(chanNo) - 1
+            pread_into(fd, quantisedPlane, dataOffset + planeIdx * quantisedPlane.nbytes)
+            channel[row["stokesIdx"]] = dequantise_plane(quantisedPlane, row["BSCALE"], row["BZERO"])
+    finally:
+        os.close(fd)
+    return channel
@@ -23,6 +23,9 @@ import shutil
 import subprocess
 import numpy as np
 import getpass
+import json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import redirect_stdout
 from datetime import datetime
 from io import StringIO
 from jinja2 import Template
@@ -36,8 +39,13 @@ from astropy.io import fits
 import aplpy
 
 
-from frocc.lhelpers import get_channelNumber_from_filename, get_config_in_dot_notation, get_std_via_mad, main_timer, change_channelNumber_from_filename,  SEPERATOR, get_lowest_channelNo_with_data_in_cube, update_fits_header_of_cube, DotMap, get_dict_from_click_args, calculate_channelFreq_from_header, read_file_as_string, write_file_from_string, get_timestamp, run_command_with_logging, get_dict_from_tabFile, get_lowest_channelIdx_and_freq_with_data_in_cube
+from frocc.lhelpers import get_channelNumber_from_filename, get_config_in_dot_notation, get_std_via_mad, main_timer, change_channelNumber_from_filename,  SEPERATOR, get_lowest_channelNo_with_data_in_cube, update_fits_header_of_cube, DotMap, get_dict_from_click_args, calculate_channelFreq_from_header, read_file_as_string, write_file_from_string, get_timestamp, run_command_with_logging, get_dict_from_tabFile, get_lowest_channelIdx_and_freq_with_data_in_cube, get_stokesList
 from frocc.check_output import print_output
+from frocc.channel_index import get_lowest_channelIdx_and_freq_with_data, get_cube_validityIndex_filepath
+from frocc.cube_average_map import get_averageMap_labelList
+from frocc.image_catalogue import get_imageCatalogue_filepath, read_image_catalogue
+from frocc.preview_pyramid import get_preview_filepath
+from frocc.runtime_index import get_times_listDict, get_relevant_logFilepathList
 from frocc.config import FORMAT_LOGS_TIMESTAMP, FILEPATH_JINJA_TEMPLATE, FILEPATH_CONFIG_TEMPLATE, FILEPATH_CONFIG_USER
 from frocc.logger import *
 
@@ -46,7 +54,7 @@ os.environ['LC_ALL'] = "C.UTF-8"
 os.environ['LANG'] = "C.UTF-8"
 
 
-def send_email_via_api(conf, failed=False):
+def send_email_via_api(conf, failed=False, status=None):
     transferID = ''.join(random.choice(string.ascii_lowercase + string.digits) for _ in range(6))
     email = conf.input.email
     username = getpass.getuser().capitalize()
@@ -56,7 +64,8 @@ def send_email_via_api(conf, failed=False):
     else:
         subject = f"[ frocc ] New cube {conf.input.basename}"
         oneLineStatus = "the cube creation finished successfully."
-    status = get_frocc_check_output(conf)
+    if status is None:
+        status = get_frocc_check_output(conf)
     body = f'Hi {username},\n\n{oneLineStatus}\n\n```\n{status}\n```\n\nLieben Gruß,\nLennart\'s IDIA API'
 
     info(f"Sending report to {conf.input.email}")
@@ -82,27 +91,28 @@ def send_email_via_api(conf, failed=False):
 
 def generate_preview_jpg(conf, mode=None):
     '''
+    Renders the Stokes planes of the first valid channel. The plot is made
+    from the smallest fitting preview pyramid level written by buildcube, only
+    falling back to downsampling the full cube if no pyramid exists.
     '''
     if mode == "smoothed":
         filepath = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeAveragemapFits)
-        print(filepath)
         savePath = os.path.join(conf.env.dirReport, conf.input.basename + conf.env.extCubeAveragemapPreviewJpg)
-        print(savePath)
-        data, header = fits.getdata(filepath, header=True)
-        title = "Preview: Average map for Stokes I, scalar P, Stokes V"
+        title = f"Preview: Average map for {', '.join(get_averageMap_labelList(conf))}"
+        # the average map has only one channel
+        refChanIdx = 0
     else:
-        filepath = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeFits)
+        filepath = get_preview_filepath(conf, targetSize=512)
         savePath = os.path.join(conf.env.dirReport, conf.input.basename + conf.env.extCubePreviewJpg)
-        data, header = fits.getdata(filepath, header=True)
-        chanIdxFreqDict = get_lowest_channelIdx_and_freq_with_data_in_cube(filepath)
-        title = f"Preview: Cube with Stokes IQUV for channel index {chanIdxFreqDict['chanIdx']} at {round(float(chanIdxFreqDict['freq']),2)} GHz"
+        chanIdxFreqDict = get_lowest_channelIdx_and_freq_with_data(conf)
+        title = f"Preview: Cube with Stokes {''.join(get_stokesList(conf))} for channel index {chanIdxFreqDict['chanIdx']} at {round(float(chanIdxFreqDict['freq']),2)} GHz"
 #        title = f"Preview: Cube with Stokes IQUV for channel {header['CRPIX3']} at {round(float(header['CRVAL3'])*1e-9,2)} GHz"
+        refChanIdx = chanIdxFreqDict['chanIdx']
+    info(f"Generating preview from: {filepath}")
 
-
-    #refChanIdx = int(header['CRPIX3']) - 1
-    refChanIdx = get_lowest_channelNo_with_data_in_cube(filepath) - 1
-    imgCount = data.shape[0]
-    imSize = data.shape[-1]
+    header = fits.getheader(filepath)
+    imgCount = int(header['NAXIS4'])
+    imSize = int(header['NAXIS1'])
     if imSize >= 512:
         downsamplingFactor = imSize//512
     else:
@@ -131,17 +141,20 @@ def generate_preview_jpg(conf, mode=None):
 
 def get_frocc_check_output(conf):
     result = StringIO()
-    sys.stdout = result
-    print(SEPERATOR)
-    print(f"Working directory: {conf.data.workingDirectory}")
-    print(f"Slurm jobIDs: {', '.join(list(map(str,conf.data.slurmIDList)))}")
-    print_output()
+    with redirect_stdout(result):
+        print(SEPERATOR)
+        print(f"Working directory: {conf.data.workingDirectory}")
+        print(f"Slurm jobIDs: {', '.join(list(map(str,conf.data.slurmIDList)))}")
+        print_output()
     return result.getvalue()
 
-def write_jinja_reportTemplate(conf):
+def write_jinja_reportTemplate(conf, status=None, listobsFileList=None):
     #old_stdout = sys.stdout
-    status = get_frocc_check_output(conf)
-    listobsOutputList = [ read_file_as_string(s) for s in write_listobs_for_inputMS_and_get_filenames(conf) ]
+    if status is None:
+        status = get_frocc_check_output(conf)
+    if listobsFileList is None:
+        listobsFileList = write_listobs_for_inputMS_and_get_filenames(conf)
+    listobsOutputList = [ read_file_as_string(s) for s in listobsFileList ]
     timestamp = get_timestamp("%H:%M:%S")
     chanStatsDict = get_cube_channel_statsDict(conf)
     iorPlotFilePath = sorted(glob(os.path.join(conf.env.dirPlots, "*diagnostic-ior*pdf")))[-1]
@@ -190,65 +203,27 @@ def create_md_from_template(conf):
     write_file_from_string(filePathReportMD, reportMDString)
     
 
+def get_listobs_filepath(conf, inputMS):
+    return os.path.join(conf.env.dirReport, os.path.basename(os.path.splitext(inputMS)[0]) + conf.env.extShortListobs)
+
+def write_listobs_for_inputMS(conf, inputMS):
+    outFile = get_listobs_filepath(conf, inputMS)
+    info(f"Writing file: {outFile}")
+    command = f"{conf.env.commandCasa5} \"listobs(vis='{inputMS}', listfile='{outFile}', overwrite=True, verbose=False)\""
+    run_command_with_logging(command)
+    return outFile
+
 def write_listobs_for_inputMS_and_get_filenames(conf):
     filenameList = []
     info(f"Writing `listobs` file via CASA. CASA errors may not be reliable.")
     for inputMS in conf.input.inputMS:
-        outFile = os.path.join(conf.env.dirReport, os.path.basename(os.path.splitext(inputMS)[0]) + conf.env.extShortListobs)
-        filenameList.append(outFile)
-        info(f"Writing file: {outFile}")
-        command = f"{conf.env.commandCasa5} \"listobs(vis='{inputMS}', listfile='{outFile}', overwrite=True, verbose=False)\""
-        run_command_with_logging(command)
+        filenameList.append(write_listobs_for_inputMS(conf, inputMS))
     return filenameList
 
 
-def get_start_stop_delta_time_from_filepath(filepath):
-    contentString = read_file_as_string(filepath)
-    # matchString: 2020-05-27 15:07:14,566
-    matchString = r'[0-9]{4}-[0-9]{2}-[0-9]{2}\ [0-9]{2}:[0-9]{2}:[0-9]{2},[0-9]{3}'
-    dateList = re.findall(matchString, contentString)
-    if dateList:
-        start = datetime.strptime(dateList[0], FORMAT_LOGS_TIMESTAMP)
-        stop = datetime.strptime(dateList[-1], FORMAT_LOGS_TIMESTAMP)
-        delta = stop - start
-        return [start, stop, delta]
-    else:
-        return []
-
-
-def get_times_listDict(conf):
-    dataDict = {}
-    dataDict['runScript'] = []
-    dataDict['filepath'] = []
-    dataDict['timeStart'] = []
-    dataDict['timeStop'] = []
-    dataDict['timeDelta'] = []
-    logFilepathList = glob(os.path.join(conf.env.dirLogs, "*.err"))
-    relevantLogFilepathList = []
-    for slurmID in conf.data.slurmIDList:
-        relevantLogFilepathList += [s for s in logFilepathList if re.search(str(slurmID), s)]
-    tmpSort = []
-    keyTmpSort = []
-    for relevantLogFilepath in relevantLogFilepathList:
-        timesList = get_start_stop_delta_time_from_filepath(relevantLogFilepath)
-        if timesList:
-            tmpSort += [[timesList, relevantLogFilepath]]
-            keyTmpSort += [timesList[0]]
-    filepathTimesList = [x for _,x in sorted(zip(keyTmpSort, tmpSort))]
-    for filepathTimesList in filepathTimesList:
-        timesList, filepath = filepathTimesList
-        dataDict['filepath'].append(filepath)
-        dataDict['timeStart'].append(timesList[0])
-        dataDict['timeStop'].append(timesList[1])
-        dataDict['timeDelta'].append(timesList[2])
-        for runScript in conf.input.runScripts:
-            if runScript.replace(".py", "") in filepath:
-                dataDict['runScript'].append(runScript)
-    return dataDict
-
-def get_total_runtime_formated(conf):
-    #dataDict = {}
-    dataDict = get_times_listDict(conf)
+def get_total_runtime_formated(conf, dataDict=None):
+    if dataDict is None:
+        dataDict = get_times_listDict(conf)
     totalHours = sum([i.total_seconds() for i in dataDict['timeDelta']])/3600
     humanHours = dataDict['timeStop'][-1] - dataDict['timeStart'][0]
     humanHours = humanHours.total_seconds()/3600
@@ -311,8 +286,8 @@ def generate_max_stokesI_plot(conf):
 
 
 def generate_plot_runtimes(conf):
-    runtimeDict = get_total_runtime_formated(conf)
     dataDict = get_times_listDict(conf)
+    runtimeDict = get_total_runtime_formated(conf, dataDict=dataDict)
 
     fig, ax1 = plt.subplots(figsize=(8,10))
     ax1.set_title(f'Runtime frocc: On single node {runtimeDict["totalAuto"]}, {runtimeDict["humanAuto"]} wall time')
@@ -362,24 +337,136 @@ def get_cube_channel_statsDict(conf):
     dataDict['unflagged'] = imageCount - iorflaggedCount
     dataDict['flagged'] = sum(statsDict['flagged'])
     dataDict['ratio'] = int(round(dataDict['unflagged']/dataDict['total'] *100,0))
+    # restoring beam range from the channel image catalogue, in [arcsec]
+    beamMajList = []
+    if os.path.exists(get_imageCatalogue_filepath(conf)):
+        beamMajList = [entry['BMAJ'] * 3600 for entry in read_image_catalogue(conf).values() if np.isfinite(entry['BMAJ'])]
+    dataDict['beamMajMin'] = round(min(beamMajList), 2) if beamMajList else None
+    dataDict['beamMajMax'] = round(max(beamMajList), 2) if beamMajList else None
     return dataDict
 
 
-def report_all(conf):
-#    try:
-    if True:
+def get_report_plot_taskList(conf):
+    '''
+    Independent plot artifacts of the report. Each of them is rendered in its
+    own process.
+    '''
+    taskList = ["maxStokesI", "runtimes", "preview"]
+    if conf.input.smoothbeam:
+        taskList.append("previewSmoothed")
+    return taskList
+
+def get_report_task_io(conf, taskName):
+    '''
+    Returns the input and output filepaths of a report artifact. They are used
+    to decide whether a cached artifact is still up to date.
+    '''
+    if taskName == "maxStokesI":
+        inputList = [os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeIORStatistics)]
+        outputList = [os.path.join(conf.env.dirReport, conf.input.basename + conf.env.extCubeMaxStokesIPlotPdf)]
+    elif taskName == "runtimes":
+        inputList = sorted(get_relevant_logFilepathList(conf))
+        outputList = [os.path.join(conf.env.dirReport, conf.input.basename + conf.env.extRuntimePdf)]
+    elif taskName == "preview":
+        inputList = [get_preview_filepath(conf, targetSize=512), get_cube_validityIndex_filepath(conf)]
+        outputList = [os.path.join(conf.env.dirReport, conf.input.basename + conf.env.extCubePreviewJpg)]
+    elif taskName == "previewSmoothed":
+        inputList = [os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeAveragemapFits)]
+        outputList = [os.path.join(conf.env.dirReport, conf.input.basename + conf.env.extCubeAveragemapPreviewJpg)]
+    elif taskName.startswith("listobs:"):
+        inputMS = taskName.split(":", 1)[1]
+        inputList = [inputMS]
+        outputList = [get_listobs_filepath(conf, inputMS)]
+    return inputList, outputList
+
+def run_report_plot_task(taskName):
+    '''
+    Entry point for the process pool. The config is re-read in the worker
+    process instead of being pickled.
+    '''
+    conf = get_config_in_dot_notation(templateFilename=FILEPATH_CONFIG_TEMPLATE, configFilename=FILEPATH_CONFIG_USER)
+    if taskName == "maxStokesI":
         generate_max_stokesI_plot(conf)
+    elif taskName == "runtimes":
         generate_plot_runtimes(conf)
-        generate_max_stokesI_plot(conf)
+    elif taskName == "preview":
         generate_preview_jpg(conf)
-        if conf.input.smoothbeam:
-            generate_preview_jpg(conf, mode="smoothed")
-        write_jinja_reportTemplate(conf)
+    elif taskName == "previewSmoothed":
+        generate_preview_jpg(conf, mode="smoothed")
+    return taskName
+
+def get_filepath_signature(filepathList):
+    '''
+    Modification time and size of every file, used as cache key.
+    '''
+    signature = []
+    for filepath in filepathList:
+        if os.path.exists(filepath):
+            signature.append([filepath, os.path.getmtime(filepath), os.path.getsize(filepath)])
+        else:
+            signature.append([filepath, None, None])
+    return signature
+
+def read_report_cache(conf):
+    filepathCache = os.path.join(conf.env.dirReport, conf.input.basename + conf.env.extReportCache)
+    if not os.path.exists(filepathCache):
+        return {}
+    try:
+        with open(filepathCache) as f:
+            return json.load(f)
+    except ValueError:
+        warning(f"Ignoring unreadable report cache: {filepathCache}")
+        return {}
+
+def write_report_cache(conf, cacheDict):
+    filepathCache = os.path.join(conf.env.dirReport, conf.input.basename + conf.env.extReportCache)
+    with open(filepathCache, "w") as f:
+        json.dump(cacheDict, f)
+
+def is_report_artifact_cached(conf, cacheDict, taskName):
+    inputList, outputList = get_report_task_io(conf, taskName)
+    if not all([os.path.exists(outFile) for outFile in outputList]):
+        return False
+    return cacheDict.get(taskName) == get_filepath_signature(inputList)
+
+def report_all(conf):
+    '''
+    Builds the report. Plots are rendered in a process pool and the `listobs`
+    calls run in a thread pool, concurrently with the output check. Artifacts
+    whose inputs did not change since the last run are taken from the cache.
+    The template, markdown and pdf are created after all artifacts exist.
+    '''
+#    try:
+    if True:
+        cacheDict = read_report_cache(conf)
+        plotTaskList = get_report_plot_taskList(conf)
+        listobsTaskList = ["listobs:" + inputMS for inputMS in conf.input.inputMS]
+        maxWorkers = max(1, int(conf.env.reportMaxCpuCores))
+        with ProcessPoolExecutor(max_workers=maxWorkers) as processPool, ThreadPoolExecutor(max_workers=maxWorkers) as threadPool:
+            futureDict = {}
+            for taskName in plotTaskList:
+                if is_report_artifact_cached(conf, cacheDict, taskName):
+                    info(f"Report artifact up to date, skipping: {taskName}")
+                    continue
+                futureDict[taskName] = processPool.submit(run_report_plot_task, taskName)
+            info(f"Writing `listobs` file via CASA. CASA errors may not be reliable.")
+            for taskName in listobsTaskList:
+                if is_report_artifact_cached(conf, cacheDict, taskName):
+                    info(f"Report artifact up to date, skipping: {taskName}")
+                    continue
+                futureDict[taskName] = threadPool.submit(write_listobs_for_inputMS, conf, taskName.split(":", 1)[1])
+            status = get_frocc_check_output(conf)
+            for taskName, future in futureDict.items():
+                future.result()
+                cacheDict[taskName] = get_filepath_signature(get_report_task_io(conf, taskName)[0])
+        write_report_cache(conf, cacheDict)
+        listobsFileList = [get_listobs_filepath(conf, inputMS) for inputMS in conf.input.inputMS]
+        write_jinja_reportTemplate(conf, status=status, listobsFileList=listobsFileList)
         create_md_from_template(conf)
         create_pdf_from_template(conf)
         info("Report created.")
         if conf.input.email:
-            send_email_via_api(conf)
+            send_email_via_api(conf, status=status)
     #except Exception as e:
     #    error("Report could not be created.")
     #    error(e)
@@ -0,0 +1,244 @@
+#!python3
+# -*- coding: utf-8 -*-
+"""
+------------------------------------------------------------------------------
+
+ This script generates a Faraday depth cube: the dirty Faraday dispersion
+ function (FDF) of every pixel of the data cube. RM synthesis is done as one
+ matrix product (phi x channels) @ (channels x pixels) per spatial tile. The
+ cube is streamed tile by tile, so the memory stays bounded by the tile size,
+ and every tile is written directly into the pre-allocated FDF cube.
+ Tiles run in parallel in a process pool and, with more than one slurm array
+ task, are distributed over several nodes.
+
+ FDF cube axes: [component, phi, y, x] with the components
+ 1: real part (Stokes Q), 2: imaginary part (Stokes U), 3: amplitude.
+
+------------------------------------------------------------------------------
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+import numpy as np
+from astropy.io import fits
+
+from frocc.lhelpers import get_config_in_dot_notation, main_timer, DotMap, get_dict_from_click_args, get_firstFreq, get_stokesIdxList, allocate_fits_file, run_once, SEPERATOR
+from frocc.channel_index import get_cube_filepath, read_cube_validity_index
+from frocc.image_catalogue import read_fits_header_block
+from frocc.config import FILEPATH_CONFIG_TEMPLATE, FILEPATH_CONFIG_USER
+from frocc.logger import *
+
+
+SPEED_OF_LIGHT = 299792458.0  # in m/s
+# seconds to wait for another array task to allocate the FDF cube
+ALLOCATION_TIMEOUT = 600
+
+
+def get_fdf_filepath(conf):
+    '''
+    '''
+    return os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeFdfFits)
+
+
+def get_phiArray(conf):
+    '''
+    Faraday depth grid in [rad/m^2] from -fdfPhiMax to +fdfPhiMax.
+    '''
+    phiMax = float(conf.input.fdfPhiMax)
+    phiStep = float(conf.input.fdfPhiStep)
+    return np.arange(-phiMax, phiMax + phiStep / 2., phiStep)
+
+
+def get_channel_lambdaSq_and_weights(conf, chanCount):
+    '''
+    Cube channel indexes, wavelength squared in [m^2] and weights of all
+    channels that go into the RM synthesis. With the cube validity index the
+    flagged channels are skipped and the channels are weighted by the inverse
+    variance of the flagging Stokes (V by default), otherwise all channels are weighted equally.
+    '''
+    indexDict = read_cube_validity_index(conf)
+    if indexDict:
+        chanIdxArray = np.array([chanNo - 1 for chanNo, valid in zip(indexDict["chanNo"], indexDict["valid"]) if valid])
+        freqArray = np.array(indexDict["frequency"])[chanIdxArray]
+        rmsArray = np.array(indexDict["rmsNoise"])[chanIdxArray]
+        weightArray = np.where(rmsArray > 0, 1. / rmsArray**2, 0.)
+    else:
+        chanIdxArray = np.arange(0, chanCount)
+        freqArray = get_firstFreq(conf) + conf.input.outputChanBandwidth * chanIdxArray
+        weightArray = np.ones(chanCount)
+    keepMask = weightArray > 0
+    return chanIdxArray[keepMask], (SPEED_OF_LIGHT / freqArray[keepMask])**2, weightArray[keepMask]
+
+
+def get_rmsynth_kernel(phiArray, lambdaSqArray, weightArray):
+    '''
+    Unnormalised RM synthesis kernel of shape (phi, channels):
+    w_i * exp(-2i * phi * (lambda_i^2 - lambda_0^2)).
+    '''
+    lambdaSq0 = np.sum(weightArray * lambdaSqArray) / np.sum(weightArray)
+    kernel = weightArray[np.newaxis, :] * np.exp(-2j * phiArray[:, np.newaxis] * (lambdaSqArray - lambdaSq0)[np.newaxis, :])
+    return kernel.astype(np.complex64)
+
+
+def get_tileList(conf, height, width):
+    '''
+    All tiles (yStart, yStop, xStart, xStop) of a height x width image.
+    '''
+    tileSize = int(conf.env.fdfTileSize)
+    tileList = []
+    for yStart in range(0, height, tileSize):
+        for xStart in range(0, width, tileSize):
+            tileList.append((yStart, min(yStart + tileSize, height), xStart, min(xStart + tileSize, width)))
+    return tileList
+
+
+def get_fdf_tile(dataCube, tile, chanIdxArray, kernel, weightArray, stokesIdxQ=1):
+    '''
+    Dirty FDF of one tile of shape (phi, y, x). NaN values are excluded per
+    pixel by normalising with the sum of the weights of the finite channels.
+    '''
+    yStart, yStop, xStart, xStop = tile
+    # Stokes Q and U are next to each other in every Stokes selection
+    qu = np.asarray(dataCube[stokesIdxQ:stokesIdxQ + 2, :, yStart:yStop, xStart:xStop])[:, chanIdxArray]
+    # Q and U are converted from big-endian directly into the complex array,
+    # without complex128 temporaries
+    pol = np.empty(qu.shape[1:], dtype=np.complex64)
+    pol.real = qu[0]
+    pol.imag = qu[1]
+    pol = pol.reshape(len(chanIdxArray), -1)
+    finiteMask = np.isfinite(pol)
+    pol[~finiteMask] = 0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        fdf = (kernel @ pol) / (weightArray.astype(np.float32) @ finiteMask)
+    return fdf.reshape(kernel.shape[0], yStop - yStart, xStop - xStart)
+
+
+def write_fdf_tile(fdfFilepath, tile, componentList):
+    '''
+    Writes the components (phi, y, x) of one tile to their byte offsets in
+    the FDF cube with pwrite. Tiles next to each other in x share the pages
+    of their rows. A memory map writes back whole pages, pwrite only the
+    bytes of the tile, so array tasks on different nodes can write
+    neighbouring tiles.
+    '''
+    yStart, yStop, xStart, xStop = tile
+    fdfHeader, fdfDataOffset = read_fits_header_block(fdfFilepath)
+    width, height, phiCount = [fdfHeader[f"NAXIS{axis}"] for axis in (1, 2, 3)]
+    # with the full width the rows of a tile are contiguous in the file
+    rowCount = yStop - yStart if (xStart, xStop) == (0, width) else 1
+    fd = os.open(fdfFilepath, os.O_WRONLY)
+    try:
+        for componentIdx, component in enumerate(componentList):
+            component = np.ascontiguousarray(component, dtype=">f4")
+            for phiIdx in range(0, phiCount):
+                for y in range(yStart, yStop, rowCount):
+                    view = memoryview(component[phiIdx, y - yStart:y - yStart + rowCount]).cast("B")
+                    offset = fdfDataOffset + 4 * (((componentIdx * phiCount + phiIdx) * height + y) * width + xStart)
+                    while view:
+                        written = os.pwrite(fd, view, offset)
+                        view = view[written:]
+                        offset += written
+    finally:
+        os.close(fd)
+
+
+def process_fdf_tile(cubeFilepath, fdfFilepath, tile, chanIdxArray, kernel, weightArray, stokesIdxQ=1):
+    '''
+    Reads one tile of the data cube, computes its FDF and writes it to the FDF
+    cube. Runs in a worker process, every worker opens both cubes itself.
+    '''
+    with fits.open(cubeFilepath, memmap=True, ignore_missing_end=True, mode="readonly") as hudCube:
+        fdf = get_fdf_tile(hudCube[0].data, tile, chanIdxArray, kernel, weightArray, stokesIdxQ=stokesIdxQ)
+    write_fdf_tile(fdfFilepath, tile, [fdf.real, fdf.imag, np.abs(fdf)])
+    return tile
+
+
+def get_fdf_header(cubeHeader, phiArray):
+    '''
+    Cube header with the frequency axis replaced by the Faraday depth and the
+    Stokes axis replaced by the FDF components.
+    '''
+    header = cubeHeader.copy()
+    header["CTYPE3"] = "FDEP"
+    header["CUNIT3"] = "rad/m^2"
+    header["CRPIX3"] = 1
+    header["CRVAL3"] = phiArray[0]
+    header["CDELT3"] = phiArray[1] - phiArray[0] if len(phiArray) > 1 else 1.
+    header["CTYPE4"] = "FDFCOMP"
+    header["CUNIT4"] = ""
+    header["CRPIX4"] = 1
+    header["CRVAL4"] = 1
+    header["CDELT4"] = 1
+    header["COMMENT"] = "FDF components: 1 real (Q), 2 imaginary (U), 3 amplitude"
+    return header
+
+
+def allocate_fdf_cube_once(fdfFilepath, header, dims):
+    '''
+    Allocates the FDF cube. With several slurm array tasks only the first one
+    to create the lock file allocates the cube, the others wait until the
+    allocation is done.
+    '''
+    lockFilepath = fdfFilepath + ".lock"
+    allocate = lambda: allocate_fits_file(fdfFilepath, header, dims)
+    if run_once(lockFilepath, allocate, timeout=ALLOCATION_TIMEOUT):
+        info(f"Allocated FDF cube with dimensions {dims}: {fdfFilepath}")
+        return
+    existingDims = [fits.getheader(fdfFilepath)[f"NAXIS{axis}"] for axis in range(1, len(dims) + 1)]
+    if existingDims != list(dims):
+        raise ValueError(f"Existing FDF cube has dimensions {existingDims} instead of {list(dims)}, remove {fdfFilepath} and {lockFilepath}")
+
+
+def make_fdf_cube(conf, arrayTaskIdx=0, arrayTaskCount=1):
+    '''
+    Computes the FDF of all tiles of this array task and writes them into the
+    FDF cube.
+    '''
+    cubeFilepath = get_cube_filepath(conf)
+    fdfFilepath = get_fdf_filepath(conf)
+    info(SEPERATOR)
+    stokesIdxListQU = get_stokesIdxList(conf, "QU")
+    if stokesIdxListQU is None:
+        info(f"No Stokes Q and U in the cube (stokes = {conf.input.stokes}). Skipping, not creating a Faraday depth cube.")
+        return
+    info(f"Generating Faraday depth cube from: {cubeFilepath}")
+    cubeHeader = fits.getheader(cubeFilepath)
+    width, height, chanCount = [cubeHeader[f"NAXIS{axis}"] for axis in (1, 2, 3)]
+    phiArray = get_phiArray(conf)
+    chanIdxArray, lambdaSqArray, weightArray = get_channel_lambdaSq_and_weights(conf, chanCount)
+    info(f"RM synthesis over {len(chanIdxArray)} channels and {len(phiArray)} Faraday depths from {phiArray[0]} to {phiArray[-1]} rad/m^2")
+    kernel = get_rmsynth_kernel(phiArray, lambdaSqArray, weightArray)
+
+    allocate_fdf_cube_once(fdfFilepath, get_fdf_header(cubeHeader, phiArray), (width, height, len(phiArray), 3))
+
+    tileList = get_tileList(conf, height, width)[arrayTaskIdx::arrayTaskCount]
+    maxWorkers = int(conf.env.fdfMaxCpuCores)
+    info(f"Processing {len(tileList)} tiles of {conf.env.fdfTileSize}x{conf.env.fdfTileSize} pixels with {maxWorkers} processes.")
+    with ProcessPoolExecutor(max_workers=maxWorkers) as executor:
+        futureList = [
+            executor.submit(process_fdf_tile, cubeFilepath, fdfFilepath, tile, chanIdxArray, kernel, weightArray, stokesIdxListQU[0])
+            for tile in tileList
+        ]
+        for ii, future in enumerate(futureList, 1):
+            tile = future.result()
+            info(f"Tile {ii}/{len(tileList)} done: y {tile[0]}-{tile[1]}, x {tile[2]}-{tile[3]}")
+
+
+@click.command(context_settings=dict(
+    ignore_unknown_options=True,
+    allow_extra_args=True,
+))
+@click.pass_context
+@main_timer
+def main(ctx):
+    args = DotMap(get_dict_from_click_args(ctx.args))
+    conf = get_config_in_dot_notation(templateFilename=FILEPATH_CONFIG_TEMPLATE, configFilename=FILEPATH_CONFIG_USER)
+    info(f"Scripts config: {conf}")
+    arrayTaskId = int(args.slurmArrayTaskId) if args.slurmArrayTaskId else 1
+    make_fdf_cube(conf, arrayTaskIdx=arrayTaskId - 1, arrayTaskCount=int(conf.env.fdfNodeCount))
+
+
+if __name__ == "__main__":
+    main()
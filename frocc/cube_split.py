@@ -26,6 +26,8 @@ import casatasks
 
 from frocc.config import FILEPATH_CONFIG_TEMPLATE, FILEPATH_CONFIG_USER
 from frocc.lhelpers import get_dict_from_click_args, DotMap, get_config_in_dot_notation, get_firstFreq, get_basename_from_path, SEPERATOR, SEPERATOR_HEAVY
+from frocc.channel_index import get_channel_freqRange, get_channel_visPath
+from frocc.workload import read_task_plan
 
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # SETTINGS
@@ -75,19 +77,11 @@ def call_split(channelNumber, conf, msIdx):
     '''
     info(f"Starting CASA split for MS and channelNumber: {conf.input.inputMS[msIdx]}, {channelNumber}")
 
-    firstFreq = get_firstFreq(conf)
     # TODO: bug with bandwidth?
-    startFreq = str(int(firstFreq) + int(conf.input.outputChanBandwidth) * (channelNumber - 1))
-    stopFreq = str(int(firstFreq) + int(conf.input.outputChanBandwidth) * channelNumber)
-    spw = "*:" + startFreq + "~" + stopFreq + "Hz"
+    startFreq, stopFreq = get_channel_freqRange(conf, channelNumber)
+    spw = "*:" + str(startFreq) + "~" + str(stopFreq) + "Hz"
     # generate outputMS filename from INPUT_MS filename
-    outputMS = (
-        conf.env.dirVis
-        + get_basename_from_path(conf.input.inputMS[msIdx])
-        + conf.env.markerChannel
-        + str(channelNumber).zfill(3)
-        + ".ms"
-    )
+    outputMS = get_channel_visPath(conf, channelNumber, msIdx)
     info(f"CASA split output file: {outputMS}")
     casatasks.split(
         vis=conf.input.inputMS[msIdx],
@@ -136,13 +130,14 @@ def main(ctx):
     conf = get_config_in_dot_notation(templateFilename=FILEPATH_CONFIG_TEMPLATE, configFilename=FILEPATH_CONFIG_USER)
     info("Scripts config: {0}".format(conf))
 
-    channelNumber = get_channelNumber_from_slurmArrayTaskId(args.slurmArrayTaskId, conf)
-
     # TODO: help: re-definition of casalog not working.
     # casatasks.casalog.setcasalog = conf.env.dirLogs + "cube_split_and_tclean-" + str(args.slurmArrayTaskId) + "-chan" + str(channelNumber) + ".casa"
 
-    msIdx = get_msIdx_from_slurmArrayTaskId(args.slurmArrayTaskId, conf)
-    call_split(channelNumber, conf, msIdx)
+    unitList = read_task_plan(conf, "cube_split.py", args.slurmArrayTaskId)
+    if unitList is None:
+        unitList = [[get_msIdx_from_slurmArrayTaskId(args.slurmArrayTaskId, conf), get_channelNumber_from_slurmArrayTaskId(args.slurmArrayTaskId, conf)]]
+    for msIdx, channelNumber in unitList:
+        call_split(channelNumber, conf, msIdx)
 
 
 if __name__ == "__main__":
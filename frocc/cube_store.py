@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+'''
+Chunked cube store in the Zarr (v2) directory format, an alternative to the
+assembled fits cube.
+
+The store is a directory with the array metadata `.zarray`, the attributes
+`.zattrs` and one chunk file per Stokes and channel plane, named
+"<stokesIdx>.<chanIdx>.0.0". The chunks are uncompressed big-endian float32,
+byte for byte the data of the plane in the fits cube. A chunk that does not
+exist reads as NaN (the fill value), so flagged and missing channels take no
+space.
+
+The store is created at setup from the planned channels. Every cube_tclean
+task writes the chunks of its channels right after imaging. A chunk is
+written to a temporary file and renamed into place, and every chunk has
+exactly one writer, so the tasks need no locking. buildcube only reads the
+chunks for the statistics, deletes the chunks of flagged channels, rewrites
+the chunks of polarisation corrected channels and writes the fits header into
+`.zattrs`. The store can be opened with zarr, `zarr.open(dirpath)`, or with
+open_cube.
+'''
+
+import json
+import os
+
+import numpy as np
+from astropy.io import fits
+
+from frocc.lhelpers import get_stokesList
+from frocc.channel_index import get_predicted_chanNoList, get_channel_imagePath
+from frocc.image_catalogue import get_image_entry, read_image_plane
+from frocc.plane_io import BIG_ENDIAN_DTYPE, get_plane_buffers, pread_into, swap_native_inplace, write_plane_bigendian
+from frocc.logger import *
+
+
+ZARRAY_FILENAME = ".zarray"
+ZATTRS_FILENAME = ".zattrs"
+
+
+def get_cubeStore_dirpath(conf, mode="normal"):
+    '''
+    Path of the chunked store of the normal or smoothed cube.
+    '''
+    if mode == "smoothed":
+        return os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeSmoothedStore)
+    return os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeStore)
+
+
+def get_planned_store_shape(conf):
+    '''
+    Shape (stokes, chan, y, x) of the store from the imaged Stokes parameters,
+    the highest planned channel and the tclean image size.
+    '''
+    imsize = conf.input.imsize
+    if isinstance(imsize, (list, tuple)):
+        xdim, ydim = int(imsize[0]), int(imsize[-1])
+    else:
+        xdim, ydim = int(imsize), int(imsize)
+    return [len(get_stokesList(conf)), max(get_predicted_chanNoList(conf)), ydim, xdim]
+
+
+def create_cube_store(conf, mode="normal"):
+    '''
+    Creates the empty store. An existing store with the same shape is kept
+    with its chunks, e.g. when the pipeline is restarted.
+    '''
+    dirpath = get_cubeStore_dirpath(conf, mode=mode)
+    shape = get_planned_store_shape(conf)
+    if os.path.exists(os.path.join(dirpath, ZARRAY_FILENAME)) and read_store_metadata(dirpath)["shape"] == shape:
+        info(f"Keeping existing cube store with shape {shape}: {dirpath}")
+        return
+    info(f"Creating cube store with shape {shape}: {dirpath}")
+    os.makedirs(dirpath, exist_ok=True)
+    metadata = {
+        "zarr_format": 2,
+        "shape": shape,
+        "chunks": [1, 1] + shape[2:],
+        "dtype": BIG_ENDIAN_DTYPE.str,
+        "compressor": None,
+        "fill_value": "NaN",
+        "order": "C",
+        "filters": None,
+        "dimension_separator": ".",
+    }
+    with open(os.path.join(dirpath, ZARRAY_FILENAME), "w") as f:
+        json.dump(metadata, f, indent=4)
+    with open(os.path.join(dirpath, ZATTRS_FILENAME), "w") as f:
+        json.dump({}, f)
+
+
+def read_store_metadata(dirpath):
+    with open(os.path.join(dirpath, ZARRAY_FILENAME)) as f:
+        return json.load(f)
+
+
+def get_chunk_filepath(dirpath, stokesIdx, chanIdx):
+    return os.path.join(dirpath, f"{stokesIdx}.{chanIdx}.0.0")
+
+
+def write_store_plane(dirpath, stokesIdx, chanIdx, plane):
+    '''
+    Writes one plane as chunk. The chunk appears only complete, through the
+    rename of the temporary file.
+    '''
+    filepathChunk = get_chunk_filepath(dirpath, stokesIdx, chanIdx)
+    filepathTmp = f"{filepathChunk}.{os.getpid()}.tmp"
+
+    def write_chunk(bigendianPlane):
+        with open(filepathTmp, "wb") as f:
+            f.write(memoryview(bigendianPlane).cast("B"))
+
+    write_plane_bigendian(write_chunk, plane)
+    os.replace(filepathTmp, filepathChunk)
+
+
+def read_store_plane(dirpath, stokesIdx, chanIdx, out):
+    '''
+    Reads one chunk into the native buffer `out`, NaN if the chunk does not
+    exist.
+    '''
+    try:
+        fd = os.open(get_chunk_filepath(dirpath, stokesIdx, chanIdx), os.O_RDONLY)
+    except FileNotFoundError:
+        out.fill(np.nan)
+        return out
+    try:
+        pread_into(fd, out, 0)
+    finally:
+        os.close(fd)
+    return swap_native_inplace(out)
+
+
+def read_store_sampled_plane(dirpath, shape, stokesIdx, chanIdx, step):
+    '''
+    Every `step`-th row of a chunk, None if the chunk does not exist. Only the
+    pages of these rows are read.
+    '''
+    filepathChunk = get_chunk_filepath(dirpath, stokesIdx, chanIdx)
+    if not os.path.exists(filepathChunk):
+        return None
+    data = np.memmap(filepathChunk, dtype=BIG_ENDIAN_DTYPE, mode="r", shape=tuple(shape[2:]))
+    plane = np.array(data[::int(step), :], dtype=np.float32)
+    del data
+    return plane
+
+
+def is_store_channel_written(dirpath, chanIdx, stokesCount):
+    return all([os.path.exists(get_chunk_filepath(dirpath, stokesIdx, chanIdx)) for stokesIdx in range(0, stokesCount)])
+
+
+def delete_store_channel(dirpath, chanIdx, stokesCount):
+    '''
+    Flags a channel: without chunks it reads as NaN.
+    '''
+    for stokesIdx in range(0, stokesCount):
+        filepathChunk = get_chunk_filepath(dirpath, stokesIdx, chanIdx)
+        if os.path.exists(filepathChunk):
+            os.remove(filepathChunk)
+
+
+def write_store_channel(conf, chanNo, mode="normal"):
+    '''
+    Writes all Stokes planes of the exported channel image into the store,
+    called by cube_tclean right after imaging.
+    '''
+    dirpath = get_cubeStore_dirpath(conf, mode=mode)
+    stokesCount, chanCount, ydim, xdim = read_store_metadata(dirpath)["shape"]
+    filepathImage = get_channel_imagePath(conf, chanNo, mode=mode)
+    try:
+        entry = get_image_entry(filepathImage, conf.env.markerChannel)
+    except (OSError, ValueError, KeyError) as e:
+        warning(f"Not writing channel {chanNo} into the cube store, channel image unreadable: {filepathImage}: {e}")
+        return
+    if chanNo > chanCount or (entry["NAXIS4"], entry["NAXIS2"], entry["NAXIS1"]) != (stokesCount, ydim, xdim):
+        warning(f"Not writing channel {chanNo} with shape {(entry['NAXIS4'], entry['NAXIS2'], entry['NAXIS1'])} into the cube store with shape {(stokesCount, chanCount, ydim, xdim)}: {dirpath}")
+        return
+    info(f"Writing channel {chanNo} into the cube store: {dirpath}")
+    plane, = get_plane_buffers((ydim, xdim), count=1)
+    for stokesIdx in range(0, stokesCount):
+        write_store_plane(dirpath, stokesIdx, chanNo - 1, read_image_plane(entry, stokesIdx, out=plane))
+
+
+def write_store_header(dirpath, header):
+    '''
+    Stores the fits header of the cube as list of [keyword, value, comment]
+    in `.zattrs`.
+    '''
+    cardList = [
+        [card.keyword, card.value if isinstance(card.value, (bool, int, float, str)) else str(card.value), card.comment]
+        for card in header.cards
+    ]
+    with open(os.path.join(dirpath, ZATTRS_FILENAME), "w") as f:
+        json.dump({"fitsHeader": cardList}, f, indent=1)
+
+
+def read_store_header(dirpath):
+    with open(os.path.join(dirpath, ZATTRS_FILENAME)) as f:
+        cardList = json.load(f).get("fitsHeader", [])
+    header = fits.Header()
+    for keyword, value, comment in cardList:
+        header.append((keyword, value, comment))
+    return header
+
+
+class CubeStoreSection:
+    '''
+    Read access to the store with the indexing of the memory mapped fits cube
+    data, e.g. section[stokesIdx, chanIdx, :, :]. Only the chunks of the
+    requested planes are read.
+    '''
+
+    def __init__(self, dirpath):
+        self.dirpath = dirpath
+        self.shape = tuple(read_store_metadata(dirpath)["shape"])
+        self.ndim = len(self.shape)
+        self.dtype = np.dtype(np.float32)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (self.ndim - len(key))
+        stokesIdxArray = np.arange(self.shape[0])[key[0]]
+        chanIdxArray = np.arange(self.shape[1])[key[1]]
+        plane, = get_plane_buffers(self.shape[2:], count=1)
+        data = np.array([
+            [np.array(read_store_plane(self.dirpath, stokesIdx, chanIdx, plane)[key[2], key[3]]) for chanIdx in np.atleast_1d(chanIdxArray)]
+            for stokesIdx in np.atleast_1d(stokesIdxArray)
+        ], dtype=np.float32)
+        # integer indices drop their axis
+        return data[tuple([0 if np.ndim(idxArray) == 0 else slice(None) for idxArray in (stokesIdxArray, chanIdxArray)])]
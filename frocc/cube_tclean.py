@@ -18,14 +18,19 @@ import logging
 import datetime
 import os
 from glob import glob
-from logging import info, error
+from logging import info, warning, error
 
 import click
 
 import casatasks 
 
 from frocc.config import FILEPATH_CONFIG_TEMPLATE, FILEPATH_CONFIG_USER
-from frocc.lhelpers import get_dict_from_click_args, DotMap, get_config_in_dot_notation, get_firstFreq, SEPERATOR, SEPERATOR_HEAVY
+from frocc.workload import read_task_plan
+from frocc.cube_cleanup import delete_channel_vis
+from frocc.channel_index import get_predicted_chanNoList
+from frocc.cube_store import write_store_channel
+from frocc.channel_sidecar import write_channel_sidecar
+from frocc.lhelpers import get_dict_from_click_args, DotMap, get_config_in_dot_notation, get_firstFreq, SEPERATOR, SEPERATOR_HEAVY, decode_channelNumber, encode_channelNumber, get_channelDigits
 
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # SETTINGS
@@ -132,19 +137,21 @@ def call_tclean(channelInputMS, channelNumber, conf):
         info(f"Exporting: {outSmoothedFits}")
         casatasks.exportfits(imagename=outSmoothedName, fitsimage=outSmoothedFits, overwrite=True)
 
+    # statistics for buildcube, while the exported images are in the page cache
+    if conf.input.channelStatisticsSidecar:
+        write_channel_sidecar(conf, int(channelNumber), mode="normal")
+        if conf.input.smoothbeam:
+            write_channel_sidecar(conf, int(channelNumber), mode="smoothed")
+
 
 def get_channelNumber_from_slurmArrayTaskId(slurmArrayTaskId, conf):
     '''
+    Channel of an array task from the predicted channels, not from the split
+    visibilities in $dirVis: with conf.input.cleanupStaged they get deleted
+    while other array tasks are still starting.
     '''
-    channelNoList = []
-    listing = glob(f"{conf.env.dirVis}/*{conf.env.markerChannel}*")
-    for filepath in listing:
-        # TODO: make this more generic, be carful with hard code 3 digits
-        startIndex = filepath.find(conf.env.markerChannel) + len(conf.env.markerChannel)
-        channelNoList.append(filepath[startIndex:startIndex+3])
-    channelNoList = sorted(list(set(channelNoList)))
-
-    return channelNoList[int(slurmArrayTaskId)-1]
+    channelNoList = get_predicted_chanNoList(conf)
+    return encode_channelNumber(channelNoList[int(slurmArrayTaskId)-1], get_channelDigits(conf))
 
 
 @click.command(context_settings=dict(
@@ -162,13 +169,27 @@ def main(ctx):
     conf = get_config_in_dot_notation(templateFilename=FILEPATH_CONFIG_TEMPLATE, configFilename=FILEPATH_CONFIG_USER)
     info("Scripts config: {0}".format(conf))
 
-    channelNumber = get_channelNumber_from_slurmArrayTaskId(args.slurmArrayTaskId, conf)
-
     # TODO: help: re-definition of casalog not working.
     # casatasks.casalog.setcasalog = conf.env.dirLogs + "cube_split_and_tclean-" + str(args.slurmArrayTaskId) + "-chan" + str(channelNumber) + ".casa"
 
-    channelInputMS = glob(f"{conf.env.dirVis}/*{conf.env.markerChannel}{channelNumber}*")
-    call_tclean(channelInputMS, channelNumber, conf)
+    unitList = read_task_plan(conf, "cube_tclean.py", args.slurmArrayTaskId)
+    if unitList is None:
+        channelNumberList = [get_channelNumber_from_slurmArrayTaskId(args.slurmArrayTaskId, conf)]
+    else:
+        channelNumberList = [encode_channelNumber(chanNo, get_channelDigits(conf)) for chanNo, in unitList]
+    for channelNumber in channelNumberList:
+        channelInputMS = glob(f"{conf.env.dirVis}/*{conf.env.markerChannel}{channelNumber}.ms")
+        if not channelInputMS:
+            warning(f"No split visibilities found for channel {channelNumber}, skipping.")
+            continue
+        call_tclean(channelInputMS, channelNumber, conf)
+        if conf.input.cubeStore:
+            # every channel has exactly one task writing its chunks
+            write_store_channel(conf, int(channelNumber), mode="normal")
+            if conf.input.smoothbeam:
+                write_store_channel(conf, int(channelNumber), mode="smoothed")
+        if conf.input.cleanupStaged:
+            delete_channel_vis(conf, int(channelNumber), channelInputMS)
 
 
 if __name__ == "__main__":
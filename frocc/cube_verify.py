@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+'''
+Integrity verification of the fits cubes, used by `frocc --verify` and before
+`cube_cleanup` deletes the intermediate data products.
+
+While a cube is filled, a CRC32 checksum, the NaN count and the sum of every
+channel (all Stokes planes) are written to the checksum index. Stages that
+change channels afterwards, e.g. the IOR flagging, update the index for these
+channels. The verification re-checksums the cube in channel chunks in a
+process pool and compares the result with the index. It also checks that the
+fits header matches the index and the file size, and that the HDF5 copy holds
+the same data as the fits cube. With conf.input.cubeStore the chunks of the
+cube store are checksummed instead of the fits cube.
+'''
+
+import csv
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+
+from frocc.channel_index import get_cube_filepath
+from frocc.cube_store import get_cubeStore_dirpath, read_store_metadata, read_store_plane, ZARRAY_FILENAME
+from frocc.plane_io import get_plane_buffers
+from frocc.logger import *
+
+
+CHECKSUM_INDEX_LEGEND = ["chanNo", "crc32", "nanCount", "sum"]
+FITS_BLOCK_SIZE = 2880
+
+
+def get_cube_checksumIndex_filepath(conf, mode="normal"):
+    '''
+    Path of the checksum index of the normal or smoothed cube.
+    '''
+    if mode == "smoothed":
+        return conf.input.basename + conf.env.extCubeSmoothedChecksumIndex
+    return conf.input.basename + conf.env.extCubeChecksumIndex
+
+
+def get_cube_hdf5_filepath(conf, mode="normal"):
+    '''
+    Path of the HDF5 copy of the normal or smoothed cube, as written by the
+    HDF5 converter in cube_ior_flagging.
+    '''
+    return os.path.join(conf.input.dirHdf5Output, os.path.basename(get_cube_filepath(conf, mode=mode).replace(".fits", ".hdf5")))
+
+
+def get_channel_checksum(channelData):
+    '''
+    Checksum of one cube channel of shape (stokes, y, x). The CRC32 is taken
+    over the big-endian float32 bytes, as stored in the fits cube, so the
+    checksum does not depend on the byte order of the array.
+
+    Returns
+    -------
+    [crc32, nanCount, sum]: list with int, int and float
+
+    '''
+    channelData = np.ascontiguousarray(channelData, dtype=">f4")
+    crc = zlib.crc32(channelData.tobytes()) & 0xffffffff
+    nanCount = int(np.count_nonzero(np.isnan(channelData)))
+    return [crc, nanCount, float(np.nansum(channelData, dtype=np.float64))]
+
+
+def write_checksum_index(conf, checksumDict, mode="normal"):
+    '''
+    Writes the checksum index of a cube.
+
+    Parameters
+    ----------
+    checksumDict: dict
+       chanNo as key and [crc32, nanCount, sum] as value.
+
+    '''
+    filepathIndex = get_cube_checksumIndex_filepath(conf, mode=mode)
+    info(f"Writing cube checksum index: {filepathIndex}")
+    with open(filepathIndex, "w") as csvFile:
+        writer = csv.writer(csvFile, delimiter="\t")
+        csvData = [CHECKSUM_INDEX_LEGEND]
+        for chanNo in sorted(checksumDict):
+            csvData.append([chanNo] + list(checksumDict[chanNo]))
+        writer.writerows(csvData)
+
+
+def read_checksum_index(conf, mode="normal"):
+    '''
+    Reads the checksum index of a cube into a dict with chanNo as key. Returns
+    an empty dict if the index does not exist.
+    '''
+    filepathIndex = get_cube_checksumIndex_filepath(conf, mode=mode)
+    if not os.path.exists(filepathIndex):
+        return {}
+    checksumDict = {}
+    with open(filepathIndex) as csvFile:
+        reader = csv.reader(csvFile, delimiter="\t")
+        next(reader)
+        for chanNo, crc, nanCount, total in reader:
+            checksumDict[int(chanNo)] = [int(crc), int(nanCount), float(total)]
+    return checksumDict
+
+
+def update_checksum_index(conf, chanNoList, mode="normal"):
+    '''
+    Re-checksums the channels in chanNoList, e.g. after the IOR flagging
+    overwrote them with NaN, and updates the checksum index.
+    '''
+    checksumDict = read_checksum_index(conf, mode=mode)
+    if not checksumDict or not chanNoList:
+        return
+    if conf.input.cubeStore:
+        checksumDict.update(get_store_checksum_chunk(get_cubeStore_dirpath(conf, mode=mode), [int(chanNo) for chanNo in chanNoList]))
+        write_checksum_index(conf, checksumDict, mode=mode)
+        return
+    with fits.open(get_cube_filepath(conf, mode=mode), memmap=True, ignore_missing_end=True, mode="readonly") as hudCube:
+        dataCube = hudCube[0].data
+        for chanNo in chanNoList:
+            checksumDict[int(chanNo)] = get_channel_checksum(dataCube[:, int(chanNo) - 1, :, :])
+    write_checksum_index(conf, checksumDict, mode=mode)
+
+
+def get_checksum_chunk(filepath, chanNoList, hdf5=False):
+    '''
+    Checksums of the channels in chanNoList of a fits cube or of its HDF5
+    copy. Runs in a worker process, every worker opens the file itself.
+    '''
+    if hdf5:
+        import h5py  # only needed for the HDF5 comparison
+        with h5py.File(filepath, "r") as hdf:
+            dataCube = hdf["0"]["DATA"]
+            return {chanNo: get_channel_checksum(dataCube[:, chanNo - 1, :, :]) for chanNo in chanNoList}
+    with fits.open(filepath, memmap=True, ignore_missing_end=True, mode="readonly") as hudCube:
+        dataCube = hudCube[0].data
+        return {chanNo: get_channel_checksum(dataCube[:, chanNo - 1, :, :]) for chanNo in chanNoList}
+
+
+def get_store_checksum_chunk(dirpath, chanNoList):
+    '''
+    Checksums of the channels in chanNoList of the cube store, read chunk by
+    chunk. A channel without chunks reads as NaN, like in the store.
+    '''
+    shape = read_store_metadata(dirpath)["shape"]
+    bufferList = get_plane_buffers(shape[2:], count=shape[0])
+    checksumDict = {}
+    for chanNo in chanNoList:
+        channel = [read_store_plane(dirpath, stokesIdx, chanNo - 1, bufferList[stokesIdx]) for stokesIdx in range(0, shape[0])]
+        checksumDict[chanNo] = get_channel_checksum(np.array(channel))
+    return checksumDict
+
+
+def get_cube_checksumDict(conf, filepath, chanNoList, hdf5=False, store=False):
+    '''
+    Checksums of all channels in chanNoList, computed in chunks of
+    conf.env.verifyChanChunkSize channels in a process pool.
+    '''
+    chunkSize = int(conf.env.verifyChanChunkSize)
+    chunkList = [chanNoList[ii:ii + chunkSize] for ii in range(0, len(chanNoList), chunkSize)]
+    checksumDict = {}
+    with ProcessPoolExecutor(max_workers=int(conf.env.verifyMaxCpuCores)) as executor:
+        if store:
+            resultIter = executor.map(get_store_checksum_chunk, [filepath] * len(chunkList), chunkList)
+        else:
+            resultIter = executor.map(get_checksum_chunk, [filepath] * len(chunkList), chunkList, [hdf5] * len(chunkList))
+        for chunkChecksumDict in resultIter:
+            checksumDict.update(chunkChecksumDict)
+    return checksumDict
+
+
+def get_header_problemList(filepathCube, chanCount):
+    '''
+    Problems with the fits header of the cube: dimensions that do not match
+    the checksum index or the file size.
+    '''
+    problemList = []
+    with open(filepathCube, "rb") as f:
+        header, headerSize = fits.Header.fromfile(f), f.tell()
+    if header.get("NAXIS") != 4 or header.get("BITPIX") != -32:
+        problemList.append(f"Expected a 4 dimensional float32 cube, header has NAXIS={header.get('NAXIS')} BITPIX={header.get('BITPIX')}")
+        return problemList
+    if header["NAXIS3"] != chanCount:
+        problemList.append(f"Header NAXIS3={header['NAXIS3']} does not match the {chanCount} channels in the checksum index")
+    dataSize = np.prod([header[f"NAXIS{axis}"] for axis in range(1, 5)], dtype=np.int64) * 4
+    dataSize = FITS_BLOCK_SIZE * ((dataSize - 1) // FITS_BLOCK_SIZE + 1)
+    fileSize = os.path.getsize(filepathCube)
+    if fileSize != headerSize + dataSize:
+        problemList.append(f"File size {fileSize} bytes does not match the header: {headerSize} bytes header and {dataSize} bytes data")
+    return problemList
+
+
+def get_checksum_problemList(checksumDict, expectedChecksumDict, label):
+    '''
+    Channels whose checksum differs from the expected one.
+    '''
+    problemList = []
+    for chanNo in sorted(expectedChecksumDict):
+        if checksumDict.get(chanNo) != expectedChecksumDict[chanNo]:
+            problemList.append(f"{label} channel {chanNo}: checksum {checksumDict.get(chanNo)} instead of {expectedChecksumDict[chanNo]}")
+    return problemList
+
+
+def verify_cube_store(conf, mode="normal"):
+    '''
+    Verifies the chunks of the cube store against the checksum index.
+    '''
+    dirpathStore = get_cubeStore_dirpath(conf, mode=mode)
+    info(f"Verifying cube store: {dirpathStore}")
+    if not os.path.exists(os.path.join(dirpathStore, ZARRAY_FILENAME)):
+        return [f"Cube store not found: {dirpathStore}"]
+    expectedChecksumDict = read_checksum_index(conf, mode=mode)
+    if not expectedChecksumDict:
+        return [f"Checksum index not found: {get_cube_checksumIndex_filepath(conf, mode=mode)}"]
+    chanNoList = sorted(expectedChecksumDict)
+    chanCount = read_store_metadata(dirpathStore)["shape"][1]
+    if chanNoList[-1] > chanCount:
+        return [f"Cube store has {chanCount} channels, the checksum index has channel {chanNoList[-1]}"]
+    return get_checksum_problemList(get_cube_checksumDict(conf, dirpathStore, chanNoList, store=True), expectedChecksumDict, "Store")
+
+
+def verify_cube(conf, mode="normal", checkHdf5=True):
+    '''
+    Verifies the fits cube, and its HDF5 copy if it exists, against the
+    checksum index. With conf.input.cubeStore the cube store is verified.
+
+    Returns
+    -------
+    problemList: list of str
+       Empty if the cube is consistent.
+
+    '''
+    if conf.input.cubeStore:
+        return verify_cube_store(conf, mode=mode)
+    filepathCube = get_cube_filepath(conf, mode=mode)
+    info(f"Verifying cube: {filepathCube}")
+    if not os.path.exists(filepathCube):
+        return [f"Cube not found: {filepathCube}"]
+    expectedChecksumDict = read_checksum_index(conf, mode=mode)
+    if not expectedChecksumDict:
+        return [f"Checksum index not found: {get_cube_checksumIndex_filepath(conf, mode=mode)}"]
+    chanNoList = sorted(expectedChecksumDict)
+
+    problemList = get_header_problemList(filepathCube, len(chanNoList))
+    if problemList:
+        return problemList
+    problemList += get_checksum_problemList(get_cube_checksumDict(conf, filepathCube, chanNoList), expectedChecksumDict, "FITS")
+
+    filepathHdf5 = get_cube_hdf5_filepath(conf, mode=mode)
+    if checkHdf5 and conf.input.dirHdf5Output and os.path.exists(filepathHdf5):
+        info(f"Verifying HDF5 copy: {filepathHdf5}")
+        try:
+            problemList += get_checksum_problemList(get_cube_checksumDict(conf, filepathHdf5, chanNoList, hdf5=True), expectedChecksumDict, "HDF5")
+        except ImportError:
+            warning(f"h5py not available, not verifying: {filepathHdf5}")
+    return problemList
+
+
+def verify(conf, checkHdf5=True):
+    '''
+    Verifies the normal and, if it exists, the smoothed cube.
+
+    Returns
+    -------
+    success: bool
+
+    '''
+    modeList = ["normal"]
+    if os.path.exists(get_cube_filepath(conf, mode="smoothed")) or (conf.input.cubeStore and os.path.exists(get_cubeStore_dirpath(conf, mode="smoothed"))):
+        modeList.append("smoothed")
+    success = True
+    for mode in modeList:
+        problemList = verify_cube(conf, mode=mode, checkHdf5=checkHdf5)
+        for problem in problemList:
+            error(problem)
+        if problemList:
+            success = False
+            error(f"Verification of the {mode} cube failed with {len(problemList)} problems.")
+        else:
+            info(f"Verification of the {mode} cube passed.")
+    return success
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+'''
+Catalogue of the exported tclean channel images.
+
+Only the header blocks of the channel images are read, in parallel, so the
+catalogue of thousands of channels is built in a fraction of a second. It
+holds everything the cube setup needs to know about a channel image without
+opening its data: shape, frequency, restoring beam, data type and the byte
+offset of the data section.
+'''
+
+import csv
+import os
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+
+import numpy as np
+from astropy.io import fits
+
+from frocc.lhelpers import decode_channelNumber, format_legend
+from frocc.plane_io import pread_into
+from frocc.logger import *
+
+
+IMAGE_CATALOGUE_LEGEND = ["chanNo", "path", "NAXIS1", "NAXIS2", "NAXIS3", "NAXIS4", "frequency [Hz]", "BMAJ [deg]", "BMIN [deg]", "BPA [deg]", "dtype", "dataOffset [bytes]"]
+FITS_BLOCK_SIZE = 2880
+BITPIX_DTYPE_DICT = {8: "u1", 16: ">i2", 32: ">i4", 64: ">i8", -32: ">f4", -64: ">f8"}
+
+
+def get_imageCatalogue_filepath(conf, mode="normal"):
+    '''
+    Path of the catalogue of the normal or smoothed channel images.
+    '''
+    if mode == "smoothed":
+        return conf.input.basename + conf.env.extImageSmoothedCatalogue
+    return conf.input.basename + conf.env.extImageCatalogue
+
+
+def read_fits_header_block(filepath):
+    '''
+    Reads only the primary header of a fits file, block by block until the
+    END card.
+
+    Returns
+    -------
+    [header, dataOffset]: list with astropy.io.fits.Header and int
+       dataOffset is the byte offset of the data section in the file.
+
+    '''
+    headerBytes = b""
+    with open(filepath, "rb") as f:
+        while True:
+            block = f.read(FITS_BLOCK_SIZE)
+            if len(block) < FITS_BLOCK_SIZE:
+                raise ValueError(f"No END card found in fits header: {filepath}")
+            headerBytes += block
+            # a header block holds 36 cards of 80 characters
+            if any([block[ii:ii + 80].rstrip() == b"END" for ii in range(0, FITS_BLOCK_SIZE, 80)]):
+                break
+    return [fits.Header.fromstring(headerBytes.decode("ascii")), len(headerBytes)]
+
+
+def get_image_entry(filepath, markerChannel):
+    '''
+    Catalogue entry of one channel image, as dict with the keys of
+    IMAGE_CATALOGUE_LEGEND (without units).
+    '''
+    header, dataOffset = read_fits_header_block(filepath)
+    return {
+        "chanNo": decode_channelNumber(filepath, markerChannel),
+        "path": filepath,
+        "NAXIS1": header.get("NAXIS1", 1),
+        "NAXIS2": header.get("NAXIS2", 1),
+        "NAXIS3": header.get("NAXIS3", 1),
+        "NAXIS4": header.get("NAXIS4", 1),
+        "frequency": header.get("CRVAL3", np.nan),
+        "BMAJ": header.get("BMAJ", np.nan),
+        "BMIN": header.get("BMIN", np.nan),
+        "BPA": header.get("BPA", np.nan),
+        "dtype": BITPIX_DTYPE_DICT[header["BITPIX"]],
+        "dataOffset": dataOffset,
+    }
+
+
+def write_image_catalogue(conf, entryList, mode="normal"):
+    filepathCatalogue = get_imageCatalogue_filepath(conf, mode=mode)
+    info(f"Writing channel image catalogue: {filepathCatalogue}")
+    keyList = [format_legend(legend) for legend in IMAGE_CATALOGUE_LEGEND]
+    with open(filepathCatalogue, "w") as csvFile:
+        writer = csv.writer(csvFile, delimiter="\t")
+        csvData = [IMAGE_CATALOGUE_LEGEND]
+        for entry in entryList:
+            csvData.append([entry[key] for key in keyList])
+        writer.writerows(csvData)
+
+
+def build_image_catalogue(conf, mode="normal"):
+    '''
+    Reads the headers of all channel images in conf.env.dirImages in parallel
+    and writes the image catalogue.
+
+    Returns
+    -------
+    catalogueDict: dict
+       chanNo as key and the catalogue entry as value, sorted by chanNo.
+
+    '''
+    if mode == "smoothed":
+        channelFitsfileList = glob(conf.env.dirImages + "*" + conf.env.extTcleanImageSmoothed)
+    else:
+        channelFitsfileList = glob(conf.env.dirImages + "*" + conf.env.extTcleanImage)
+    info(f"Reading the headers of {len(channelFitsfileList)} channel images.")
+    entryList = []
+    with ThreadPoolExecutor(max_workers=int(conf.env.imageCatalogueMaxWorkers)) as executor:
+        futureDict = {executor.submit(get_image_entry, filepath, conf.env.markerChannel): filepath for filepath in channelFitsfileList}
+        for future, filepath in futureDict.items():
+            try:
+                entryList.append(future.result())
+            except (OSError, ValueError, KeyError) as e:
+                # the channel gets flagged like a missing image
+                warning(f"Not adding unreadable channel image to catalogue: {filepath}: {e}")
+    entryList = sorted(entryList, key=lambda entry: entry["chanNo"])
+    write_image_catalogue(conf, entryList, mode=mode)
+    return {entry["chanNo"]: entry for entry in entryList}
+
+
+def read_image_catalogue(conf, mode="normal"):
+    '''
+    Reads the image catalogue into a dict with chanNo as key. Builds the
+    catalogue if it does not exist yet.
+    '''
+    filepathCatalogue = get_imageCatalogue_filepath(conf, mode=mode)
+    if not os.path.exists(filepathCatalogue):
+        return build_image_catalogue(conf, mode=mode)
+    keyList = [format_legend(legend) for legend in IMAGE_CATALOGUE_LEGEND]
+    catalogueDict = {}
+    with open(filepathCatalogue) as csvFile:
+        reader = csv.reader(csvFile, delimiter="\t")
+        next(reader)
+        for row in reader:
+            entry = dict(zip(keyList, row))
+            for key in ["chanNo", "NAXIS1", "NAXIS2", "NAXIS3", "NAXIS4", "dataOffset"]:
+                entry[key] = int(entry[key])
+            for key in ["frequency", "BMAJ", "BMIN", "BPA"]:
+                entry[key] = float(entry[key])
+            catalogueDict[entry["chanNo"]] = entry
+    return catalogueDict
+
+
+def read_image_plane(entry, stokesIdx, window=None, out=None):
+    '''
+    Reads the plane [stokesIdx, 0, :, :] of a channel image directly from the
+    file, without astropy. With window=(top, bottom, left, right) only the
+    column span of the rows inside the window is read, so the I/O scales with
+    the cropped area. The bytes are read straight into a native byte order
+    array, or into `out`, and swapped there in place.
+
+    Returns
+    -------
+    plane: numpy.ndarray
+       In the native byte order, e.g. float32.
+
+    '''
+    dtype = np.dtype(entry["dtype"])
+    rowStride = entry["NAXIS1"] * dtype.itemsize
+    planeOffset = entry["dataOffset"] + stokesIdx * entry["NAXIS3"] * entry["NAXIS2"] * rowStride
+    if window is None:
+        window = (0, entry["NAXIS2"], 0, entry["NAXIS1"])
+    top, bottom, left, right = window
+    shape = (bottom - top, right - left)
+    nativeDtype = dtype.newbyteorder("=")
+    if out is None or out.shape != shape or out.dtype != nativeDtype or not out.flags.c_contiguous:
+        out = np.empty(shape, dtype=nativeDtype)
+    fd = os.open(entry["path"], os.O_RDONLY)
+    try:
+        if left == 0 and right == entry["NAXIS1"]:
+            # full rows are contiguous in the file, read them in one go
+            pread_into(fd, out, planeOffset + top * rowStride)
+        else:
+            for row in range(top, bottom):
+                pread_into(fd, out[row - top], planeOffset + row * rowStride + left * dtype.itemsize)
+    finally:
+        os.close(fd)
+    if not dtype.isnative:
+        out.byteswap(inplace=True)
+    return out
@@ -8,11 +8,14 @@ import datetime
 import os
 import ast
 import functools
+import itertools
+import re
 import numpy as np
 from numpy import nan
 import inspect
 import subprocess
 import sys
+import time
 from astropy.io import fits
 #from frocc.logger import info, debug, error, warning
 
@@ -30,6 +33,13 @@ SEPERATOR_HEAVY = "="*79
 SEPERATOR_SOFT = "- " * 79
 SEPERATOR_SOFT = SEPERATOR_SOFT[:80]
 
+# minimum number of digits of the channel number in filenames, e.g. ".chan001"
+CHANNEL_DIGITS_MIN = 3
+
+# Stokes parameters that tclean can image into one image, in the order of the
+# W-axis of the cube
+VALID_STOKES_LIST = ["I", "Q", "U", "V", "IV", "QU", "IQ", "UV", "IQUV"]
+
 os.environ['LC_ALL'] = "C.UTF-8"
 os.environ['LANG'] = "C.UTF-8"
 
@@ -109,22 +119,54 @@ def get_config_in_dot_notation(templateFilename=FILEPATH_CONFIG_TEMPLATE, config
                 setattr(getattr(dot, section), key, str(value))
     return dot
 
-def get_channelNumber_from_filename(filename, marker, digits=3):
+def get_channelDigits(conf):
+    '''
+    Returns the number of digits used to encode channel numbers in filenames.
+    If `channelDigits` is not set in the config the width is derived from the
+    highest predicted output channel, but never less than CHANNEL_DIGITS_MIN.
+    '''
+    if conf.input.channelDigits:
+        return int(conf.input.channelDigits)
+    digits = CHANNEL_DIGITS_MIN
+    if conf.data and conf.data.predictedOutputChannels:
+        maxChanNo = max(itertools.chain(*conf.data.predictedOutputChannels))
+        digits = max(digits, len(str(maxChanNo)))
+    return digits
+
+def encode_channelNumber(chanNo, digits=CHANNEL_DIGITS_MIN):
+    '''
+    Channel number as zero padded string, e.g. 7 -> "007".
+    '''
+    chanId = str(int(chanNo)).zfill(digits)
+    if len(chanId) > digits:
+        raise ValueError(f"Channel number {chanNo} does not fit into {digits} digits.")
+    return chanId
+
+def decode_channelNumber(filename, marker):
+    '''
+    Channel number following the last `marker` in the basename of `filename`,
+    independent of the number of digits.
+    '''
+    matchList = re.findall(re.escape(marker) + r"([0-9]+)", os.path.basename(filename))
+    if not matchList:
+        raise ValueError(f"No channel number with marker '{marker}' in filename: {filename}")
+    return int(matchList[-1])
+
+def get_channelNumber_from_filename(filename, marker, digits=CHANNEL_DIGITS_MIN):
     '''
-    TODO: digits=3 -> len(marker)
     '''
-    markerChannelPositionEnd = int(filename.find(marker)) + len(marker)
-    chanNo = filename[markerChannelPositionEnd:markerChannelPositionEnd+digits]
-    return chanNo.zfill(digits)
+    return encode_channelNumber(decode_channelNumber(filename, marker), digits)
 
-def change_channelNumber_from_filename(filename, marker, newChanNo, digits=3):
+def change_channelNumber_from_filename(filename, marker, newChanNo, digits=CHANNEL_DIGITS_MIN):
     '''
-    TODO: digits=3 -> len(marker)
     '''
-    markerChannelPositionEnd = int(filename.find(marker)) + len(marker)
-    chanNo = filename[markerChannelPositionEnd:markerChannelPositionEnd+digits]
-    newFilename = filename.replace(marker+str(chanNo).zfill(digits), marker+str(newChanNo).zfill(digits))
-    return newFilename
+    basename = os.path.basename(filename)
+    matchList = list(re.finditer(re.escape(marker) + r"[0-9]+", basename))
+    if not matchList:
+        raise ValueError(f"No channel number with marker '{marker}' in filename: {filename}")
+    start, end = matchList[-1].span()
+    newBasename = basename[:start] + marker + encode_channelNumber(newChanNo, digits) + basename[end:]
+    return os.path.join(os.path.dirname(filename), newBasename)
 
 def main_timer(func):
     '''
@@ -188,10 +230,15 @@ def get_mad(a, axis=None):
        MAD from a
 
     """
+    # big-endian fits data gets converted once instead of in every operation
+    if not a.dtype.isnative:
+        a = a.astype(a.dtype.newbyteorder("="))
     # Median along given axis, but *keeping* the reduced axis so that
     # result can still broadcast against a.
-    med = np.nanmedian(a, axis=axis, keepdims=False)
-    mad = np.nanmedian(np.absolute(a - med), axis=axis)  # MAD along given axis
+    med = np.nanmedian(a, axis=axis, keepdims=True)
+    dev = a - med
+    np.absolute(dev, out=dev)
+    mad = np.nanmedian(dev, axis=axis)  # MAD along given axis
     return mad
 
 
@@ -216,6 +263,57 @@ def get_std_via_mad(npArray, axis=None):
     return std
 
 
+def get_stokesList(conf):
+    '''
+    Stokes parameters imaged by tclean, in the order of the W-axis of the cube,
+    e.g. ["I", "V"] for stokes = "IV".
+    '''
+    return list(str(conf.input.stokes).strip().upper())
+
+
+def get_stokesIdx(conf, stokes):
+    '''
+    Index of the Stokes parameter `stokes` on the W-axis of the cube, or None
+    if it is not imaged.
+    '''
+    stokesList = get_stokesList(conf)
+    if stokes not in stokesList:
+        return None
+    return stokesList.index(stokes)
+
+
+def get_stokesIdxList(conf, stokesString):
+    '''
+    Indexes of all Stokes parameters in stokesString, e.g. "QU", on the W-axis
+    of the cube, or None if one of them is not imaged.
+    '''
+    stokesIdxList = [get_stokesIdx(conf, stokes) for stokes in stokesString]
+    if None in stokesIdxList:
+        return None
+    return stokesIdxList
+
+
+def get_flaggingStokes(conf):
+    '''
+    Stokes parameter whose RMS is used to flag channels. Falls back to the
+    last imaged Stokes parameter if conf.input.flaggingStokes is not imaged.
+    '''
+    flaggingStokes = str(conf.input.flaggingStokes).strip().upper()
+    if flaggingStokes not in get_stokesList(conf):
+        flaggingStokes = get_stokesList(conf)[-1]
+        warning(f"Flagging Stokes {conf.input.flaggingStokes} is not imaged, flagging with Stokes {flaggingStokes}.")
+    return flaggingStokes
+
+
+def get_rmsStokesList(conf):
+    '''
+    Stokes parameters with an RMS column in the cube statistics: Stokes I, if
+    imaged, and the flagging Stokes parameter.
+    '''
+    flaggingStokes = get_flaggingStokes(conf)
+    return [stokes for stokes in get_stokesList(conf) if stokes in ["I", flaggingStokes]]
+
+
 def get_firstFreq(conf):
     firstFreq = float(conf.input.freqRanges[0].split("-")[0]) * 1e6
     return firstFreq
@@ -297,11 +395,105 @@ def update_fits_header_of_cube(filepathCube, headerDict):
             header[key] = value
 
 
+def allocate_fits_file(filepath, header, dims, dtype=np.float32):
+    '''
+    Writes `header` with the dimensions `dims` (NAXIS1, NAXIS2, ...) to
+    `filepath` and extends the file to its full size by writing only the last
+    byte. The data section is therefore not written and can exceed the
+    machine's RAM.
+    '''
+    for i, dim in enumerate(dims, 1):
+        header["NAXIS%d" % i] = dim
+    header.tofile(filepath, overwrite=True)
+
+    header_size = len(
+        header.tostring()
+    )  # Probably 2880. We don't pad the header any more; it's just the bare minimum
+    data_size = np.prod(dims) * np.dtype(dtype).itemsize
+    # This is not documented in the example, but appears to be Astropy's default behaviour
+    # Pad the total file size to a multiple of the header block size
+    block_size = 2880
+    data_size = block_size * (((data_size -1) // block_size) + 1)
+
+    with open(filepath, "rb+") as f:
+        f.seek(header_size + data_size - 1)
+        f.write(b"\0")
+
+
+def run_once(lockFilepath, func, timeout=600):
+    '''
+    Runs `func` in only one of several processes, possibly on different
+    nodes: the first process to create the lock file runs it, the others wait
+    until it is done. If `func` raises, the lock file is removed again, so a
+    waiting or a resubmitted process runs it instead.
+
+    Returns
+    -------
+    owner: bool
+       True for the process that ran `func`.
+
+    '''
+    timeStart = time.time()
+    waiting = False
+    while True:
+        try:
+            lockFile = os.open(lockFilepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            pass
+        try:
+            with open(lockFilepath) as f:
+                if f.read() == "done":
+                    return False
+        except FileNotFoundError:
+            # the owner failed and released the lock
+            continue
+        if time.time() - timeStart > timeout:
+            raise TimeoutError(f"Lock was not released, remove stale lock file: {lockFilepath}")
+        if not waiting:
+            info(f"Waiting for another task holding the lock: {lockFilepath}")
+            waiting = True
+        time.sleep(5)
+    try:
+        func()
+    except BaseException:
+        os.close(lockFile)
+        os.remove(lockFilepath)
+        raise
+    os.write(lockFile, b"done")
+    os.close(lockFile)
+    return True
+
+
+def copy_file_region(srcFd, dstFd, count, srcOffset, dstOffset):
+    '''
+    Copies `count` bytes from `srcOffset` of one file to `dstOffset` of
+    another inside the kernel, with copy_file_range or, where it is not
+    supported, sendfile. Falls back to pread/pwrite.
+    '''
+    while count > 0:
+        try:
+            copied = os.copy_file_range(srcFd, dstFd, count, srcOffset, dstOffset)
+        except (AttributeError, OSError):
+            try:
+                os.lseek(dstFd, dstOffset, os.SEEK_SET)
+                copied = os.sendfile(dstFd, srcFd, srcOffset, count)
+            except OSError:
+                copied = os.pwrite(dstFd, os.pread(srcFd, min(count, 64 * 1024**2), srcOffset), dstOffset)
+        if copied == 0:
+            raise EOFError(f"Source file ends before {count} more bytes at offset {srcOffset}.")
+        count -= copied
+        srcOffset += copied
+        dstOffset += copied
+
+
 def get_lowest_channelNo_with_data_in_cube(filepathCube):
     '''
+    Scans the cube plane by plane. Prefer the cube validity index in
+    frocc.channel_index, which does not need to read the cube.
     '''
     info(f"Getting lowest channel number which holds data in cube: {filepathCube}") 
-    with fits.open(filepathCube, memmap=True, mode="update") as hud:
+    with fits.open(filepathCube, memmap=True, mode="readonly") as hud:
         dataCube = hud[0].data
         maxIdx = hud[0].data.shape[1]
         if maxIdx == 1:
@@ -320,10 +512,11 @@ def get_lowest_channelIdx_and_freq_with_data_in_cube(filepathCube, freqPower=1e-
     info(f"Getting lowest channel number which holds data in cube: {filepathCube}") 
     dataDict = {}
 #        title = f"Preview: Cube with Stokes IQUV for channel {header['CRPIX3']} at {round(float(header['CRVAL3'])*1e-9,2)} GHz"
-    with fits.open(filepathCube, memmap=True, mode="update") as hud:
+    with fits.open(filepathCube, memmap=True, mode="readonly") as hud:
         dataCube = hud[0].data
         headerCube = hud[0].header
         maxIdx = hud[0].data.shape[1]
+        chanIdx = 0
         for ii in range(0, maxIdx):
             if np.isnan(np.sum(dataCube[0, ii, :, :])) or np.sum(dataCube[0, ii, :, :] == 0):
                 continue
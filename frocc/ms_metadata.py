@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+'''
+Metadata of the input measurement sets, as needed to plan the output channels.
+
+Every MS is opened once and its SPECTRAL_WINDOW and FIELD subtables are read
+in one pass, with the pure-Python reader in frocc.casa_table and casatools as
+fallback. All input MSs are read concurrently in a process pool and the
+results are kept in a metadata cache, so re-running `--createScripts` only
+reads MSs that changed since. For the workload model the flagged fraction of
+every channel can be read as well (conf.env.workloadFlagSummary), which needs
+casatasks and a pass over the FLAG column.
+'''
+
+import functools
+import json
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+
+from frocc.casa_table import read_casa_table_columns, read_table_nrow
+from frocc.logger import *
+
+
+# keys every cache entry must hold, entries missing a key are read again
+METADATA_KEYS = ["signature", "nrow", "chanFreqList", "chanWidthList", "fieldList"]
+# subtables whose modification invalidates the cache entry of an MS
+SIGNATURE_SUBTABLES = ["", "SPECTRAL_WINDOW", "FIELD"]
+
+
+def get_ms_signature(msPath):
+    '''
+    Modification time and size of the table files of the MS and of the
+    subtables the metadata is read from.
+    '''
+    signature = []
+    for subtable in SIGNATURE_SUBTABLES:
+        for filename in ["table.dat", "table.f0"]:
+            filepath = os.path.join(msPath, subtable, filename)
+            if os.path.exists(filepath):
+                stat = os.stat(filepath)
+                signature.append([os.path.join(subtable, filename), stat.st_mtime, stat.st_size])
+    return signature
+
+
+def read_ms_metadata_with_casatools(msPath):
+    '''
+    Same as read_ms_metadata, but with casatools.
+    '''
+    from casatools import table  # work around sice this script get executed in different environments/containers
+    info(f"Reading spectral windows and fields: {msPath}")
+    metadata = {"signature": get_ms_signature(msPath), "chanFreqList": [], "chanWidthList": []}
+    tb = table()
+    tb.open(tablename=msPath)
+    metadata["nrow"] = int(tb.nrows())
+    tb.close()
+    tb.open(tablename=os.path.join(msPath, "SPECTRAL_WINDOW"))
+    # spws can have different numbers of channels, read them row by row
+    for row in range(0, tb.nrows()):
+        metadata["chanFreqList"].append([float(freq) for freq in tb.getcell("CHAN_FREQ", row)])
+        metadata["chanWidthList"].append([float(width) for width in tb.getcell("CHAN_WIDTH", row)])
+    tb.close()
+    tb.open(tablename=os.path.join(msPath, "FIELD"))
+    metadata["fieldList"] = [str(name) for name in tb.getcol("NAME")]
+    tb.close()
+    return metadata
+
+
+def read_ms_flagFractionList(msPath, chanCountList):
+    '''
+    Flagged fraction of every channel of every spw from the flag summary of
+    casatasks.flagdata. This reads the FLAG column of the whole MS once.
+    '''
+    from casatasks import flagdata  # work around sice this script get executed in different environments/containers
+    info(f"Reading flag summary: {msPath}")
+    summary = flagdata(vis=msPath, mode="summary", spwchan=True, action="calculate")
+    spwChanDict = summary["spw:channel"]
+    flagFractionList = []
+    for spw, chanCount in enumerate(chanCountList):
+        flagFractions = []
+        for chan in range(0, chanCount):
+            counts = spwChanDict.get(f"{spw}:{chan}")
+            flagFractions.append(float(counts["flagged"]) / counts["total"] if counts and counts["total"] else 0.)
+        flagFractionList.append(flagFractions)
+    return flagFractionList
+
+
+def read_ms_metadata(msPath, allowCasatools=True, withFlagFractions=False):
+    '''
+    Reads channel frequencies and widths of all spectral windows and the
+    field names of an MS with one open per subtable. Uses the pure-Python
+    CASA table reader and falls back to casatools for table layouts it does
+    not support. With withFlagFractions the flagged fraction of every channel
+    is read as well, which needs casatasks.
+
+    Returns
+    -------
+    metadata: dict
+       nrow is the number of rows of the main table, chanFreqList and
+       chanWidthList hold one list per spw in [Hz], fieldList the field names
+       and flagFractionList (only withFlagFractions) one list per spw.
+
+    '''
+    try:
+        nrow = read_table_nrow(msPath)
+        spwDict = read_casa_table_columns(os.path.join(msPath, "SPECTRAL_WINDOW"), ["CHAN_FREQ", "CHAN_WIDTH"])
+        fieldDict = read_casa_table_columns(os.path.join(msPath, "FIELD"), ["NAME"])
+    except (NotImplementedError, ValueError, OSError, IndexError, struct.error) as e:
+        if not allowCasatools:
+            raise
+        warning(f"Reading {msPath} without casatools failed, using casatools: {e}")
+        metadata = read_ms_metadata_with_casatools(msPath)
+    else:
+        info(f"Read spectral windows and fields without casatools: {msPath}")
+        metadata = {
+            "signature": get_ms_signature(msPath),
+            "nrow": int(nrow),
+            "chanFreqList": [[float(freq) for freq in chanFreqs] for chanFreqs in spwDict["CHAN_FREQ"]],
+            "chanWidthList": [[float(width) for width in chanWidths] for chanWidths in spwDict["CHAN_WIDTH"]],
+            "fieldList": [str(name) for name in fieldDict["NAME"]],
+        }
+    if withFlagFractions:
+        metadata["flagFractionList"] = read_ms_flagFractionList(msPath, [len(chanFreqs) for chanFreqs in metadata["chanFreqList"]])
+    return metadata
+
+
+def get_ms_metadataCache_filepath(conf):
+    return conf.input.basename + conf.env.extMsMetadataCache
+
+
+def read_ms_metadata_cache(conf):
+    '''
+    Reads the metadata cache into a dict with the absolute MS path as key.
+    '''
+    filepathCache = get_ms_metadataCache_filepath(conf)
+    if not os.path.exists(filepathCache):
+        return {}
+    try:
+        with open(filepathCache) as f:
+            return json.load(f)
+    except ValueError:
+        warning(f"Ignoring unreadable MS metadata cache: {filepathCache}")
+        return {}
+
+
+def write_ms_metadata_cache(conf, cacheDict):
+    filepathCache = get_ms_metadataCache_filepath(conf)
+    info(f"Writing MS metadata cache: {filepathCache}")
+    with open(filepathCache, "w") as f:
+        json.dump(cacheDict, f)
+
+
+def is_ms_metadata_cached(msPath, entry, withFlagFractions=False):
+    '''
+    True if the cache entry is complete and the MS did not change since.
+    '''
+    keyList = METADATA_KEYS + ["flagFractionList"] if withFlagFractions else METADATA_KEYS
+    if not entry or not all(key in entry for key in keyList):
+        return False
+    return entry["signature"] == get_ms_signature(msPath)
+
+
+def get_ms_metadataList(conf, allowCasatools=True, withFlagFractions=False):
+    '''
+    Metadata of all conf.input.inputMS in input order. MSs that are not in the
+    cache, or changed since, are read concurrently. With allowCasatools=False
+    an MS the pure-Python reader can not read raises an error. With
+    withFlagFractions cache entries without flag fractions are read again.
+    '''
+    cacheDict = read_ms_metadata_cache(conf)
+    msPathList = [os.path.abspath(inputMS) for inputMS in conf.input.inputMS]
+    readMsPathList = [msPath for msPath in msPathList if not is_ms_metadata_cached(msPath, cacheDict.get(msPath), withFlagFractions=withFlagFractions)]
+    info(f"MS metadata: {len(msPathList) - len(readMsPathList)} of {len(msPathList)} measurement sets found in cache.")
+    if readMsPathList:
+        maxWorkers = max(1, min(len(readMsPathList), int(conf.env.msMetadataMaxWorkers)))
+        readMetadata = functools.partial(read_ms_metadata, allowCasatools=allowCasatools, withFlagFractions=withFlagFractions)
+        with ProcessPoolExecutor(max_workers=maxWorkers) as executor:
+            for msPath, metadata in zip(readMsPathList, executor.map(readMetadata, readMsPathList)):
+                cacheDict[msPath] = metadata
+        write_ms_metadata_cache(conf, cacheDict)
+    return [cacheDict[msPath] for msPath in msPathList]
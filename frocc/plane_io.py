@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+'''
+Native byte order plane buffers.
+
+Fits data is big-endian float32. Every numpy operation on a big-endian array
+converts it to the native byte order first, allocating a new array, often
+several times per plane. The functions here convert every plane exactly once
+into a reusable native-endian buffer, all computation runs in native order,
+and planes are swapped back to big-endian in place only where they are
+written.
+
+Run `python3 -m frocc.plane_io` for a benchmark of a typical plane
+computation (weighted sums, polarised intensity and MAD) on big-endian
+planes against native buffers.
+'''
+
+import os
+import time
+import tracemalloc
+
+import click
+import numpy as np
+
+from frocc.lhelpers import get_std_via_mad
+from frocc.logger import *
+
+
+NATIVE_DTYPE = np.dtype(np.float32)
+BIG_ENDIAN_DTYPE = np.dtype(">f4")
+
+
+def get_plane_buffers(shape, count=1):
+    '''
+    List of `count` native float32 buffers of `shape`, to be reused for every
+    plane.
+    '''
+    return [np.empty(shape, dtype=NATIVE_DTYPE) for ii in range(0, count)]
+
+
+def read_plane_native(plane, out):
+    '''
+    Converts a (big-endian) plane into the native buffer `out` without
+    allocating a new array.
+    '''
+    np.copyto(out, plane, casting="unsafe")
+    return out
+
+
+def pread_into(fd, buffer, offset):
+    '''
+    Reads exactly the bytes of `buffer` from `offset` of a file. Raises
+    EOFError if the file ends before, e.g. for a truncated or partly written
+    image, instead of leaving stale bytes of a reused buffer behind.
+    '''
+    view = memoryview(buffer).cast("B")
+    while view:
+        count = os.preadv(fd, [view], offset)
+        if count == 0:
+            raise EOFError(f"File ends before {len(view)} more bytes at offset {offset}.")
+        view = view[count:]
+        offset += count
+    return buffer
+
+
+def swap_native_inplace(buffer):
+    '''
+    Interprets the raw big-endian bytes in a native buffer, e.g. read with
+    os.preadv, as big-endian and swaps them in place into native order.
+    '''
+    if BIG_ENDIAN_DTYPE != NATIVE_DTYPE:
+        buffer.byteswap(inplace=True)
+    return buffer
+
+
+def get_bigendian_view(buffer):
+    '''
+    Big-endian view of a native buffer whose bytes were swapped in place.
+    '''
+    return buffer.view(BIG_ENDIAN_DTYPE)
+
+
+def write_plane_bigendian(write, buffer):
+    '''
+    Calls `write` with a big-endian view of the native buffer. The bytes are
+    swapped in place before and swapped back after, so the buffer keeps its
+    values and no big-endian copy gets allocated.
+    '''
+    if not buffer.flags.c_contiguous or buffer.dtype != NATIVE_DTYPE:
+        write(np.ascontiguousarray(buffer, dtype=BIG_ENDIAN_DTYPE))
+        return
+    swap_native_inplace(buffer)
+    try:
+        write(get_bigendian_view(buffer))
+    finally:
+        swap_native_inplace(buffer)
+
+
+def get_average_map_terms_bigendian(planeList, w, accumulatorList):
+    '''
+    Weighted sums of one channel as done before the native buffers, directly
+    on the big-endian planes I, Q, U, V.
+    '''
+    I, Q, U, V = planeList
+    accumulatorList[0] += w * I
+    accumulatorList[1] += w * np.sqrt(Q**2 + U**2)
+    accumulatorList[2] += w * V
+    return get_std_via_mad(V)
+
+
+def get_average_map_terms_native(planeList, w, accumulatorList, bufferList):
+    '''
+    Same as get_average_map_terms_bigendian with every plane converted once
+    into the native buffers and all temporaries written into a buffer.
+    '''
+    I, Q, U, V, tmp = [read_plane_native(plane, buffer) for plane, buffer in zip(planeList, bufferList)] + [bufferList[4]]
+    np.multiply(I, w, out=tmp)
+    accumulatorList[0] += tmp
+    np.hypot(Q, U, out=tmp)
+    tmp *= w
+    accumulatorList[1] += tmp
+    np.multiply(V, w, out=tmp)
+    accumulatorList[2] += tmp
+    return get_std_via_mad(V)
+
+
+def benchmark_plane_io(size=2048, repeat=5):
+    '''
+    Time and peak temporary memory per plane of the average map computation
+    on big-endian planes and on native buffers. numpy reports its array
+    allocations to tracemalloc, so the peak is the size of the temporary
+    arrays allocated for one plane.
+
+    Returns
+    -------
+    resultDict: dict
+       For "bigendian" and "native": seconds per plane and peak temporary
+       memory in units of one float32 plane.
+
+    '''
+    rng = np.random.default_rng(0)
+    planeList = [rng.normal(size=(size, size)).astype(BIG_ENDIAN_DTYPE) for ii in range(0, 4)]
+    accumulatorList = get_plane_buffers((size, size), count=3)
+    bufferList = get_plane_buffers((size, size), count=5)
+    planeBytes = size * size * NATIVE_DTYPE.itemsize
+    resultDict = {}
+    for name, run in [
+        ("bigendian", lambda: get_average_map_terms_bigendian(planeList, 0.5, accumulatorList)),
+        ("native", lambda: get_average_map_terms_native(planeList, 0.5, accumulatorList, bufferList)),
+    ]:
+        run()  # warm up
+        tracemalloc.start()
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        timeStart = time.perf_counter()
+        for ii in range(0, repeat):
+            run()
+        resultDict[name] = {
+            "seconds": (time.perf_counter() - timeStart) / repeat,
+            "peakPlanes": peak / planeBytes,
+        }
+    return resultDict
+
+
+@click.command()
+@click.option("--size", default=2048, help="Plane edge in pixels.")
+@click.option("--repeat", default=5, help="Planes per measurement.")
+def main(size, repeat):
+    '''
+    Benchmark of big-endian planes against native buffers.
+    '''
+    resultDict = benchmark_plane_io(size=size, repeat=repeat)
+    for name, result in resultDict.items():
+        info(f"{name}: {round(result['seconds'] * 1e3, 2)} ms per plane, temporary arrays of {round(result['peakPlanes'], 1)} planes")
+    info(f"Speedup: {round(resultDict['bigendian']['seconds'] / resultDict['native']['seconds'], 2)}x")
+
+
+if __name__ == "__main__":
+    main()
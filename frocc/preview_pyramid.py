@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+'''
+Multi-resolution preview pyramid of the data cube.
+
+While buildcube streams the channels into the cube every channel plane is
+also block-averaged by factors of 2, 4, 8, ... and written into one small fits
+cube per level. Additionally a per-Stokes spectral average (quicklook) is
+accumulated. The report and viewers read these small files instead of the
+full cube.
+'''
+
+import os
+import warnings
+
+import numpy as np
+from astropy.io import fits
+
+from frocc.lhelpers import allocate_fits_file, update_fits_header_of_cube, DotMap
+from frocc.logger import *
+
+
+def get_pyramid_factorList(conf, xdim, ydim):
+    '''
+    Downsampling factors (powers of 2) of all pyramid levels. Only levels with
+    an image size between pyramidMinSize and pyramidMaxSize are kept.
+    '''
+    factorList = []
+    factor = 2
+    while max(xdim, ydim) // factor >= int(conf.env.pyramidMinSize):
+        if max(xdim, ydim) // factor <= int(conf.env.pyramidMaxSize):
+            factorList.append(factor)
+        factor *= 2
+    return factorList
+
+
+def get_pyramid_filepath(conf, factor, mode="normal"):
+    '''
+    '''
+    if mode == "smoothed":
+        ext = conf.env.extCubeSmoothedPyramid
+    else:
+        ext = conf.env.extCubePyramid
+    return os.path.join(conf.input.dirOutput, conf.input.basename + ext + f"-{factor}x.fits")
+
+
+def get_quicklook_filepath(conf, mode="normal"):
+    '''
+    '''
+    if mode == "smoothed":
+        return os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeSmoothedQuicklookFits)
+    return os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeQuicklookFits)
+
+
+def get_block_averaged_plane(plane, factor):
+    '''
+    Averages blocks of factor x factor pixels, ignoring NaNs. Rows and columns
+    that do not fill a whole block are cut off.
+    '''
+    if factor == 1:
+        return np.array(plane, dtype=np.float32)
+    height = plane.shape[0] // factor
+    width = plane.shape[1] // factor
+    blocks = np.asarray(plane[:height * factor, :width * factor], dtype=np.float32).reshape(height, factor, width, factor)
+    # all-NaN blocks are expected for flagged or blanked areas
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return np.nanmean(blocks, axis=(1, 3))
+
+
+def get_downsampled_header(header, factor):
+    '''
+    Copy of the cube header with the spatial axes adjusted to the block
+    averaged grid.
+    '''
+    header = header.copy()
+    for axis in (1, 2):
+        if f"CDELT{axis}" in header:
+            header[f"CDELT{axis}"] = header[f"CDELT{axis}"] * factor
+        if f"CRPIX{axis}" in header:
+            header[f"CRPIX{axis}"] = (header[f"CRPIX{axis}"] - 0.5) / factor + 0.5
+    return header
+
+
+def open_pyramid(conf, header, mode="normal"):
+    '''
+    Allocates the pyramid levels and the quicklook for a cube with `header`
+    and opens them for writing.
+
+    Returns
+    -------
+    pyramid: DotMap
+       Holds the opened levels, the quicklook accumulators and the filepaths.
+
+    '''
+    wdim, zdim, ydim, xdim = [header[f"NAXIS{axis}"] for axis in (4, 3, 2, 1)]
+    pyramid = DotMap()
+    pyramid.factorList = get_pyramid_factorList(conf, xdim, ydim)
+    pyramid.hudList = []
+    pyramid.filepathList = []
+    for factor in pyramid.factorList:
+        filepath = get_pyramid_filepath(conf, factor, mode=mode)
+        info(f"Allocating preview pyramid level {factor}x: {filepath}")
+        allocate_fits_file(filepath, get_downsampled_header(header, factor), (xdim // factor, ydim // factor, zdim, wdim))
+        pyramid.filepathList.append(filepath)
+        pyramid.hudList.append(fits.open(filepath, memmap=True, ignore_missing_end=True, mode="update"))
+
+    # the quicklook uses the finest pyramid level
+    pyramid.quicklookFactor = pyramid.factorList[0] if pyramid.factorList else 1
+    pyramid.quicklookFilepath = get_quicklook_filepath(conf, mode=mode)
+    pyramid.quicklookHeader = get_downsampled_header(header, pyramid.quicklookFactor)
+    pyramid.quicklookShape = (wdim, ydim // pyramid.quicklookFactor, xdim // pyramid.quicklookFactor)
+    pyramid.quicklookSum = np.zeros(pyramid.quicklookShape, dtype=np.float64)
+    pyramid.quicklookCount = np.zeros(pyramid.quicklookShape, dtype=np.int32)
+    return pyramid
+
+
+def add_channel_to_pyramid(pyramid, chanIdx, planeList):
+    '''
+    Block averages the Stokes planes of one channel into all pyramid levels.
+    If planeList is None the channel is flagged and set to NaN.
+    '''
+    for factor, hud in zip(pyramid.factorList, pyramid.hudList):
+        if planeList is None:
+            hud[0].data[:, chanIdx, :, :] = np.nan
+            continue
+        for stokesIdx, plane in enumerate(planeList):
+            hud[0].data[stokesIdx, chanIdx, :, :] = get_block_averaged_plane(plane, factor)
+    if planeList is None:
+        return
+    for stokesIdx, plane in enumerate(planeList):
+        if pyramid.quicklookFactor in pyramid.factorList:
+            levelIdx = pyramid.factorList.index(pyramid.quicklookFactor)
+            quicklookPlane = pyramid.hudList[levelIdx][0].data[stokesIdx, chanIdx, :, :]
+        else:
+            quicklookPlane = get_block_averaged_plane(plane, pyramid.quicklookFactor)
+        validMask = np.isfinite(quicklookPlane)
+        pyramid.quicklookSum[stokesIdx][validMask] += quicklookPlane[validMask]
+        pyramid.quicklookCount[stokesIdx][validMask] += 1
+
+
+def close_pyramid(pyramid, headerDict):
+    '''
+    Closes all pyramid levels, updates their headers with headerDict (as done
+    for the cube) and writes the quicklook.
+    '''
+    for hud, filepath in zip(pyramid.hudList, pyramid.filepathList):
+        hud.close()
+        update_fits_header_of_cube(filepath, headerDict)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        quicklook = (pyramid.quicklookSum / pyramid.quicklookCount).astype(np.float32)
+    quicklookHeader = pyramid.quicklookHeader
+    quicklookHeader.update(headerDict)
+    quicklookHeader["NAXIS3"] = 1
+    info(f"Writing spectral average quicklook: {pyramid.quicklookFilepath}")
+    fits.writeto(pyramid.quicklookFilepath, quicklook[:, np.newaxis, :, :], header=quicklookHeader, overwrite=True)
+
+
+def get_preview_filepath(conf, targetSize=512, mode="normal"):
+    '''
+    Returns the pyramid level with the largest image size not exceeding
+    targetSize, or the full cube if no pyramid exists.
+    '''
+    factor = 2
+    filepathList = []
+    while factor <= 1024:
+        filepath = get_pyramid_filepath(conf, factor, mode=mode)
+        if os.path.exists(filepath):
+            filepathList.append(filepath)
+            if fits.getheader(filepath)["NAXIS1"] <= targetSize:
+                return filepath
+        factor *= 2
+    if filepathList:
+        return filepathList[-1]
+    if mode == "smoothed":
+        return os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeSmoothedFits)
+    return os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeFits)
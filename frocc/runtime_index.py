@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+'''
+Runtime accounting from the slurm log files.
+
+Only the head and the tail of every log file are read to find the first and
+the last logger timestamp. The results are kept in a runtime index file, so
+log files that did not change since the last run are not read again.
+'''
+
+import csv
+import os
+import re
+from datetime import datetime
+from glob import glob
+
+from frocc.config import FORMAT_LOGS_TIMESTAMP
+from frocc.logger import *
+
+
+# matchString: 2020-05-27 15:07:14,566
+TIMESTAMP_PATTERN = re.compile(rb'[0-9]{4}-[0-9]{2}-[0-9]{2}\ [0-9]{2}:[0-9]{2}:[0-9]{2},[0-9]{3}')
+# slurm log files are named <runScript>-<jobID>-<arrayTaskID>.err
+SLURM_LOG_PATTERN = re.compile(r'-([0-9]+)-([0-9]+)\.err$')
+# bytes read from the start and from the end of each log file
+LOG_CHUNK_SIZE = 64 * 1024
+
+
+def get_start_stop_delta_time_from_filepath(filepath, chunkSize=LOG_CHUNK_SIZE):
+    '''
+    Returns [start, stop, delta] from the first and last timestamp in the log
+    file, or an empty list if the file holds no timestamp. Reads at most
+    2 * chunkSize bytes, falling back to the whole file only if the tail holds
+    no timestamp.
+    '''
+    fileSize = os.path.getsize(filepath)
+    with open(filepath, 'rb') as f:
+        if fileSize <= 2 * chunkSize:
+            head = f.read()
+            tail = head
+        else:
+            head = f.read(chunkSize)
+            f.seek(-chunkSize, os.SEEK_END)
+            tail = f.read()
+            if not TIMESTAMP_PATTERN.search(tail):
+                f.seek(0)
+                tail = f.read()
+    startMatch = TIMESTAMP_PATTERN.search(head)
+    stopMatchList = TIMESTAMP_PATTERN.findall(tail)
+    if not (startMatch and stopMatchList):
+        return []
+    start = datetime.strptime(startMatch.group().decode(), FORMAT_LOGS_TIMESTAMP)
+    stop = datetime.strptime(stopMatchList[-1].decode(), FORMAT_LOGS_TIMESTAMP)
+    return [start, stop, stop - start]
+
+
+def get_relevant_logFilepathList(conf):
+    '''
+    All *.err log files of the slurm jobs in conf.data.slurmIDList.
+    '''
+    slurmIDSet = set([str(slurmID) for slurmID in conf.data.slurmIDList])
+    relevantLogFilepathList = []
+    for logFilepath in glob(os.path.join(conf.env.dirLogs, "*.err")):
+        match = SLURM_LOG_PATTERN.search(logFilepath)
+        if match and match.group(1) in slurmIDSet:
+            relevantLogFilepathList.append(logFilepath)
+    return relevantLogFilepathList
+
+
+def get_runtimeIndex_filepath(conf):
+    return os.path.join(conf.env.dirLogs, conf.input.basename + conf.env.extRuntimeIndex)
+
+
+def read_runtime_index(conf):
+    '''
+    Reads the runtime index into a dict with the log filepath as key.
+    '''
+    indexDict = {}
+    filepathIndex = get_runtimeIndex_filepath(conf)
+    if not os.path.exists(filepathIndex):
+        return indexDict
+    with open(filepathIndex) as csvFile:
+        reader = csv.reader(csvFile, delimiter="\t")
+        next(reader)
+        for filepath, mtime, size, start, stop in reader:
+            indexDict[filepath] = {
+                "mtime": float(mtime),
+                "size": int(size),
+                "timesList": [] if not start else [
+                    datetime.strptime(start, FORMAT_LOGS_TIMESTAMP),
+                    datetime.strptime(stop, FORMAT_LOGS_TIMESTAMP),
+                ],
+            }
+            if indexDict[filepath]["timesList"]:
+                indexDict[filepath]["timesList"].append(indexDict[filepath]["timesList"][1] - indexDict[filepath]["timesList"][0])
+    return indexDict
+
+
+def write_runtime_index(conf, indexDict):
+    filepathIndex = get_runtimeIndex_filepath(conf)
+    with open(filepathIndex, "w") as csvFile:
+        writer = csv.writer(csvFile, delimiter="\t")
+        csvData = [["filepath", "mtime", "size", "timeStart", "timeStop"]]
+        for filepath, entry in indexDict.items():
+            if entry["timesList"]:
+                start, stop = [t.strftime(FORMAT_LOGS_TIMESTAMP) for t in entry["timesList"][:2]]
+            else:
+                start, stop = "", ""
+            csvData.append([filepath, entry["mtime"], entry["size"], start, stop])
+        writer.writerows(csvData)
+
+
+def get_times_listDict(conf):
+    '''
+    Runtime table of all slurm tasks of this run, sorted by start time. Log
+    files are only read if they changed since the runtime index was written.
+    '''
+    dataDict = {}
+    dataDict['runScript'] = []
+    dataDict['filepath'] = []
+    dataDict['timeStart'] = []
+    dataDict['timeStop'] = []
+    dataDict['timeDelta'] = []
+    indexDict = read_runtime_index(conf)
+    updatedIndexDict = {}
+    for logFilepath in get_relevant_logFilepathList(conf):
+        stat = os.stat(logFilepath)
+        entry = indexDict.get(logFilepath)
+        if not entry or entry["mtime"] != stat.st_mtime or entry["size"] != stat.st_size:
+            entry = {
+                "mtime": stat.st_mtime,
+                "size": stat.st_size,
+                "timesList": get_start_stop_delta_time_from_filepath(logFilepath),
+            }
+        updatedIndexDict[logFilepath] = entry
+    write_runtime_index(conf, updatedIndexDict)
+
+    filepathTimesList = sorted(
+        [[entry["timesList"], filepath] for filepath, entry in updatedIndexDict.items() if entry["timesList"]],
+        key=lambda x: x[0][0],
+    )
+    for timesList, filepath in filepathTimesList:
+        dataDict['filepath'].append(filepath)
+        dataDict['timeStart'].append(timesList[0])
+        dataDict['timeStop'].append(timesList[1])
+        dataDict['timeDelta'].append(timesList[2])
+        for runScript in conf.input.runScripts:
+            if runScript.replace(".py", "") in filepath:
+                dataDict['runScript'].append(runScript)
+    return dataDict
@@ -14,6 +14,11 @@ from frocc.logger import *
 
 # own helpers
 from frocc.lhelpers import get_dict_from_click_args, DotMap, get_config_in_dot_notation, main_timer, write_sbtach_file, get_firstFreq, get_basename_from_path, get_optimal_taskNo_cpu_mem, SEPERATOR, run_command_with_logging
+from frocc.ms_metadata import get_ms_metadataList, read_ms_metadata
+from frocc.workload import write_task_plan, get_taskPlan_filepath
+from frocc.channel_index import remove_stale_slab_files
+from frocc.supervisor import supervise, read_sbatch_header, get_task_profileList, get_profile_optionList
+from frocc.cube_verify import verify
 from frocc.config import SPECIAL_FLAGS, FILEPATH_CONFIG_USER, PATH_PACKAGE, FILEPATH_CONFIG_TEMPLATE, FILEPATH_CONFIG_TEMPLATE_ORIGINAL, FILEPATH_LOG_PIPELINE, FILEPATH_LOG_TIMER
 import frocc
 
@@ -67,35 +72,38 @@ def get_all_freqsList(conf, msIdx):
     """
     Get all the frequencies of all the channels in each spw.
     """
-    from casatools import msmetadata  # work around sice this script get executed in different environments/containers
-    allFreqsList = np.array([])
     info(f"Opening file to read the frequency coverage of all channels in each spw: {conf.input.inputMS[msIdx]}")
-    msmd = msmetadata()
-    msmd.open(msfile=conf.input.inputMS[msIdx], maxcache=10000)
-    for spw in range(0, msmd.nspw()):
-        allFreqsList = np.append(allFreqsList, (msmd.chanfreqs(spw) + msmd.chanwidths(spw)))
-        allFreqsList = np.append(allFreqsList, (msmd.chanfreqs(spw) - msmd.chanwidths(spw)))
+    return get_all_freqsList_from_metadata(read_ms_metadata(conf.input.inputMS[msIdx]))
+
+
+def get_all_freqsList_from_metadata(metadata):
+    """
+    Same as get_all_freqsList, but from the harvested MS metadata.
+    """
+    allFreqsList = np.array([])
+    for chanFreqs, chanWidths in zip(metadata["chanFreqList"], metadata["chanWidthList"]):
+        allFreqsList = np.append(allFreqsList, np.array(chanFreqs) + np.array(chanWidths))
+        allFreqsList = np.append(allFreqsList, np.array(chanFreqs) - np.array(chanWidths))
     return allFreqsList
 
 
 def get_fields(conf, msIdx):
     """
-    Get all the frequencies of all the channels in each spw.
-    TODO: put all the msmd in one fuction so that the object is created only once.
+    Get all field names of the MS.
     """
-    from casatools import table  # work around sice this script get executed in different environments/containers
-    import casatools
-    print("DEBUG", casatools.__path__)
     info(f"Opening file to read the fields: {conf.input.inputMS[msIdx]}")
-    tb = table()
-    tb.open(tablename=conf.input.inputMS[msIdx]+"/FIELD")
-    return list(tb.getcol('NAME'))
+    return read_ms_metadata(conf.input.inputMS[msIdx])["fieldList"]
 
-def get_unflagged_channelIndexBoolList(conf, msIdx):
+def get_unflagged_channelIndexBoolList(conf, msIdx, allFreqsList=None):
     '''
+    allFreqsList: frequencies of the MS as from get_all_freqsList, read from
+    the MS if None.
     '''
+    if allFreqsList is None:
+        allFreqsList = get_all_freqsList(conf, msIdx)
+    allFreqsList = np.array(allFreqsList)
+
     def get_subrange_unflagged_channelIndexSet(firstFreq, startFreq, stopFreq):
-        allFreqsList = np.array(get_all_freqsList(conf, msIdx))
         rangeFreqsList = allFreqsList[(allFreqsList >= startFreq) & (allFreqsList <= stopFreq)]
         # A list of indexes for all cube channels in range that will hold data.
         # Expl: ( 901e6 [Hz] - 890e6 [Hz] ) // 2.5e6 [Hz] = 4 [listIndex]
@@ -124,9 +132,9 @@ def get_unflagged_channelIndexBoolList(conf, msIdx):
             channelIndexBoolList.append(False)
     return channelIndexBoolList
 
-def get_unflagged_channelList(conf, msIdx):
+def get_unflagged_channelList(conf, msIdx, allFreqsList=None):
     channelList = []
-    channelIndexBoolList = get_unflagged_channelIndexBoolList(conf, msIdx)
+    channelIndexBoolList = get_unflagged_channelIndexBoolList(conf, msIdx, allFreqsList=allFreqsList)
     for i, channelBool in enumerate(channelIndexBoolList):
         if channelBool:
             channelList.append(i+1)
@@ -212,7 +220,14 @@ def write_all_sbatch_files(conf):
     TODO: make this shorter and better
     '''
     # split
-    slurmArrayLength = str(sum([len(x) for x in conf.data.predictedOutputChannels]))
+    # one array task per (MS, channel) and per channel, or balanced task bundles
+    taskPlanDict = {}
+    if conf.env.balanceSplitTcleanTasks:
+        taskPlanDict = write_task_plan(conf)
+    # a stale plan from an earlier setup would not match the array lengths
+    if not taskPlanDict and os.path.exists(get_taskPlan_filepath(conf)):
+        os.remove(get_taskPlan_filepath(conf))
+    slurmArrayLength = str(taskPlanDict.get("cube_split.py", sum([len(x) for x in conf.data.predictedOutputChannels])))
     numberInputMS = len(conf.input.inputMS)
     slurmMemory = 20
     if slurmMemory > int(conf.env.tcleanMaxMemory):
@@ -236,7 +251,7 @@ def write_all_sbatch_files(conf):
     write_sbtach_file(filename, command, conf, sbatchDict)
 
     # tclean
-    slurmArrayLength = str(len(set(itertools.chain(*conf.data.predictedOutputChannels))))
+    slurmArrayLength = str(taskPlanDict.get("cube_tclean.py", len(set(itertools.chain(*conf.data.predictedOutputChannels)))))
     tcleanSlurm = get_optimal_taskNo_cpu_mem(conf)
     basename = "cube_tclean"
     filename = basename + ".sbatch"
@@ -256,11 +271,11 @@ def write_all_sbatch_files(conf):
     command = conf.env.prefixSingularity + ' python3 ' + scriptPath + ' --slurmArrayTaskId ${SLURM_ARRAY_TASK_ID}'
     write_sbtach_file(filename, command, conf, sbatchDict)
 
-    # buildcube
+    # buildcube, one array task per cube and channel slab
     if conf.input.smoothbeam:
-        noOfArrayTasks = 2
+        noOfArrayTasks = 2 * int(conf.env.buildcubeSlabCount)
     else:
-        noOfArrayTasks = 1
+        noOfArrayTasks = int(conf.env.buildcubeSlabCount)
     basename = "cube_buildcube"
     filename = basename + ".sbatch"
     sbatchDict = {
@@ -326,8 +341,8 @@ def write_all_sbatch_files(conf):
             'job-name': basename,
             'output': "logs/" + basename + "-%A-%a.out",
             'error': "logs/" + basename + "-%A-%a.err",
-            'cpus-per-task': 1,
-            'mem': "1GB",
+            'cpus-per-task': conf.env.verifyMaxCpuCores,
+            'mem': "16GB",
             'time': "01:00:00",
             }
     if os.path.exists(basename + ".py"):
@@ -345,8 +360,8 @@ def write_all_sbatch_files(conf):
             'job-name': basename,
             'output': "logs/" + basename + "-%A-%a.out",
             'error': "logs/" + basename + "-%A-%a.err",
-            'cpus-per-task': 1,
-            'mem': "30GB",
+            'cpus-per-task': conf.env.reportMaxCpuCores,
+            'mem': "30GB" if not conf.input.previewPyramid else "8GB",
             'time': "00:30:00",
             }
     if os.path.exists(basename + ".py"):
@@ -365,7 +380,7 @@ def write_all_sbatch_files(conf):
             'output': "logs/" + basename + "-%A-%a.out",
             'error': "logs/" + basename + "-%A-%a.err",
             'cpus-per-task': 1,
-            'mem': "100GB",
+            'mem': "10GB",
             }
     if os.path.exists(basename + ".py"):
         scriptPath =  basename + ".py"
@@ -382,7 +397,7 @@ def write_all_sbatch_files(conf):
             'job-name': basename,
             'output': "logs/" + basename + "-%A-%a.out",
             'error': "logs/" + basename + "-%A-%a.err",
-            'cpus-per-task': 1,
+            'cpus-per-task': conf.env.rmsyMaxCpuCores if conf.input.rmsyCatalogue else 1,
             'mem': "10GB",
             }
     if os.path.exists(basename + ".py"):
@@ -392,6 +407,26 @@ def write_all_sbatch_files(conf):
     command = conf.env.prefixSingularity + ' python3 ' + scriptPath
     write_sbtach_file(filename, command, conf, sbatchDict)
 
+    # Faraday depth cube
+    basename = "cube_rmsy_fdf"
+    filename = basename + ".sbatch"
+    fdfNodeCount = int(conf.env.fdfNodeCount)
+    sbatchDict = {
+            'array': f"1-{fdfNodeCount}%{fdfNodeCount}",
+            'job-name': basename,
+            'output': "logs/" + basename + "-%A-%a.out",
+            'error': "logs/" + basename + "-%A-%a.err",
+            'cpus-per-task': conf.env.fdfMaxCpuCores,
+            # about 2GB per process for the default tile size
+            'mem': str(2 * int(conf.env.fdfMaxCpuCores) + 4) + "GB",
+            }
+    if os.path.exists(basename + ".py"):
+        scriptPath =  basename + ".py"
+    else:
+        scriptPath =  os.path.join(PATH_PACKAGE, basename + ".py")
+    command = conf.env.prefixSingularity + ' python3 ' + scriptPath + ' --slurmArrayTaskId ${SLURM_ARRAY_TASK_ID}'
+    write_sbtach_file(filename, command, conf, sbatchDict)
+
 def copy_runscripts(conf):
     '''
     Copies the runScripts to the local directory
@@ -467,10 +502,11 @@ def main(ctx):
         data['predictedOutputChannels'] = []
         data['fields'] = []
         data['field'] = ""
-        for msIdx, inputMS in enumerate(conf.input.inputMS):
-            info(SEPERATOR)
-            data['predictedOutputChannels'].append(get_unflagged_channelList(conf, msIdx))
-            data['fields'].append(get_fields(conf, msIdx))
+        info(SEPERATOR)
+        withFlagFractions = bool(conf.env.balanceSplitTcleanTasks and conf.env.workloadFlagSummary)
+        for msIdx, metadata in enumerate(get_ms_metadataList(conf, withFlagFractions=withFlagFractions)):
+            data['predictedOutputChannels'].append(get_unflagged_channelList(conf, msIdx, allFreqsList=get_all_freqsList_from_metadata(metadata)))
+            data['fields'].append(metadata['fieldList'])
         data['field'] = get_field(data['fields'], conf)
         update_user_config_data(data)
         # reload conf after data got appended to user conf
@@ -487,13 +523,25 @@ def main(ctx):
     if "--start" in ctx.args:
         conf = get_config_in_dot_notation(templateFilename=FILEPATH_CONFIG_TEMPLATE, configFilename=FILEPATH_CONFIG_USER)
         create_directories(conf)
+        remove_stale_slab_files(conf)
         args = DotMap(get_dict_from_click_args(ctx.args))
-        firstRunScript = conf.input.runScripts[0].replace('.py', '.sbatch')
-        command = f"SLURMID=$(sbatch {firstRunScript} | cut -d ' ' -f4) && echo SLURMID: "
-        for runScript in conf.input.runScripts[1:]:
+        # one array job per resource profile, every stage depends on all
+        # array jobs of the stage before
+        command = ""
+        dependency = ""
+        for stageIdx, runScript in enumerate(conf.input.runScripts):
             sbatchScript = runScript.replace(".py", ".sbatch")
-            command += f"$SLURMID;SLURMID=$(sbatch --dependency=afterany:$SLURMID {sbatchScript} | cut -d ' ' -f4) && echo "
-        command += "$SLURMID && echo Slurm jobs submitted!"
+            profileList = get_task_profileList(conf, runScript, read_sbatch_header(sbatchScript))
+            variableList = []
+            for profileIdx, (taskIdList, optionDict) in enumerate(profileList):
+                optionList = get_profile_optionList(optionDict)
+                if dependency:
+                    optionList = [f"--dependency=afterany:{dependency}"] + optionList
+                variable = f"SLURMID_{stageIdx}_{profileIdx}"
+                command += f"{variable}=$(sbatch {' '.join(optionList)} {sbatchScript} | cut -d ' ' -f4) && echo {variable}: ${variable};"
+                variableList.append("$" + variable)
+            dependency = ":".join(variableList)
+        command += "echo Slurm jobs submitted!"
         info(f"Slurm command: {command}")
         sbatchResult = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, shell=True)
         sbatchResultStd = sbatchResult.stdout.replace("\n", " ")
@@ -507,6 +555,28 @@ def main(ctx):
                 error(sbatchResultStderr)
         return None
 
+    if "--supervise" in ctx.args:
+        conf = get_config_in_dot_notation(templateFilename=FILEPATH_CONFIG_TEMPLATE, configFilename=FILEPATH_CONFIG_USER)
+        create_directories(conf)
+        remove_stale_slab_files(conf)
+        # runs as slurm job submitted by the wrapper, --cancel cancels it first
+        slurmIDList = [int(os.environ["SLURM_JOB_ID"])] if "SLURM_JOB_ID" in os.environ else []
+        if slurmIDList:
+            update_user_config_data({'slurmIDList': slurmIDList})
+
+        def on_submit(jobIdList):
+            slurmIDList.extend(jobIdList)
+            update_user_config_data({'slurmIDList': slurmIDList})
+
+        supervise(conf, on_submit)
+        return None
+
+    if "--verify" in ctx.args:
+        conf = get_config_in_dot_notation(templateFilename=FILEPATH_CONFIG_TEMPLATE, configFilename=FILEPATH_CONFIG_USER)
+        if not verify(conf):
+            sys.exit(1)
+        return None
+
     if "--cancel" in ctx.args or "--kill" in ctx.args:
         conf = get_config_in_dot_notation(templateFilename=FILEPATH_CONFIG_TEMPLATE, configFilename=FILEPATH_CONFIG_USER)
         command = f'scancel {" ".join(map(str,conf.data.slurmIDList))}'
@@ -21,6 +21,7 @@ os.environ['LC_ALL'] = "C-UTF-8"
 os.environ['LANG'] = "C-UTF-8"
 
 import click
+import shlex
 import subprocess
 from os.path import expanduser
 from frocc.lhelpers import main_timer, get_config_in_dot_notation, print_starting_banner
@@ -28,7 +29,11 @@ from frocc.check_input import check_all, print_usage, print_help, print_help_ver
 from frocc.check_status import print_status
 from frocc.config import SPECIAL_FLAGS, FILEPATH_CONFIG_TEMPLATE_ORIGINAL, FILEPATH_LOG_PIPELINE, FILEPATH_CONFIG_USER, FILEPATH_CONFIG_TEMPLATE
 from frocc.logger import *
-from frocc.setup_buildcube import write_all_sbatch_files, copy_runscripts
+from frocc.setup_buildcube import write_all_sbatch_files, copy_runscripts, create_directories
+from frocc.supervisor import submit_supervisor, SUPERVISOR_JOB_NAME
+from frocc.channel_index import write_channel_index
+from frocc.cube_store import create_cube_store
+from frocc.ms_metadata import get_ms_metadataList
 
 
 # TODO: put this in default_config.* at a later stage
@@ -47,6 +52,19 @@ PATH_HOME = expanduser("~") + "/"
 # os.environ['PYTHONPATH'] = ":".join([os.environ.get('PYTHONPATH'), PYTHONPATH_QUICKFIX])
 
 
+def is_ms_metadata_readable_without_casatools(conf):
+    '''
+    Reads the metadata of all input MSs with the pure-Python CASA table
+    reader into the metadata cache. Returns False if any MS needs casatools.
+    '''
+    try:
+        get_ms_metadataList(conf, allowCasatools=False)
+    except Exception as e:
+        info(f"MS metadata can not be read without casatools, starting container: {e}")
+        return False
+    return True
+
+
 @click.command(context_settings=dict(
     ignore_unknown_options=True,
     allow_extra_args=True,
@@ -92,7 +110,10 @@ def main(ctx):
         # if [data] scrtion doesnent exists start the container, else give warning and write scripts
         conf = get_config_in_dot_notation(templateFilename=FILEPATH_CONFIG_TEMPLATE, configFilename=FILEPATH_CONFIG_USER)
         print("!!!!!!!!")
-        if not conf.data:
+        if not conf.data and is_ms_metadata_readable_without_casatools(conf):
+            # no casatools needed, plan the channels on the head node
+            subprocess.run(conf.env.commandSingularity.replace("${HOME}", PATH_HOME).split(" ") + ctx.args)
+        elif not conf.data:
             commandList = PREFIX_SRUN.split(" ") + conf.env.prefixSingularity.split(" ") + conf.env.commandSingularity.replace("${HOME}", PATH_HOME).split(" ") + ctx.args
             commandList = [i for i in commandList if i]
             print(commandList)
@@ -107,6 +128,11 @@ def main(ctx):
             copy_runscripts(conf)
 
         write_all_sbatch_files(conf)
+        write_channel_index(conf)
+        if conf.input.cubeStore:
+            create_cube_store(conf, mode="normal")
+            if conf.input.smoothbeam:
+                create_cube_store(conf, mode="smoothed")
         ctx.args.remove("--createScripts")
     if "--start" in ctx.args:
         print_starting_banner("frocc --start")
@@ -114,6 +140,18 @@ def main(ctx):
         time.sleep(5)
         print()
         print_status()
+    if "--supervise" in ctx.args:
+        print_starting_banner("frocc --supervise")
+        # the supervisor runs until the last stage finished, as slurm job
+        # instead of blocking the head node
+        conf = get_config_in_dot_notation(templateFilename=FILEPATH_CONFIG_TEMPLATE, configFilename=FILEPATH_CONFIG_USER)
+        create_directories(conf)
+        command = " ".join([shlex.quote(arg) for arg in conf.env.commandSingularity.replace("${HOME}", PATH_HOME).split(" ") + ctx.args])
+        jobId = submit_supervisor(conf, command)
+        info(f"Supervisor submitted as slurm job {jobId}, log: {conf.env.dirLogs}{SUPERVISOR_JOB_NAME}-{jobId}.out")
+    if "--verify" in ctx.args:
+        print_starting_banner("frocc --verify")
+        subprocess.run(conf.env.commandSingularity.replace("${HOME}", PATH_HOME).split(" ") + ctx.args)
     if "--cancel" in ctx.args or "--kill" in ctx.args:
         print_starting_banner("frocc --cancel")
         subprocess.run(conf.env.commandSingularity.replace("${HOME}", PATH_HOME).split(" ") + ctx.args)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+'''
+Spectral extraction from the (memmapped) data cube with the axes
+[stokes, channel, y, x], or from the section of the tile-compressed cube.
+
+All functions only touch the data they need: peaks are searched in a single
+channel plane, spectra are read as one strided read across all channels and
+box RMS values are computed for all channels in one vectorised call.
+'''
+
+import numpy as np
+
+from frocc.lhelpers import get_std_via_mad
+from frocc.logger import *
+
+
+def get_peak_position_in_plane(dataCube, chanIdx, stokesIdx=0):
+    '''
+    Pixel position (yIdx, xIdx) of the highest value in one channel plane, or
+    None if the plane holds no finite value.
+    '''
+    plane = np.asarray(dataCube[stokesIdx, chanIdx, :, :])
+    if not np.isfinite(plane).any():
+        return None
+    yIdx, xIdx = np.unravel_index(np.nanargmax(plane), plane.shape)
+    return int(yIdx), int(xIdx)
+
+
+def get_first_peak_position(dataCube, chanIdxList, stokesIdx=0):
+    '''
+    Peak position in the first channel of chanIdxList that holds data.
+    Returns (chanIdx, (yIdx, xIdx)).
+    '''
+    for chanIdx in chanIdxList:
+        position = get_peak_position_in_plane(dataCube, chanIdx, stokesIdx=stokesIdx)
+        if position is not None:
+            return chanIdx, position
+    raise ValueError("No channel with finite data found in cube.")
+
+
+def get_spectra(dataCube, positionList, chanIdxList=None, stokesIdxList=(0, 1, 2), chanChunkSize=None):
+    '''
+    Spectra for many pixel positions at once.
+
+    Parameters
+    ----------
+    positionList: list of (yIdx, xIdx)
+       Pixel positions to extract
+    chanIdxList: list of int
+       Channels to return, all channels if None
+    chanChunkSize: int
+       Number of channels read per pass, all channels at once if None. Keeps
+       the pages touched per read bounded for large position lists, and the
+       decompressed planes of a tile-compressed cube.
+
+    Returns
+    -------
+    spectra: numpy.array
+       Array of shape (len(stokesIdxList), len(chanIdxList), len(positionList))
+
+    '''
+    yIdxArray = np.array([position[0] for position in positionList], dtype=np.intp)
+    xIdxArray = np.array([position[1] for position in positionList], dtype=np.intp)
+    chanCount = dataCube.shape[1]
+    if not chanChunkSize:
+        chanChunkSize = chanCount
+    spectra = np.empty((len(stokesIdxList), chanCount, len(positionList)), dtype=np.float32)
+    for chanStart in range(0, chanCount, chanChunkSize):
+        chanStop = min(chanStart + chanChunkSize, chanCount)
+        for ii, stokesIdx in enumerate(stokesIdxList):
+            if isinstance(dataCube, np.ndarray):
+                spectra[ii, chanStart:chanStop, :] = dataCube[stokesIdx][chanStart:chanStop, yIdxArray, xIdxArray]
+            else:
+                # compressed tiles are whole planes, decompress the chunk once
+                spectra[ii, chanStart:chanStop, :] = dataCube[stokesIdx, chanStart:chanStop, :, :][:, yIdxArray, xIdxArray]
+    if chanIdxList is not None:
+        spectra = spectra[:, chanIdxList, :]
+    return spectra
+
+
+def get_box_rms(dataCube, position, boxSize, chanIdxList=None, stokesIdx=3):
+    '''
+    Standard deviation via MAD in a box of boxSize x boxSize pixels centred on
+    position, for all channels in one call.
+    '''
+    yIdx, xIdx = position
+    yStart = max(0, int(yIdx - boxSize/2))
+    yStop = int(yIdx + boxSize/2)
+    xStart = max(0, int(xIdx - boxSize/2))
+    xStop = int(xIdx + boxSize/2)
+    boxCube = np.asarray(dataCube[stokesIdx, :, yStart:yStop, xStart:xStop], dtype=np.float64)
+    if chanIdxList is not None:
+        boxCube = boxCube[chanIdxList]
+    return get_std_via_mad(boxCube.reshape(boxCube.shape[0], -1), axis=1)
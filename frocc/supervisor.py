@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+'''
+Supervisor for the slurm stages, used by `frocc --supervise` instead of
+`frocc --start`.
+
+The stages are submitted one after another. While a stage runs, the states
+of its array tasks are polled with sacct. Failed, timed out or out of memory
+tasks are resubmitted with escalated memory and time limits, stragglers (tasks
+running much longer than their completed siblings) are cancelled and
+resubmitted the same way. The next stage is only submitted when every task of
+the current stage completed or used up its retry budget.
+
+The supervisor itself runs as a lightweight slurm job (see submit_supervisor),
+so the head node is not blocked until the last stage finished.
+
+With a task plan the array tasks of a stage are submitted as one array job
+per resource profile, so tasks with little work get shorter time and
+memory limits than the most expensive one (see frocc.workload).
+'''
+
+import math
+import re
+import statistics
+import subprocess
+import time
+
+from frocc.workload import read_task_costDict
+from frocc.logger import *
+
+
+# sacct states after which a task is resubmitted
+RETRY_STATES = ["FAILED", "TIMEOUT", "NODE_FAIL", "OUT_OF_MEMORY", "BOOT_FAIL", "PREEMPTED", "DEADLINE"]
+# sacct states after which a task is given up
+GIVE_UP_STATES = ["CANCELLED", "REVOKED"]
+# minimum number of completed tasks before stragglers are detected
+STRAGGLER_MIN_COMPLETED = 3
+SUPERVISOR_JOB_NAME = "frocc_supervisor"
+
+
+def parse_slurm_time(timeString):
+    '''
+    Seconds from a slurm time string [D-]HH:MM:SS, MM:SS or MM.
+    '''
+    days = 0
+    if "-" in timeString:
+        days, timeString = timeString.split("-")
+    partList = [int(float(part)) for part in timeString.split(":")]
+    if len(partList) == 1:
+        partList = [0, partList[0], 0]
+    elif len(partList) == 2:
+        partList = [0] + partList
+    hours, minutes, seconds = partList
+    return ((int(days) * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def format_slurm_time(seconds):
+    seconds = int(seconds)
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return f"{days}-{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+
+def parse_slurm_mem(memString):
+    '''
+    Memory in MB from a slurm memory string like "20GB", "500M" or "2T".
+    '''
+    match = re.match(r"([0-9.]+)\s*([KMGT]?)", str(memString).upper())
+    value, unit = float(match.group(1)), match.group(2) or "M"
+    return int(value * {"K": 1 / 1024., "M": 1, "G": 1024, "T": 1024**2}[unit])
+
+
+def get_array_taskIdList(arraySpec):
+    '''
+    Task IDs of a slurm array specification like "1-30%30" or "1,3,5-7".
+    '''
+    taskIdList = []
+    for part in arraySpec.split("%")[0].split(","):
+        if "-" in part:
+            start, stop = part.split("-")
+            taskIdList += list(range(int(start), int(stop) + 1))
+        elif part:
+            taskIdList.append(int(part))
+    return taskIdList
+
+
+def read_sbatch_header(filename):
+    '''
+    The #SBATCH options of an sbatch file as dict.
+    '''
+    headerDict = {}
+    with open(filename) as f:
+        for line in f:
+            match = re.match(r"#SBATCH --([^=\s]+)=(.*)", line.strip())
+            if match:
+                headerDict[match.group(1)] = match.group(2).strip()
+    return headerDict
+
+
+def get_task_profileList(conf, runScript, header):
+    '''
+    Groups the array tasks of runScript into resource profiles. The --time and
+    --mem of the sbatch header are for the most expensive task. A task that
+    costs at most 1/2^k of it gets 1/2^k of the time and memory, at least
+    conf.env.workloadMinTime and conf.env.workloadMinMemory, with at most
+    conf.env.workloadProfileCount profiles.
+
+    Returns
+    -------
+    profileList: list of [taskIdList, optionDict]
+       optionDict holds the array, time and mem of the profile. Without task
+       plan there is one profile with the options of the header.
+
+    '''
+    costDict = read_task_costDict(conf, runScript) if conf.env.workloadProfileCount else None
+    if not costDict:
+        taskIdList = get_array_taskIdList(header.get("array", "1"))
+        return [[taskIdList, {key: header[key] for key in ["array", "time", "mem"] if key in header}]]
+    maxCost = max(costDict.values())
+    maxLevel = max(0, int(conf.env.workloadProfileCount) - 1)
+    levelDict = {}
+    for taskId, cost in sorted(costDict.items()):
+        level = min(maxLevel, int(math.floor(math.log2(maxCost / cost)))) if cost > 0 else maxLevel
+        levelDict.setdefault(level, []).append(taskId)
+    profileList = []
+    for level, taskIdList in sorted(levelDict.items()):
+        optionDict = {"array": ",".join(map(str, taskIdList))}
+        if "time" in header:
+            seconds = parse_slurm_time(header["time"])
+            optionDict["time"] = format_slurm_time(min(seconds, max(seconds / 2**level, parse_slurm_time(conf.env.workloadMinTime))))
+        if "mem" in header:
+            memory = parse_slurm_mem(header["mem"])
+            optionDict["mem"] = f"{int(min(memory, max(memory / 2**level, 1024 * float(conf.env.workloadMinMemory))))}M"
+        profileList.append([taskIdList, optionDict])
+    return profileList
+
+
+def get_profile_optionList(optionDict):
+    '''
+    sbatch command line options of a resource profile.
+    '''
+    return [f"--{key}={value}" for key, value in optionDict.items()]
+
+
+def submit_sbatch(filename, optionList=[]):
+    '''
+    Submits an sbatch file and returns the slurm job ID. Without filename the
+    optionList has to hold the --wrap command.
+    '''
+    command = ["sbatch", "--parsable"] + optionList + ([filename] if filename else [])
+    info(f"Slurm command: {' '.join(command)}")
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"sbatch failed: {result.stderr.strip()}")
+    return int(result.stdout.strip().split(";")[0])
+
+
+def get_supervisor_optionList(conf):
+    '''
+    sbatch options of the slurm job running the supervisor: one core, little
+    memory and a time limit covering all stages, with the account and
+    partition of the default sbatch header.
+    '''
+    optionDict = {key: value for key, value in dict(conf.input.slurmDefaultHeader).items() if key in ["account", "partition", "qos"]}
+    optionDict.update({
+        "job-name": SUPERVISOR_JOB_NAME,
+        "output": conf.env.dirLogs + SUPERVISOR_JOB_NAME + "-%j.out",
+        "error": conf.env.dirLogs + SUPERVISOR_JOB_NAME + "-%j.err",
+        "nodes": 1,
+        "ntasks-per-node": 1,
+        "cpus-per-task": 1,
+        "mem": f"{conf.env.supervisorMemory}GB",
+        "time": conf.env.supervisorTime,
+    })
+    return get_profile_optionList(optionDict)
+
+
+def submit_supervisor(conf, command):
+    '''
+    Submits `command`, which runs the supervisor, as its own slurm job and
+    returns the slurm job ID.
+    '''
+    return submit_sbatch(None, get_supervisor_optionList(conf) + ["--wrap=" + command])
+
+
+def get_array_task_stateDict(jobIdList):
+    '''
+    State and elapsed seconds of all array tasks of the slurm jobs in
+    jobIdList, keyed by (jobId, taskId). Tasks that did not start yet are
+    reported as PENDING.
+    '''
+    stateDict = {}
+    if not jobIdList:
+        return stateDict
+    command = ["sacct", "-X", "-P", "--delimiter=|", "--noheader", "--format=jobid,state,elapsed", "--jobs=" + ",".join(map(str, jobIdList))]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        warning(f"sacct failed, retrying at next poll: {result.stderr.strip()}")
+        return stateDict
+    for line in result.stdout.splitlines():
+        if not line.strip():
+            continue
+        jobIdString, state, elapsed = line.split("|")[:3]
+        state = state.split(" ")[0]
+        match = re.match(r"([0-9]+)_([0-9]+)$", jobIdString)
+        if match:
+            stateDict[(int(match.group(1)), int(match.group(2)))] = (state, parse_slurm_time(elapsed))
+            continue
+        match = re.match(r"([0-9]+)_\[(.*)\]$", jobIdString)
+        if match:
+            for taskId in get_array_taskIdList(match.group(2)):
+                stateDict[(int(match.group(1)), taskId)] = ("PENDING", 0)
+            continue
+        # jobs without array
+        if re.match(r"[0-9]+$", jobIdString):
+            stateDict[(int(jobIdString), 1)] = (state, parse_slurm_time(elapsed))
+    return stateDict
+
+
+def resubmit_tasks(conf, sbatchFilename, taskDict, taskIdList):
+    '''
+    Resubmits the tasks in taskIdList with the memory and time of their
+    resource profile escalated by the number of retries. Tasks with the same
+    profile and number of retries are submitted as one array job.
+    '''
+    jobIdList = []
+    groupDict = {}
+    for taskId in taskIdList:
+        task = taskDict[taskId]
+        groupDict.setdefault((task["retries"], task.get("mem"), task.get("time")), []).append(taskId)
+    for (retries, mem, limit), retryTaskIdList in sorted(groupDict.items(), key=lambda item: item[0][0]):
+        optionList = ["--array=" + ",".join(map(str, retryTaskIdList))]
+        if mem:
+            optionList.append(f"--mem={int(parse_slurm_mem(mem) * float(conf.env.supervisorMemFactor)**retries)}M")
+        if limit:
+            optionList.append("--time=" + format_slurm_time(parse_slurm_time(limit) * float(conf.env.supervisorTimeFactor)**retries))
+        jobId = submit_sbatch(sbatchFilename, optionList)
+        for taskId in retryTaskIdList:
+            taskDict[taskId]["jobId"] = jobId
+        jobIdList.append(jobId)
+    return jobIdList
+
+
+def supervise_stage(conf, runScript, onSubmit):
+    '''
+    Submits one stage and supervises it until every array task completed or
+    used up its retry budget.
+
+    Parameters
+    ----------
+    onSubmit: function
+       Called with the list of newly submitted slurm job IDs.
+
+    Returns
+    -------
+    failedTaskIdList: list of int
+       Tasks that did not complete.
+
+    '''
+    sbatchFilename = runScript.replace(".py", ".sbatch")
+    header = read_sbatch_header(sbatchFilename)
+    maxRetries = int(conf.env.supervisorMaxRetries)
+    stragglerFactor = float(conf.env.supervisorStragglerFactor)
+    info(f"Supervising stage: {sbatchFilename}")
+    taskDict = {}
+    jobIdList = []
+    for taskIdList, optionDict in get_task_profileList(conf, runScript, header):
+        jobId = submit_sbatch(sbatchFilename, get_profile_optionList(optionDict))
+        jobIdList.append(jobId)
+        for taskId in taskIdList:
+            taskDict[taskId] = {
+                "jobId": jobId, "retries": 0, "done": False, "completed": False,
+                "mem": optionDict.get("mem"), "time": optionDict.get("time"),
+            }
+    onSubmit(jobIdList)
+
+    while not all([task["done"] for task in taskDict.values()]):
+        time.sleep(int(conf.env.supervisorPollInterval))
+        openTaskDict = {taskId: task for taskId, task in taskDict.items() if not task["done"]}
+        stateDict = get_array_task_stateDict(sorted(set([task["jobId"] for task in openTaskDict.values()])))
+        completedElapsedList = [task["elapsed"] for task in taskDict.values() if task["completed"]]
+        medianElapsed = statistics.median(completedElapsedList) if len(completedElapsedList) >= STRAGGLER_MIN_COMPLETED else None
+        retryTaskIdList = []
+        for taskId, task in openTaskDict.items():
+            state, elapsed = stateDict.get((task["jobId"], taskId), ("PENDING", 0))
+            if state == "COMPLETED":
+                task["done"] = task["completed"] = True
+                task["elapsed"] = elapsed
+            elif state in RETRY_STATES or (
+                state == "RUNNING" and stragglerFactor > 0 and medianElapsed and elapsed > stragglerFactor * medianElapsed
+            ):
+                if task["retries"] >= maxRetries:
+                    if state != "RUNNING":
+                        error(f"{runScript} task {taskId} {state}, retry budget used up.")
+                        task["done"] = True
+                    continue
+                if state == "RUNNING":
+                    warning(f"{runScript} task {taskId} is a straggler ({elapsed}s, median {medianElapsed}s), resubmitting.")
+                    subprocess.run(["scancel", f"{task['jobId']}_{taskId}"])
+                else:
+                    warning(f"{runScript} task {taskId} {state}, resubmitting (retry {task['retries'] + 1}/{maxRetries}).")
+                task["retries"] += 1
+                retryTaskIdList.append(taskId)
+            elif state in GIVE_UP_STATES:
+                error(f"{runScript} task {taskId} {state}, not resubmitting.")
+                task["done"] = True
+        if retryTaskIdList:
+            onSubmit(resubmit_tasks(conf, sbatchFilename, taskDict, retryTaskIdList))
+
+    failedTaskIdList = [taskId for taskId, task in taskDict.items() if not task["completed"]]
+    info(f"Stage {runScript} finished, {len(taskDict) - len(failedTaskIdList)} of {len(taskDict)} tasks completed.")
+    return failedTaskIdList
+
+
+def supervise(conf, onSubmit):
+    '''
+    Runs all conf.input.runScripts stage by stage under supervision.
+    '''
+    for runScript in conf.input.runScripts:
+        failedTaskIdList = supervise_stage(conf, runScript, onSubmit)
+        if failedTaskIdList:
+            warning(f"Releasing next stage with failed {runScript} tasks: {failedTaskIdList}")
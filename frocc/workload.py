@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+'''
+Workload model and task plan for the split and tclean slurm arrays.
+
+The cost of splitting one output channel from one MS is estimated as the
+number of rows of the MS times the number of its unflagged input channels
+that fall into the output channel: every input channel counts with its
+unflagged fraction from the flag summary of the MS metadata
+(conf.env.workloadFlagSummary), or fully without. The tclean cost of an
+output channel is the sum over all contributing MSs. Work units are packed
+into array tasks (first fit decreasing) with the cost of the most expensive
+unit as capacity, so many small channels share one allocation while no task
+takes longer than the largest single channel.
+
+The time and memory of the sbatch files are meant for the most expensive
+task. Slurm gives all tasks of one array job the same limits, so the tasks
+are grouped into resource profiles by their cost relative to the most
+expensive task (supervisor.get_task_profileList) and every profile is
+submitted as its own array job of the same sbatch file, with scaled --time
+and --mem.
+'''
+
+import csv
+
+from frocc.lhelpers import get_firstFreq
+from frocc.ms_metadata import get_ms_metadataList
+from frocc.logger import *
+
+
+TASK_PLAN_LEGEND = ["runScript", "taskId", "unitList", "cost [rows x unflagged channels]"]
+
+
+def get_inputChanCountDict(conf, metadata):
+    '''
+    Number of unflagged input channels of an MS per output channel number,
+    every input channel weighted by its unflagged fraction if the metadata
+    holds flag fractions.
+    '''
+    firstFreq = get_firstFreq(conf)
+    flagFractionList = metadata.get("flagFractionList") or [[0.] * len(chanFreqs) for chanFreqs in metadata["chanFreqList"]]
+    inputChanCountDict = {}
+    for chanFreqs, flagFractions in zip(metadata["chanFreqList"], flagFractionList):
+        for freq, flagFraction in zip(chanFreqs, flagFractions):
+            chanNo = int((freq - firstFreq) // conf.input.outputChanBandwidth) + 1
+            inputChanCountDict[chanNo] = inputChanCountDict.get(chanNo, 0) + 1. - flagFraction
+    return inputChanCountDict
+
+
+def get_split_unitList(conf, metadataList):
+    '''
+    All split work units [msIdx, chanNo, cost] in the order of the split
+    array without task plan.
+    '''
+    unitList = []
+    for msIdx, chanList in enumerate(conf.data.predictedOutputChannels):
+        inputChanCountDict = get_inputChanCountDict(conf, metadataList[msIdx])
+        for chanNo in chanList:
+            # fully flagged channels still get split and imaged
+            unitList.append([msIdx, chanNo, max(1, round(metadataList[msIdx]["nrow"] * inputChanCountDict.get(chanNo, 0)))])
+    return unitList
+
+
+def get_tclean_unitList(splitUnitList):
+    '''
+    All tclean work units [chanNo, cost], the cost summed over all MSs.
+    '''
+    costDict = {}
+    for msIdx, chanNo, cost in splitUnitList:
+        costDict[chanNo] = costDict.get(chanNo, 0) + cost
+    return [[chanNo, costDict[chanNo]] for chanNo in sorted(costDict)]
+
+
+def pack_units(unitList):
+    '''
+    Packs work units (lists with the cost as last item) into tasks with first
+    fit decreasing. The capacity of a task is the cost of the largest unit.
+
+    Returns
+    -------
+    taskList: list of lists of units
+    '''
+    if not unitList:
+        return []
+    capacity = max([unit[-1] for unit in unitList])
+    taskList = []
+    taskCostList = []
+    for unit in sorted(unitList, key=lambda unit: unit[-1], reverse=True):
+        for ii, taskCost in enumerate(taskCostList):
+            if taskCost + unit[-1] <= capacity:
+                taskList[ii].append(unit)
+                taskCostList[ii] += unit[-1]
+                break
+        else:
+            taskList.append([unit])
+            taskCostList.append(unit[-1])
+    return taskList
+
+
+def get_taskPlan_filepath(conf):
+    return conf.input.basename + conf.env.extTaskPlan
+
+
+def write_task_plan(conf):
+    '''
+    Writes the task plan for cube_split and cube_tclean.
+
+    Returns
+    -------
+    taskPlanDict: dict
+       Number of array tasks per runScript, or an empty dict if the MS
+       metadata is not available and no plan was written.
+
+    '''
+    try:
+        metadataList = get_ms_metadataList(conf, allowCasatools=False)
+    except Exception as e:
+        warning(f"No MS metadata for the workload model, using one array task per channel: {e}")
+        return {}
+    if conf.env.workloadFlagSummary and not all(["flagFractionList" in metadata for metadata in metadataList]):
+        warning("No flag summary in the MS metadata, the workload model counts all input channels as unflagged.")
+    splitUnitList = get_split_unitList(conf, metadataList)
+    taskListDict = {
+        "cube_split.py": pack_units(splitUnitList),
+        "cube_tclean.py": pack_units(get_tclean_unitList(splitUnitList)),
+    }
+    filepathPlan = get_taskPlan_filepath(conf)
+    with open(filepathPlan, "w") as csvFile:
+        writer = csv.writer(csvFile, delimiter="\t")
+        csvData = [TASK_PLAN_LEGEND]
+        for runScript, taskList in taskListDict.items():
+            for taskId, task in enumerate(taskList, 1):
+                unitString = ",".join([":".join([str(item) for item in unit[:-1]]) for unit in task])
+                csvData.append([runScript, taskId, unitString, sum([unit[-1] for unit in task])])
+        writer.writerows(csvData)
+    taskPlanDict = {runScript: len(taskList) for runScript, taskList in taskListDict.items()}
+    info(f"Writing task plan with {taskPlanDict} array tasks: {filepathPlan}")
+    return taskPlanDict
+
+
+def read_task_plan(conf, runScript, taskId):
+    '''
+    Work units of one array task of runScript: a list of [msIdx, chanNo] for
+    cube_split and of [chanNo] for cube_tclean. Returns None if there is no
+    task plan.
+    '''
+    try:
+        with open(get_taskPlan_filepath(conf)) as csvFile:
+            reader = csv.reader(csvFile, delimiter="\t")
+            next(reader)
+            for row in reader:
+                if row[0] == runScript and int(row[1]) == int(taskId):
+                    return [[int(item) for item in unit.split(":")] for unit in row[2].split(",")]
+    except FileNotFoundError:
+        return None
+    raise ValueError(f"Task {taskId} of {runScript} not found in task plan: {get_taskPlan_filepath(conf)}")
+
+
+def read_task_costDict(conf, runScript):
+    '''
+    Cost of every array task of runScript from the task plan, with the task
+    ID as key. Returns None if there is no task plan.
+    '''
+    try:
+        with open(get_taskPlan_filepath(conf)) as csvFile:
+            reader = csv.reader(csvFile, delimiter="\t")
+            next(reader)
+            return {int(row[1]): float(row[3]) for row in reader if row[0] == runScript}
+    except FileNotFoundError:
+        return None
+
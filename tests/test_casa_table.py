@@ -0,0 +1,72 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from frocc.casa_table import read_casa_table_columns, read_table_nrow
+from frocc.ms_metadata import read_ms_metadata
+
+
+# tiny tables written with python-casacore (TILED without its table.f0_TSM0)
+DIR_TABLES = os.path.join(os.path.dirname(__file__), "data", "casa_tables")
+CHAN_COUNTS = [4, 7, 1]
+
+
+def get_table_path(name):
+    return os.path.join(DIR_TABLES, name)
+
+
+def test_spectral_window():
+    spwDict = read_casa_table_columns(get_table_path("SPECTRAL_WINDOW"), ["CHAN_FREQ", "CHAN_WIDTH", "NAME"])
+    assert read_table_nrow(get_table_path("SPECTRAL_WINDOW")) == 3
+    assert spwDict["NAME"] == ["spw0", "spw1", "spw2"]
+    for row, chanCount in enumerate(CHAN_COUNTS):
+        assert np.array_equal(spwDict["CHAN_FREQ"][row], 856e6 + row * 1e8 + np.arange(chanCount) * 2.5e5)
+        assert np.array_equal(spwDict["CHAN_WIDTH"][row], np.full(chanCount, 2.5e5))
+
+
+def test_field_names():
+    fieldDict = read_casa_table_columns(get_table_path("FIELD"), ["NAME"])
+    assert read_table_nrow(get_table_path("FIELD")) == 3
+    assert fieldDict["NAME"] == ["J0408-6545", "A", "a_rather_long_field_name_over_eight"]
+
+
+def test_direct_array():
+    arrayList = read_casa_table_columns(get_table_path("DIRECT"), ["VAL"])["VAL"]
+    assert read_table_nrow(get_table_path("DIRECT")) == 5
+    assert np.array_equal(np.array(arrayList), np.arange(15.).reshape(5, 3))
+
+
+def test_unsupported_layouts():
+    with pytest.raises(NotImplementedError):
+        read_casa_table_columns(get_table_path("TILED"), ["DATA"])
+    with pytest.raises(ValueError):
+        read_casa_table_columns(get_table_path("FIELD"), ["MISSING"])
+
+
+def make_ms(tmp_path, fieldTable="FIELD"):
+    '''
+    Measurement set like directory with the DIRECT table as main table.
+    '''
+    msPath = str(tmp_path / "test.ms")
+    shutil.copytree(get_table_path("DIRECT"), msPath)
+    shutil.copytree(get_table_path("SPECTRAL_WINDOW"), os.path.join(msPath, "SPECTRAL_WINDOW"))
+    shutil.copytree(get_table_path(fieldTable), os.path.join(msPath, "FIELD"))
+    return msPath
+
+
+def test_read_ms_metadata(tmp_path):
+    metadata = read_ms_metadata(make_ms(tmp_path), allowCasatools=False)
+    assert metadata["nrow"] == 5
+    assert [len(chanFreqs) for chanFreqs in metadata["chanFreqList"]] == CHAN_COUNTS
+    assert metadata["chanWidthList"][1] == [2.5e5] * 7
+    assert metadata["fieldList"][0] == "J0408-6545"
+
+
+def test_read_ms_metadata_fallback(tmp_path, monkeypatch):
+    msPath = make_ms(tmp_path, fieldTable="TILED")
+    with pytest.raises(ValueError):
+        read_ms_metadata(msPath, allowCasatools=False)
+    monkeypatch.setattr("frocc.ms_metadata.read_ms_metadata_with_casatools", lambda msPath: {"casatools": msPath})
+    assert read_ms_metadata(msPath) == {"casatools": msPath}
@@ -0,0 +1,53 @@
+import os
+
+import numpy as np
+from astropy.io import fits
+
+from frocc.lhelpers import DotMap, allocate_fits_file
+from frocc.image_catalogue import get_image_entry
+from frocc.channel_sidecar import write_channel_sidecar
+from frocc.cube_buildcube import fill_cube_slab
+
+
+def get_conf():
+    return DotMap({
+        "input": DotMap({
+            "stokes": "IQUV", "dirOutput": ".", "basename": "test", "channelDigits": 3, "crop": False,
+            "fileXYphasePolAngleCoeffs": "", "sparseCube": False,
+        }),
+        "env": DotMap({
+            "dirImages": "images/", "markerChannel": ".chan", "extTcleanImage": ".image.fits", "extCubeFits": ".cube.fits",
+            "extChannelSidecar": ".stats.json", "buildcubeFastPath": True, "fastPathSampleStep": 4,
+        }),
+    })
+
+
+def test_fill_cube_slab_with_unreadable_channels(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("images")
+    conf = get_conf()
+    catalogueDict = {}
+    rng = np.random.default_rng(0)
+    for chanNo in [1, 2, 3, 5]:
+        filepath = f"images/test.chan{chanNo:03d}.image.fits"
+        fits.PrimaryHDU(rng.normal(scale=1e-3, size=(4, 1, 16, 20)).astype(np.float32)).writeto(filepath)
+        if chanNo == 3:
+            write_channel_sidecar(conf, chanNo)
+        catalogueDict[chanNo] = get_image_entry(filepath, ".chan")
+    # channel 4 is missing, channel 5 got truncated after it was catalogued
+    with open("images/test.chan005.image.fits", "r+b") as f:
+        f.truncate(catalogueDict[5]["dataOffset"] + 2 * 16 * 20 * 4)
+    header = fits.Header()
+    header["SIMPLE"] = True
+    header["BITPIX"] = -32
+    header["NAXIS"] = 4
+    allocate_fits_file("test.cube.fits", header, (20, 16, 5, 4))
+
+    rmsDict, checksumDict = fill_cube_slab(conf, range(1, 6), catalogueDict)
+    assert all([len(valueList) == 5 for valueList in rmsDict.values()])
+    assert rmsDict["chanNo"] == [1, 2, 3, 4, 5]
+    assert rmsDict["flagged"] == [False, False, False, True, True]
+    assert np.isnan(rmsDict["freq"][3:]).all() and np.isnan(rmsDict["rmsV"][3:]).all()
+    assert rmsDict["freq"][:3] == [catalogueDict[chanNo]["frequency"] for chanNo in [1, 2, 3]]
+    assert sorted(checksumDict) == [1, 2, 3, 4, 5]
+    assert np.isnan(fits.getdata("test.cube.fits")[:, 3:]).all()
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from frocc.lhelpers import DotMap
+from frocc.channel_index import write_cube_validity_index
+from frocc.cube_compress import COMPRESSION_TYPE_LIST, QUANTISED_COMPRESSION_TYPE_LIST, write_compressed_cube, replace_compressed_tiles, get_compressedCube_filepath, open_cube
+from frocc.cube_quantise import write_quantised_cube, get_quantisedCube_filepath, read_quantised_channel
+
+
+NOISE = 1e-3
+QUANTISATION_STEP = 0.25
+
+
+def get_conf(tmp_path, compressionType, sparseCube=False):
+    return DotMap({
+        "input": DotMap({
+            "dirOutput": str(tmp_path), "basename": "test", "compressedCube": compressionType,
+            "compressionQuantisationStep": QUANTISATION_STEP, "sparseCube": sparseCube, "cubeStore": False,
+            "quantisedCube": "int16", "quantisationStep": QUANTISATION_STEP,
+        }),
+        "env": DotMap({
+            "extCubeFits": ".cube.fits", "extCubeCompressedFits": ".cube.compressed.fits",
+            "compressionChanChunkSize": 3, "compressionMaxCpuCores": 2,
+            "extCubeValidityIndex": ".cube.validity.tab", "extCubeQuantisedFits": ".cube.quantised.fits",
+            "quantiseChanChunkSize": 2, "quantiseMaxCpuCores": 2, "extCubeStore": ".cube.zarr",
+        }),
+    })
+
+
+@pytest.mark.parametrize("compressionType", COMPRESSION_TYPE_LIST)
+def test_compressed_cube_round_trip(tmp_path, monkeypatch, compressionType):
+    monkeypatch.setattr("frocc.cube_compress.get_channel_noiseDict", lambda conf, mode="normal": {chanNo: NOISE for chanNo in range(1, 6)})
+    conf = get_conf(tmp_path, compressionType)
+    cube = np.random.default_rng(1).normal(scale=NOISE, size=(4, 5, 64, 48)).astype(np.float32)
+    cube[:, 2] = np.nan
+    cube[0, 1, 3:7, 5] = np.nan
+    fits.PrimaryHDU(cube).writeto(tmp_path / "test.cube.fits")
+    write_compressed_cube(conf)
+
+    tolerance = QUANTISATION_STEP * NOISE / 2. * (1 + 1e-6) if compressionType in QUANTISED_COMPRESSION_TYPE_LIST else 0.
+    with fits.open(get_compressedCube_filepath(conf)) as hud:
+        hud.verify("exception")
+        assert isinstance(hud[1], fits.CompImageHDU)
+        data = hud[1].data
+        assert data.shape == cube.shape
+        assert np.array_equal(np.isnan(data), np.isnan(cube))
+        assert np.nanmax(np.abs(data - cube)) <= tolerance
+        assert np.array_equal(hud[1].section[2, 3], data[2, 3], equal_nan=True)
+
+    replace_compressed_tiles(conf, [4])
+    with fits.open(get_compressedCube_filepath(conf)) as hud:
+        data = hud[1].data
+        assert np.isnan(data[:, 3]).all()
+        assert np.nanmax(np.abs(data[:, [0, 1, 4]] - cube[:, [0, 1, 4]])) <= tolerance
+
+
+def test_sparse_cube_holes_read_as_nan(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    conf = get_conf(tmp_path, "RICE_1", sparseCube=True)
+    cube = np.random.default_rng(2).normal(scale=NOISE, size=(2, 5, 16, 12)).astype(np.float32)
+    # channels 2 and 4 are unallocated holes of the sparse cube
+    cube[:, [1, 3]] = 0.
+    fits.PrimaryHDU(cube).writeto(tmp_path / "test.cube.fits")
+    write_cube_validity_index(conf, {
+        "chanNo": [1, 2, 3, 4, 5], "frequency": [1e9 + ii * 1e6 for ii in range(0, 5)],
+        "valid": [True, False, True, False, True], "rmsStokesI": [NOISE] * 5, "rmsNoise": [NOISE] * 5, "maxStokesI": [1.] * 5,
+    })
+    expected = cube.copy()
+    expected[:, [1, 3]] = np.nan
+
+    hud, data, header = open_cube(conf)
+    assert data.shape == cube.shape
+    assert np.array_equal(data[:, :, :, :], expected, equal_nan=True)
+    assert np.isnan(data[0, 1]).all() and np.array_equal(data[1, 2], cube[1, 2])
+    assert np.array_equal(data[1, 1:4, 2:5, 3], expected[1, 1:4, 2:5, 3], equal_nan=True)
+    hud.close()
+
+    write_compressed_cube(conf)
+    with fits.open(get_compressedCube_filepath(conf)) as hud:
+        assert np.array_equal(np.isnan(hud[1].data), np.isnan(expected))
+
+    write_quantised_cube(conf)
+    for chanNo in [1, 2, 3, 4, 5]:
+        assert np.array_equal(np.isnan(read_quantised_channel(get_quantisedCube_filepath(conf), chanNo)), np.isnan(expected[:, chanNo - 1]))
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from frocc.lhelpers import DotMap
+from frocc.cube_quantise import (
+    QUANTISED_DTYPE_DICT, get_plane_scaling, quantise_plane, dequantise_plane,
+    write_quantised_cube, get_quantisedCube_filepath, read_quantised_channel,
+)
+
+
+def get_plane(seed=0, shape=(64, 48)):
+    plane = np.random.default_rng(seed).normal(scale=1e-3, size=shape).astype(np.float32)
+    plane[10, 10] = 0.5
+    plane[3, 7] = np.nan
+    return plane
+
+
+@pytest.mark.parametrize("quantisedType", ["int16", "int32"])
+@pytest.mark.parametrize("quantisationStep", [0., 0.5])
+def test_quantisation_error_bound(quantisedType, quantisationStep):
+    dtype = QUANTISED_DTYPE_DICT[quantisedType]
+    plane = get_plane()
+    noise = 1e-3
+    bscale, bzero = get_plane_scaling(plane, dtype, noise=noise, quantisationStep=quantisationStep)
+    restored = dequantise_plane(quantise_plane(plane, bscale, bzero, dtype), bscale, bzero)
+    finiteMask = np.isfinite(plane)
+    # float32 rounding of the restored values on top of BSCALE / 2
+    tolerance = bscale / 2. + np.spacing(np.float32(np.max(np.abs(plane[finiteMask]))))
+    assert np.max(np.abs(restored[finiteMask] - plane[finiteMask])) <= tolerance
+    if quantisationStep > 0:
+        assert bscale >= quantisationStep * noise
+
+
+@pytest.mark.parametrize("quantisedType", ["int16", "int32"])
+def test_nan_round_trip(quantisedType):
+    dtype = QUANTISED_DTYPE_DICT[quantisedType]
+    plane = get_plane()
+    plane[0, :] = np.nan
+    bscale, bzero = get_plane_scaling(plane, dtype)
+    restored = dequantise_plane(quantise_plane(plane, bscale, bzero, dtype), bscale, bzero)
+    assert np.array_equal(np.isnan(restored), np.isnan(plane))
+
+
+def test_all_nan_and_constant_planes():
+    dtype = QUANTISED_DTYPE_DICT["int16"]
+    for plane in [np.full((4, 4), np.nan, dtype=np.float32), np.full((4, 4), 0.25, dtype=np.float32)]:
+        bscale, bzero = get_plane_scaling(plane, dtype)
+        restored = dequantise_plane(quantise_plane(plane, bscale, bzero, dtype), bscale, bzero)
+        assert np.array_equal(restored, plane, equal_nan=True)
+
+
+@pytest.mark.parametrize("quantisedType", ["int16", "int32"])
+def test_read_quantised_channel_round_trip(tmp_path, monkeypatch, quantisedType):
+    monkeypatch.chdir(tmp_path)
+    conf = DotMap({
+        "input": DotMap({"dirOutput": str(tmp_path), "basename": "test", "quantisedCube": quantisedType, "quantisationStep": 0.5}),
+        "env": DotMap({
+            "extCubeFits": ".cube.fits", "extCubeQuantisedFits": ".cube.quantised.fits",
+            "extCubeValidityIndex": ".cube.validity.tab", "quantiseChanChunkSize": 2, "quantiseMaxCpuCores": 2,
+        }),
+    })
+    cube = np.array([[get_plane(seed=10 * stokesIdx + chanIdx) for chanIdx in range(5)] for stokesIdx in range(4)])
+    fits.PrimaryHDU(cube).writeto(tmp_path / "test.cube.fits")
+    write_quantised_cube(conf)
+    filepathQuantised = get_quantisedCube_filepath(conf)
+    table = fits.getdata(filepathQuantised, extname="QUANTISE")
+    for chanNo in range(1, 6):
+        channel = read_quantised_channel(filepathQuantised, chanNo)
+        assert channel.shape == cube[:, chanNo - 1].shape
+        assert np.array_equal(np.isnan(channel), np.isnan(cube[:, chanNo - 1]))
+        for row in table[table["chanNo"] == chanNo]:
+            original = cube[row["stokesIdx"], chanNo - 1]
+            finiteMask = np.isfinite(original)
+            tolerance = row["BSCALE"] / 2. + np.spacing(np.float32(np.max(np.abs(original[finiteMask]))))
+            assert np.max(np.abs(channel[row["stokesIdx"]][finiteMask] - original[finiteMask])) <= tolerance
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from frocc.image_catalogue import get_image_entry, read_image_plane
+
+
+def write_channel_image(filepath, dtype=np.float32):
+    data = np.random.default_rng(0).normal(size=(4, 1, 32, 24)).astype(dtype)
+    fits.PrimaryHDU(data).writeto(filepath)
+    return data
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_read_image_plane(tmp_path, dtype):
+    filepath = str(tmp_path / "test.chan001.image.fits")
+    data = write_channel_image(filepath, dtype=dtype)
+    entry = get_image_entry(filepath, ".chan")
+    for stokesIdx in range(0, 4):
+        assert np.array_equal(read_image_plane(entry, stokesIdx), data[stokesIdx, 0])
+    assert np.array_equal(read_image_plane(entry, 2, window=(3, 20, 5, 17)), data[2, 0, 3:20, 5:17])
+
+
+def test_read_image_plane_truncated(tmp_path):
+    filepath = str(tmp_path / "test.chan001.image.fits")
+    write_channel_image(filepath)
+    entry = get_image_entry(filepath, ".chan")
+    with open(filepath, "r+b") as f:
+        f.truncate(entry["dataOffset"] + 3 * 32 * 24 * 4 + 100)
+    out = np.zeros((32, 24), dtype=np.float32)
+    read_image_plane(entry, 2, out=out)
+    with pytest.raises(EOFError):
+        read_image_plane(entry, 3, out=out)
+    with pytest.raises(EOFError):
+        read_image_plane(entry, 3, window=(0, 32, 2, 10), out=out[:, :8].copy())
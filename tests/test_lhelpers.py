@@ -0,0 +1,57 @@
+import pytest
+
+from frocc.lhelpers import (
+    DotMap, CHANNEL_DIGITS_MIN, get_channelDigits, encode_channelNumber, decode_channelNumber,
+    get_channelNumber_from_filename, change_channelNumber_from_filename,
+)
+from frocc.channel_index import get_channel_visPath, get_channel_imagePath
+
+
+def get_conf(channelDigits="", predictedOutputChannels=None):
+    return DotMap({
+        "input": DotMap({"channelDigits": channelDigits, "inputMS": ["/data/obs.ms"], "basename": "cube"}),
+        "env": DotMap({"dirVis": "vis/", "dirImages": "images/", "markerChannel": ".chan", "extTcleanImage": ".image.fits"}),
+        "data": DotMap({"predictedOutputChannels": predictedOutputChannels or []}),
+    })
+
+
+@pytest.mark.parametrize("chanNo, digits, chanId", [
+    (7, 3, "007"), (999, 3, "999"), (7, 4, "0007"), (1000, 4, "1000"), (12345, 5, "12345"), (42, 6, "000042"),
+])
+def test_channelNumber_round_trip(chanNo, digits, chanId):
+    assert encode_channelNumber(chanNo, digits) == chanId
+    filename = f"/images/cube.chan{chanId}.image.fits"
+    assert decode_channelNumber(filename, ".chan") == chanNo
+    assert get_channelNumber_from_filename(filename, ".chan", digits) == chanId
+
+
+def test_channelNumber_too_wide():
+    with pytest.raises(ValueError):
+        encode_channelNumber(1000, 3)
+    with pytest.raises(ValueError):
+        encode_channelNumber(10000)
+    with pytest.raises(ValueError):
+        change_channelNumber_from_filename("cube.chan0999.image.fits", ".chan", 10000, 4)
+    with pytest.raises(ValueError):
+        decode_channelNumber("cube.image.fits", ".chan")
+
+
+def test_change_channelNumber_from_filename():
+    assert change_channelNumber_from_filename("/img/cube.chan007.image.fits", ".chan", 1234, 4) == "/img/cube.chan1234.image.fits"
+    assert change_channelNumber_from_filename("/img/cube.chan0007.image.fits", ".chan", 8, 4) == "/img/cube.chan0008.image.fits"
+    # only the last marker in the basename is replaced
+    assert change_channelNumber_from_filename("/x.chan1/a.chan01.chan002.fits", ".chan", 3) == "/x.chan1/a.chan01.chan003.fits"
+
+
+def test_get_channelDigits():
+    assert get_channelDigits(get_conf()) == CHANNEL_DIGITS_MIN
+    assert get_channelDigits(get_conf(predictedOutputChannels=[[1, 2], [3]])) == CHANNEL_DIGITS_MIN
+    assert get_channelDigits(get_conf(predictedOutputChannels=[[998, 999], [1000, 1001]])) == 4
+    assert get_channelDigits(get_conf(channelDigits="5", predictedOutputChannels=[[1000]])) == 5
+
+
+def test_channel_paths_with_wide_channel_numbers():
+    conf = get_conf(predictedOutputChannels=[[999, 1000]])
+    assert get_channel_visPath(conf, 12, 0) == "vis/obs.chan0012.ms"
+    assert get_channel_imagePath(conf, 1000) == "images/cube.chan1000.image.fits"
+    assert decode_channelNumber(get_channel_imagePath(conf, 1000), ".chan") == 1000
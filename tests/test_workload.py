@@ -0,0 +1,91 @@
+import subprocess
+
+from frocc.lhelpers import DotMap
+from frocc.workload import get_split_unitList, get_tclean_unitList, pack_units, write_task_plan, read_task_plan, read_task_costDict
+from frocc.supervisor import get_task_profileList, get_profile_optionList, parse_slurm_time, submit_supervisor
+
+
+def get_conf(tmp_path, profileCount=4):
+    return DotMap({
+        "input": DotMap({
+            "basename": str(tmp_path / "test"), "freqRanges": ["1000-1010"], "outputChanBandwidth": 2.5e6,
+            "inputMS": [str(tmp_path / "a.ms"), str(tmp_path / "b.ms")],
+        }),
+        "env": DotMap({
+            "extTaskPlan": ".taskplan.tab", "workloadFlagSummary": True, "workloadProfileCount": profileCount,
+            "workloadMinTime": "00:15:00", "workloadMinMemory": 1,
+        }),
+        "data": DotMap({"predictedOutputChannels": [[1, 2, 3, 4], [1, 2]]}),
+    })
+
+
+def get_metadataList():
+    # four input channels per output channel
+    chanFreqs = [1000e6 + 0.625e6 * (ii + 0.5) for ii in range(0, 16)]
+    return [
+        {"nrow": 1000, "chanFreqList": [chanFreqs], "flagFractionList": [[0.] * 8 + [1.] * 4 + [0.5] * 4]},
+        {"nrow": 500, "chanFreqList": [chanFreqs[:8]]},
+    ]
+
+
+def test_cost_model(tmp_path):
+    splitUnitList = get_split_unitList(get_conf(tmp_path), get_metadataList())
+    # fully flagged channel 3 is still split and imaged
+    assert splitUnitList == [[0, 1, 4000], [0, 2, 4000], [0, 3, 1], [0, 4, 2000], [1, 1, 2000], [1, 2, 2000]]
+    assert get_tclean_unitList(splitUnitList) == [[1, 6000], [2, 6000], [3, 1], [4, 2000]]
+
+
+def test_pack_units():
+    taskList = pack_units([[1, 10], [2, 3], [3, 7], [4, 4], [5, 6]])
+    assert all([sum([unit[-1] for unit in task]) <= 10 for task in taskList])
+    assert sorted([unit[0] for task in taskList for unit in task]) == [1, 2, 3, 4, 5]
+    assert len(taskList) == 3
+
+
+def test_task_profiles(tmp_path, monkeypatch):
+    conf = get_conf(tmp_path)
+    monkeypatch.setattr("frocc.workload.get_ms_metadataList", lambda conf, allowCasatools: get_metadataList())
+    assert write_task_plan(conf) == {"cube_split.py": 4, "cube_tclean.py": 3}
+    assert read_task_plan(conf, "cube_tclean.py", 1) == [[1]]
+    costDict = read_task_costDict(conf, "cube_split.py")
+    assert sorted(costDict.values()) == [2001, 4000, 4000, 4000]
+
+    profileList = get_task_profileList(conf, "cube_tclean.py", {"array": "1-3%3", "time": "20:00:00", "mem": "16GB"})
+    assert [optionDict for taskIdList, optionDict in profileList] == [
+        {"array": "1,2", "time": "0-20:00:00", "mem": "16384M"},
+        {"array": "3", "time": "0-10:00:00", "mem": "8192M"},
+    ]
+    assert get_profile_optionList(profileList[1][1]) == ["--array=3", "--time=0-10:00:00", "--mem=8192M"]
+    # the smaller profile is bounded by the minimum time and memory
+    profileList = get_task_profileList(conf, "cube_tclean.py", {"array": "1-3%3", "time": "00:20:00", "mem": "1.5GB"})
+    assert [parse_slurm_time(optionDict["time"]) for taskIdList, optionDict in profileList] == [1200, 900]
+    assert profileList[-1][1]["mem"] == "1024M"
+    # at most workloadProfileCount profiles
+    conf.env.workloadProfileCount = 1
+    profileList = get_task_profileList(conf, "cube_tclean.py", {"array": "1-3%3", "time": "20:00:00", "mem": "16GB"})
+    assert profileList == [[[1, 2, 3], {"array": "1,2,3", "time": "0-20:00:00", "mem": "16384M"}]]
+
+
+def test_task_profiles_without_plan(tmp_path):
+    header = {"array": "1-5%5", "time": "02:00:00", "mem": "20GB", "job-name": "cube_split"}
+    profileList = get_task_profileList(get_conf(tmp_path), "cube_split.py", header)
+    assert profileList == [[[1, 2, 3, 4, 5], {"array": "1-5%5", "time": "02:00:00", "mem": "20GB"}]]
+
+
+def test_submit_supervisor(tmp_path, monkeypatch):
+    conf = get_conf(tmp_path)
+    conf.input.slurmDefaultHeader = {"array": "1-30%30", "mem": "29GB", "partition": "Main", "account": "b03-idia-ag"}
+    conf.env.update({"dirLogs": "logs/", "supervisorMemory": 2, "supervisorTime": "7-00:00:00"})
+    commandList = []
+
+    def run(command, **kwargs):
+        commandList.append(command)
+        return subprocess.CompletedProcess(command, 0, stdout="4242;cluster\n", stderr="")
+
+    monkeypatch.setattr("frocc.supervisor.subprocess.run", run)
+    assert submit_supervisor(conf, "setup_buildcube --supervise") == 4242
+    assert commandList == [[
+        "sbatch", "--parsable", "--partition=Main", "--account=b03-idia-ag", "--job-name=frocc_supervisor",
+        "--output=logs/frocc_supervisor-%j.out", "--error=logs/frocc_supervisor-%j.err", "--nodes=1",
+        "--ntasks-per-node=1", "--cpus-per-task=1", "--mem=2GB", "--time=7-00:00:00", "--wrap=setup_buildcube --supervise",
+    ]]